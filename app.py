@@ -23,17 +23,45 @@ This setup ensures:
 """
 
 import requests
+import base64
 import json
 import flask
+import hashlib
+import heapq
 import os
+import random
 import secrets
 import csv
+import gzip
+import http.cookiejar
 import io
+import itertools
 import logging
+import math
+import mimetypes
+import queue
 import re
-from datetime import datetime
-from bs4 import BeautifulSoup
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from bs4 import BeautifulSoup, SoupStrainer
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from werkzeug.routing import BaseConverter
+from xml.sax.saxutils import escape as xml_escape
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 # -----------------------------------------------------------------------------
 # Standalone Mode (Docker all-in-one)
@@ -47,7 +75,8 @@ from flask_cors import CORS
 STANDALONE_MODE = os.environ.get('STANDALONE_MODE', 'true').lower() == 'true'
 
 if STANDALONE_MODE:
-    app = flask.Flask(__name__, static_folder='frontend', static_url_path='')
+    # frontend/ is served by serve_static_asset (fingerprinted, precompressed)
+    app = flask.Flask(__name__, static_folder=None)
 else:
     app = flask.Flask(__name__)
 
@@ -66,8 +95,226 @@ CORS(app,
          "http://localhost:3000"       # Local frontend development
      ],
      supports_credentials=True,        # Allow cookies/session across origins
-     allow_headers=["Content-Type", "X-API-Key"],  # Allow custom headers
-     expose_headers=["Content-Type"])
+     allow_headers=["Content-Type", "X-API-Key", "If-None-Match", "Last-Event-ID"],  # Allow custom headers
+     expose_headers=["Content-Type", "ETag", "X-Grades-Checked-At", "X-Grades-Age", "X-Grades-Stale",
+                     "X-Grades-Version"])
+
+# =============================================================================
+# JSON ENCODING
+# =============================================================================
+# Responses (flask.jsonify and the session cookie, through the app's JSON
+# provider), grade store values and payload hashes are encoded with orjson
+# when it is installed, else with the json module. orjson writes UTF-8 instead
+# of \u escapes; otherwise the output is the same, keys sorted like Flask's.
+# Set FAST_JSON=false to always use the json module.
+# =============================================================================
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FAST_JSON = os.environ.get('FAST_JSON', 'true').lower() == 'true' and orjson is not None
+
+
+def _orjson_dumps(value, sort_keys=False, default=None, newline=False):
+    # Dates go through default, like with the json module (Flask sends HTTP dates)
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if newline:
+        option |= orjson.OPT_APPEND_NEWLINE
+    return orjson.dumps(value, default=default, option=option)
+
+def dumps_json(value, sort_keys=False):
+    """Compact JSON text of value."""
+    if FAST_JSON:
+        return _orjson_dumps(value, sort_keys).decode('utf-8')
+    return json.dumps(value, sort_keys=sort_keys, separators=(',', ':'), ensure_ascii=False)
+
+def loads_json(raw):
+    """Value of JSON text or bytes."""
+    return orjson.loads(raw) if FAST_JSON else json.loads(raw)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, encoding with orjson when FAST_JSON is on."""
+
+    # What the session serializer passes; anything else goes to the json module
+    _FAST_DUMPS_ARGS = frozenset(['sort_keys', 'separators'])
+
+    def dumps(self, obj, **kwargs):
+        if not FAST_JSON or not self._FAST_DUMPS_ARGS.issuperset(kwargs):
+            return super().dumps(obj, **kwargs)
+        return _orjson_dumps(obj, kwargs.get('sort_keys', self.sort_keys), self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if not FAST_JSON or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Pretty-printed in debug mode, like Flask does
+        if not FAST_JSON or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = _orjson_dumps(obj, self.sort_keys, self.default, newline=True)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+app.json = FastJSONProvider(app)
+
+# =============================================================================
+# INSTRUMENTATION (Prometheus metrics)
+# =============================================================================
+# Request latency per route, upstream latency per ClasseViva endpoint, parse
+# and aggregation time, cache outcomes and upstream errors, exposed in the
+# Prometheus text format on /api/metrics.
+#
+# The endpoint is disabled unless METRICS_TOKEN is set; scrapers must send
+# "Authorization: Bearer <METRICS_TOKEN>". Metrics are kept per worker
+# process, so each scrape reports the worker that answered it (label "worker").
+# =============================================================================
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '').strip() or None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    """Monotonic counter with a fixed set of label names."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self, extra_labels):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, labels, extra_labels)} {value}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram with a fixed set of label names."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *labels):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the wall time spent in the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self, extra_labels):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = [(labels, list(series)) for labels, series in self._values.items()]
+        for labels, series in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                le = (('le', bound if bound == '+Inf' else repr(float(bound))),)
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, extra_labels + le)} {cumulative}"
+            label_text = _format_labels(self.labelnames, labels, extra_labels)
+            yield f"{self.name}_sum{label_text} {series[-1]}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds',
+                            'Time spent handling a request.', ('route', 'method', 'status'))
+UPSTREAM_SECONDS = Histogram('upstream_request_duration_seconds',
+                             'Time spent in a ClasseViva request, retries included.', ('endpoint',))
+UPSTREAM_ERRORS = Counter('upstream_errors_total',
+                          'ClasseViva requests that failed, by HTTP status or error kind.', ('endpoint', 'status'))
+PARSE_SECONDS = Histogram('grades_parse_duration_seconds',
+                          'Time spent parsing the grades HTML page.', ('parser',))
+AGGREGATION_SECONDS = Histogram('grades_aggregation_duration_seconds',
+                                'Time spent building a grade document (averages and views).')
+CACHE_REQUESTS = Counter('upstream_cache_requests_total',
+                         'Upstream cache lookups by outcome (hit, revalidated, unchanged, miss).', ('result',))
+
+UPSTREAM_LOGINS = Counter('upstream_logins_total',
+                          'Logins to ClasseViva by login type and reason (login, expiring, rejected, background).',
+                          ('login_type', 'reason'))
+
+METRICS = (REQUEST_SECONDS, UPSTREAM_SECONDS, UPSTREAM_ERRORS, PARSE_SECONDS, AGGREGATION_SECONDS, CACHE_REQUESTS,
+           UPSTREAM_LOGINS)
+
+# Known ClasseViva paths, with ids replaced so they don't explode label cardinality
+_UPSTREAM_ENDPOINT_RE = re.compile(r'^/rest/v1/students/[^/]+/')
+
+def upstream_endpoint(url):
+    """Metrics label for a ClasseViva URL: REST path without ids, or the page name."""
+    path = urllib.parse.urlsplit(url).path
+    if path.startswith('/rest/'):
+        return _UPSTREAM_ENDPOINT_RE.sub('/rest/v1/students/{id}/', path)[1:]
+    return path.rsplit('/', 1)[-1] or path
+
+
+@app.before_request
+def start_request_timer():
+    flask.g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    started = flask.g.pop('request_started', None)
+    if started is not None:
+        rule = flask.request.url_rule
+        REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                rule.rule if rule is not None else 'unmatched',
+                                flask.request.method, str(response.status_code))
+    return response
+
+@app.route('/api/metrics')
+def api_metrics():
+    """Prometheus scrape endpoint (see METRICS_TOKEN)."""
+    if not METRICS_TOKEN:
+        flask.abort(404)
+    provided = flask.request.headers.get('Authorization', '')
+    if not secrets.compare_digest(provided.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        return flask.Response('unauthorized\n', status=401, mimetype='text/plain',
+                              headers={'WWW-Authenticate': 'Bearer'})
+    extra = (('worker', os.getpid()),)
+    lines = [line for metric in METRICS for line in metric.render(extra)]
+    return flask.Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 # -----------------------------------------------------------------------------
 # API Key Protection
@@ -83,7 +330,7 @@ CORS(app,
 API_KEY = os.environ.get('API_KEY', '').strip() or None  # Treat empty string as None
 
 # Routes that do NOT require API key authentication
-PUBLIC_ROUTES = frozenset(['/api/session', '/api/version'])
+PUBLIC_ROUTES = frozenset(['/api/session', '/api/version', '/api/metrics'])  # /api/metrics checks METRICS_TOKEN
 
 
 @app.before_request
@@ -157,10 +404,6 @@ MARK_TABLE = {
     "10-": 9.75, "10": 10
 }
 
-# Placeholder webidentity for email login when actual identity cannot be extracted
-# This is used when the session is valid but webidentity is not found in the page
-EMAIL_LOGIN_WEBIDENTITY = "_EMAIL_SESSION_"
-
 # User-Agent string for web requests (used for email login)
 DEFAULT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 
@@ -223,6 +466,437 @@ app.config.update(
     SESSION_COOKIE_SAMESITE='None' if _https_enabled else 'Lax'  # Cross-origin for HTTPS tunnel
 )
 
+# =============================================================================
+# SERVER-SIDE GRADE STORE
+# =============================================================================
+# The grades tree (every grade, note and teacher name) is far too big for the
+# signed session cookie: browsers silently drop cookies above ~4KB. The cookie
+# only carries an opaque store id ('sid'), the data lives in a server-side
+# key/value store selected with the GRADE_STORE environment variable:
+#
+#   sqlite  (default) - a local SQLite file, shared by all gunicorn workers
+#   memory            - in-process LRU, only for single-worker/dev setups
+#   redis             - any server speaking the Redis protocol (REDIS_URL)
+#
+# Values are JSON-encoded by the store, so every backend behaves the same way.
+# =============================================================================
+GRADE_STORE_BACKEND = os.environ.get('GRADE_STORE', 'sqlite').strip().lower()
+GRADE_STORE_PATH = os.environ.get('GRADE_STORE_PATH', 'grade_store.sqlite3')
+GRADE_STORE_MAX_ENTRIES = int(os.environ.get('GRADE_STORE_MAX_ENTRIES', '1024'))
+GRADE_STORE_TTL = int(os.environ.get('GRADE_STORE_TTL', str(7 * 24 * 3600)))  # one week
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+
+
+class MemoryStore:
+    """In-process LRU store. Each gunicorn worker gets its own copy."""
+
+    def __init__(self, max_entries=GRADE_STORE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            raw, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+        return loads_json(raw)
+
+    def set(self, key, value, ttl=None):
+        raw = dumps_json(value)
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (raw, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        """Set key only if it does not exist yet. Returns True if it was set."""
+        raw = dumps_json(value)
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                return False
+            self._data[key] = (raw, now + ttl if ttl else None)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        return True
+
+    def incr(self, key, ttl=None):
+        """Atomically increment an integer counter, creating it with ttl."""
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= now):
+                entry = ('0', now + ttl if ttl else None)
+            value = int(entry[0]) + 1
+            self._data[key] = (str(value), entry[1])
+            self._data.move_to_end(key)
+        return value
+
+    def keys(self, prefix):
+        """All live keys starting with prefix."""
+        now = time.time()
+        with self._lock:
+            return [k for k, (_, expires_at) in self._data.items()
+                    if k.startswith(prefix) and (expires_at is None or expires_at > now)]
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+def cooperative_workers():
+    """True under gevent workers, where a waiting request only holds a greenlet."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+class SqliteConnection:
+    """
+    One sqlite3 connection per process, shared by its threads behind a lock.
+    Under gevent every request is a greenlet with its own thread-locals, so a
+    per-thread connection would be one per request; and a busy database waits
+    in C, which would stall the whole worker, so there the statements run on
+    gevent's threadpool while the request greenlet waits for them.
+    """
+
+    _setup_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self._pid = None
+        self._conn = None
+        self._lock = None
+        self._threadpool = None
+
+    def _open(self):
+        # Forked workers (preload_app) must not reuse the master's connection,
+        # and their lock must be created after gevent has patched threading
+        with self._setup_lock:
+            if self._pid == os.getpid():
+                return
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn = conn
+            self._lock = threading.Lock()
+            self._threadpool = None
+            if cooperative_workers():
+                from gevent import get_hub
+                self._threadpool = get_hub().threadpool
+            self._pid = os.getpid()
+
+    def run(self, func, *args):
+        """Call func(conn, *args) holding the connection and return its result."""
+        if self._pid != os.getpid():
+            self._open()
+        with self._lock:
+            if self._threadpool is not None:
+                return self._threadpool.apply(func, (self._conn,) + args)
+            return func(self._conn, *args)
+
+
+class SqliteStore:
+    """SQLite-backed store. WAL mode lets every worker read while one writes."""
+
+    def __init__(self, path=GRADE_STORE_PATH):
+        self.path = path
+        self._db = SqliteConnection(path)
+        self._db.run(self._create)
+
+    @staticmethod
+    def _create(conn):
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL)"
+            )
+
+    def get(self, key):
+        def query(conn):
+            row = conn.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] is not None and row[1] <= time.time():
+                with conn:
+                    conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+                return None
+            return row
+        row = self._db.run(query)
+        return None if row is None else loads_json(row[0])
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        raw = dumps_json(value)
+        def query(conn):
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, raw, expires_at)
+                )
+                # Opportunistic cleanup keeps the file from growing with dead sessions
+                conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+        self._db.run(query)
+
+    def add(self, key, value, ttl=None):
+        """Set key only if it does not exist yet. Returns True if it was set."""
+        now = time.time()
+        raw = dumps_json(value)
+        def query(conn):
+            with conn:
+                conn.execute("DELETE FROM kv WHERE key = ? AND expires_at IS NOT NULL AND expires_at <= ?", (key, now))
+                return conn.execute(
+                    "INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, raw, now + ttl if ttl else None)
+                ).rowcount
+        return self._db.run(query) == 1
+
+    def incr(self, key, ttl=None):
+        """Atomically increment an integer counter, creating it with ttl."""
+        now = time.time()
+        def query(conn):
+            with conn:
+                conn.execute("DELETE FROM kv WHERE key = ? AND expires_at IS NOT NULL AND expires_at <= ?", (key, now))
+                return conn.execute(
+                    "INSERT INTO kv (key, value, expires_at) VALUES (?, '1', ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1 "
+                    "RETURNING value",
+                    (key, now + ttl if ttl else None)
+                ).fetchone()
+        return int(self._db.run(query)[0])
+
+    def keys(self, prefix):
+        """All live keys starting with prefix."""
+        def query(conn):
+            return conn.execute(
+                "SELECT key FROM kv WHERE key >= ? AND key < ? AND (expires_at IS NULL OR expires_at > ?)",
+                (prefix, prefix + '\uffff', time.time())
+            ).fetchall()
+        return [row[0] for row in self._db.run(query)]
+
+    def delete(self, key):
+        def query(conn):
+            with conn:
+                conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+        self._db.run(query)
+
+
+class RedisStore:
+    """
+    Minimal Redis-protocol (RESP) client, so no extra dependency is needed.
+    Works with Redis, Valkey, KeyDB or any local stand-in speaking RESP.
+    """
+
+    def __init__(self, url=REDIS_URL):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=5)
+        self._reader = self._sock.makefile('rb')
+        if self.password:
+            self._call('AUTH', self.password)
+        if self.db:
+            self._call('SELECT', self.db)
+
+    def _close(self):
+        try:
+            if self._sock is not None:
+                self._sock.close()
+        finally:
+            self._sock = None
+            self._reader = None
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode()
+        if prefix == b'-':
+            raise RuntimeError(f"Redis error: {payload.decode()}")
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if prefix == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    def _call(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def execute(self, *args):
+        with self._lock:
+            # One reconnect attempt covers server restarts and idle timeouts
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._call(*args)
+                except (OSError, ConnectionError):
+                    self._close()
+                    if attempt:
+                        raise
+
+    def get(self, key):
+        raw = self.execute('GET', key)
+        return loads_json(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.execute('SET', key, dumps_json(value), 'PX', max(1, int(ttl * 1000)))
+        else:
+            self.execute('SET', key, dumps_json(value))
+
+    def add(self, key, value, ttl=None):
+        """Set key only if it does not exist yet. Returns True if it was set."""
+        if ttl:
+            reply = self.execute('SET', key, dumps_json(value), 'NX', 'PX', max(1, int(ttl * 1000)))
+        else:
+            reply = self.execute('SET', key, dumps_json(value), 'NX')
+        return reply == 'OK'
+
+    def incr(self, key, ttl=None):
+        """Atomically increment an integer counter, creating it with ttl."""
+        value = self.execute('INCR', key)
+        if value == 1 and ttl:
+            self.execute('PEXPIRE', key, max(1, int(ttl * 1000)))
+        return value
+
+    def keys(self, prefix):
+        """All live keys starting with prefix."""
+        pattern = re.sub(r'([*?\[\]\\])', r'\\\1', prefix) + '*'
+        cursor, found = '0', []
+        while True:
+            cursor, batch = self.execute('SCAN', cursor, 'MATCH', pattern, 'COUNT', 200)
+            found.extend(k.decode() for k in batch)
+            cursor = cursor.decode() if isinstance(cursor, bytes) else cursor
+            if cursor == '0':
+                return found
+
+    def delete(self, key):
+        self.execute('DEL', key)
+
+
+def create_grade_store(backend=GRADE_STORE_BACKEND):
+    """Build the configured store backend."""
+    if backend == 'memory':
+        return MemoryStore()
+    if backend == 'redis':
+        return RedisStore()
+    if backend != 'sqlite':
+        logger.warning(f"Unknown GRADE_STORE '{backend}', falling back to sqlite")
+    return SqliteStore()
+
+grade_store = create_grade_store()
+logger.info(f"Grade store backend: {type(grade_store).__name__}")
+
+
+def grades_key(sid):
+    """Store key of the grade document of a session."""
+    return f"grades:{sid}"
+
+def _grade_store_key():
+    """Store key for the grades of the current session, or None if there is no sid."""
+    sid = flask.session.get('sid')
+    return grades_key(sid) if sid else None
+
+def load_grade_document():
+    """
+    Return the stored grade document of the current session, or None.
+    The document holds the grade 'table' plus metadata such as 'source_hash'.
+    """
+    key = _grade_store_key()
+    if key is None:
+        return None
+    document = grade_store.get(key)
+    if document is not None and 'grades_avr' in document:
+        # Saved before grades were stored as a table
+        document['table'] = GradeTable.from_grades_avr(document.pop('grades_avr')).to_dict()
+    return document
+
+def document_table(document):
+    """GradeTable of a grade document."""
+    return GradeTable.from_dict(document['table'])
+
+def save_grade_document(document):
+    """Persist the grade document of the current session, creating a sid if needed."""
+    if 'sid' not in flask.session:
+        flask.session['sid'] = secrets.token_urlsafe(32)
+    grade_store.set(_grade_store_key(), document, ttl=GRADE_STORE_TTL)
+    publish_grade_document(flask.session['sid'], document)
+
+def current_view_name():
+    """Name of the view matching the session's blue-grade preference."""
+    return VIEW_WITHOUT_BLUE if should_exclude_blue_grades() else VIEW_WITH_BLUE
+
+def current_view(document):
+    """Precomputed aggregates matching the session's blue-grade preference."""
+    return document['views'][current_view_name()]
+
+def load_grades_view():
+    """
+    Return (table, view) for the current session, or (None, None).
+    The view follows the session's blue-grade preference.
+    """
+    document = load_grade_document()
+    if document is None:
+        return None, None
+    return document_table(document), current_view(document)
+
+def _drop_session_data():
+    """Delete everything stored server-side for the current session."""
+    sid = flask.session.get('sid')
+    if sid:
+        grade_store.delete(grades_key(sid))
+        grade_store.delete(active_key(sid))
+        grade_store.delete(auth_key(sid))
+        grade_store.delete(auth_secret_key(sid))
+        grade_store.delete(auth_pad_key(sid))
+        grade_store.delete(stream_key(sid))
+
+def new_store_session():
+    """Give the current session a fresh sid, dropping data stored under the old one."""
+    _drop_session_data()
+    flask.session['sid'] = secrets.token_urlsafe(32)
+
+def clear_session():
+    """Drop the server-side data of the current session and clear the cookie."""
+    _drop_session_data()
+    flask.session.clear()
+
 # =============================================================================
 # STANDALONE MODE: Serve static frontend files
 # =============================================================================
@@ -230,51 +904,244 @@ app.config.update(
 # This enables "all-in-one" Docker deployment without a separate frontend server.
 # =============================================================================
 
+# -----------------------------------------------------------------------------
+# Fingerprinted static assets
+# -----------------------------------------------------------------------------
+# At startup every file under frontend/ is read once, hashed and, for text
+# types, precompressed with gzip and brotli (if the brotli package is
+# installed). Pages are rewritten to load their CSS, JS and icons from
+# fingerprinted URLs (js/api.3f9c2a1b7e04.js), which are served with
+# "Cache-Control: immutable" for a year. Pages, sw.js and unversioned URLs are
+# served with "no-cache" and a strong ETag, so a reload costs a 304.
+#
+# sw.js gets the precache manifest built from the same hashes, so its cache
+# name changes exactly when an asset does.
+# -----------------------------------------------------------------------------
+STATIC_ROOT = os.path.join(app.root_path, 'frontend')
+STATIC_HASH_LENGTH = 12
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+STATIC_COMPRESSIBLE = frozenset(['.html', '.css', '.js', '.json', '.svg'])
+# Never fingerprinted nor precached: on Vercel api/ holds functions,
+# static/sw.js only unregisters old service workers, and installed PWAs keep
+# track of their manifest by URL
+STATIC_UNVERSIONED_PREFIXES = ('api/', 'static/', 'manifest.json')
+SERVICE_WORKER = 'sw.js'
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+_ASSET_REF_RE = re.compile(r'\b(src|href)="([^"#?:]+)"')
+_FINGERPRINT_RE = re.compile(r'^(.+)\.([0-9a-f]{%d})(\.[^./]+)$' % STATIC_HASH_LENGTH)
+
+
+class StaticAsset:
+    """One file of the frontend: its hash, mimetype and precompressed bodies."""
+    
+    __slots__ = ('path', 'digest', 'mimetype', 'bodies')
+    
+    def __init__(self, path, content):
+        self.path = path
+        self.digest = hashlib.sha256(content).hexdigest()[:STATIC_HASH_LENGTH]
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.bodies = {'identity': content}
+        if os.path.splitext(path)[1] in STATIC_COMPRESSIBLE:
+            compressed = {'gzip': gzip.compress(content, 9, mtime=0)}
+            if BROTLI_AVAILABLE:
+                compressed['br'] = brotli.compress(content, quality=11)
+            for encoding, body in compressed.items():
+                if len(body) < len(content):
+                    self.bodies[encoding] = body
+    
+    @property
+    def url(self):
+        """Fingerprinted URL, e.g. /js/api.3f9c2a1b7e04.js"""
+        base, ext = os.path.splitext(self.path)
+        return f'/{base}.{self.digest}{ext}'
+    
+    @property
+    def versioned(self):
+        return (not self.path.endswith('.html') and self.path != SERVICE_WORKER
+                and not self.path.startswith(STATIC_UNVERSIONED_PREFIXES))
+
+
+def page_url(path):
+    return '/' if path == 'index.html' else f'/{path}'
+
+def build_static_assets(root):
+    """Hash, fingerprint and precompress the frontend; return {path: StaticAsset}."""
+    contents = {}
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            full_path = os.path.join(directory, filename)
+            path = os.path.relpath(full_path, root).replace(os.sep, '/')
+            with open(full_path, 'rb') as f:
+                contents[path] = f.read()
+    
+    assets = {path: StaticAsset(path, content) for path, content in contents.items()
+              if not path.endswith('.html') and path != SERVICE_WORKER}
+    
+    def fingerprint(match):
+        asset = assets.get(match.group(2).lstrip('/'))
+        if asset is None or not asset.versioned:
+            return match.group(0)
+        return f'{match.group(1)}="{asset.url}"'
+    
+    pages = [path for path in contents if path.endswith('.html')]
+    for path in pages:
+        html = _ASSET_REF_RE.sub(fingerprint, contents[path].decode('utf-8'))
+        assets[path] = StaticAsset(path, html.encode('utf-8'))
+    
+    if SERVICE_WORKER in contents:
+        urls = sorted(page_url(path) for path in pages)
+        urls += sorted(asset.url for asset in assets.values() if asset.versioned)
+        version = hashlib.sha256(' '.join(
+            f'{path}:{assets[path].digest}' for path in sorted(assets)).encode()).hexdigest()
+        manifest = {'version': version[:STATIC_HASH_LENGTH], 'urls': urls}
+        script = f'self.__PRECACHE_MANIFEST = {json.dumps(manifest)};\n'.encode('utf-8')
+        assets[SERVICE_WORKER] = StaticAsset(SERVICE_WORKER, script + contents[SERVICE_WORKER])
+    return assets
+
+def find_static_asset(path):
+    """(asset, immutable) for a frontend path or fingerprinted URL, or (None, False)."""
+    asset = STATIC_ASSETS.get(path)
+    if asset is not None:
+        return asset, False
+    match = _FINGERPRINT_RE.match(path)
+    asset = STATIC_ASSETS.get(match.group(1) + match.group(3)) if match else None
+    if asset is None:
+        return None, False
+    # A stale fingerprint (page cached before a deploy) gets the current
+    # file, but must not be cached for good under the old URL
+    return asset, match.group(2) == asset.digest
+
+class StaticAssetConverter(BaseConverter):
+    """
+    URL converter matching only the files of the built frontend, with any
+    fingerprint: other paths fall through to a 404 for every method instead
+    of a 405 from the GET-only frontend route.
+    """
+    part_isolating = False
+    
+    def __init__(self, map, *args, **kwargs):
+        super().__init__(map, *args, **kwargs)
+        names = []
+        for path in sorted(STATIC_ASSETS, key=len, reverse=True):
+            base, ext = os.path.splitext(path)
+            names.append(re.escape(path))
+            names.append(r'%s\.[0-9a-f]{%d}%s' % (re.escape(base), STATIC_HASH_LENGTH, re.escape(ext)))
+        self.regex = '(?:%s)' % '|'.join(names)
+
+def serve_static_asset(path):
+    """Serve a frontend file with the best accepted encoding and HTTP caching."""
+    asset, immutable = find_static_asset(path)
+    if asset is None:
+        flask.abort(404)
+    
+    accepted = flask.request.accept_encodings
+    encoding = next((e for e in ('br', 'gzip') if e in asset.bodies and accepted.quality(e) > 0),
+                    'identity')
+    response = flask.Response(asset.bodies[encoding], mimetype=asset.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(asset.digest if encoding == 'identity' else f'{asset.digest}-{encoding}')
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.max_age = STATIC_IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(flask.request)
+
+
 if STANDALONE_MODE:
     logger.info("Running in STANDALONE mode - serving frontend files from /frontend")
     
+    started = time.perf_counter()
+    STATIC_ASSETS = build_static_assets(STATIC_ROOT)
+    logger.info(f"Fingerprinted {len(STATIC_ASSETS)} frontend files in "
+                f"{(time.perf_counter() - started) * 1000:.0f}ms (brotli: {BROTLI_AVAILABLE})")
+    
     @app.route('/')
     def serve_index():
         """Serve the main login page"""
-        return flask.send_from_directory('frontend', 'index.html')
-    
-    @app.route('/grades.html')
-    def serve_grades():
-        """Serve the grades page"""
-        return flask.send_from_directory('frontend', 'grades.html')
-    
-    @app.route('/export.html')
-    def serve_export():
-        """Serve the export page"""
-        return flask.send_from_directory('frontend', 'export.html')
-    
-    @app.route('/settings.html')
-    def serve_settings():
-        """Serve the settings page"""
-        return flask.send_from_directory('frontend', 'settings.html')
-    
-    @app.route('/subject_detail.html')
-    def serve_subject_detail():
-        """Serve the subject detail page"""
-        return flask.send_from_directory('frontend', 'subject_detail.html')
-    
-    @app.route('/overall_average_detail.html')
-    def serve_overall_average_detail():
-        """Serve the overall average detail page"""
-        return flask.send_from_directory('frontend', 'overall_average_detail.html')
-    
-    @app.route('/manifest.json')
-    def serve_manifest():
-        """Serve PWA manifest"""
-        return flask.send_from_directory('frontend', 'manifest.json')
-    
-    @app.route('/sw.js')
-    def serve_sw():
-        """Serve service worker"""
-        return flask.send_from_directory('frontend', 'sw.js')
+        return serve_static_asset('index.html')
+    
+    app.url_map.converters['asset'] = StaticAssetConverter
+    
+    @app.route('/<asset:asset_path>')
+    def serve_frontend_file(asset_path):
+        """Serve pages, the PWA manifest, the service worker and fingerprinted assets"""
+        return serve_static_asset(asset_path)
 else:
     logger.info("Running in API-ONLY mode - frontend should be deployed separately (e.g., Vercel)")
 
+# =============================================================================
+# JSON RESPONSE CACHING AND COMPRESSION
+# =============================================================================
+# Grade responses carry an ETag derived from the stored grade data (content
+# hash of the upstream payload, blue-grade view and what is being returned),
+# so a client sending it back in If-None-Match gets a 304 without the grades
+# tree even being rebuilt. The tag is weak because the same JSON may be sent
+# gzip- or brotli-encoded.
+#
+# JSON responses of at least JSON_COMPRESS_MIN_SIZE bytes are compressed with
+# brotli (if installed) or gzip, whichever the client prefers.
+# -----------------------------------------------------------------------------
+JSON_COMPRESS_MIN_SIZE = int(os.environ.get('JSON_COMPRESS_MIN_SIZE', '1024'))
+JSON_BROTLI_QUALITY = 5  # on the fly: far faster than 11, nearly as small
+JSON_GZIP_LEVEL = 6
+
+
+def grades_etag(document, *parts):
+    """ETag of a response built from a grade document in the current view."""
+    source = document.get('source_hash') or _payload_hash(document['table'])
+    return view_etag(source, current_view_name(), *parts)
+
+def view_etag(source_hash, view_name, *parts):
+    """grades_etag from the document's source hash and a view name."""
+    key = '\0'.join((APP_VERSION, source_hash, view_name) + parts)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+def tag_grades_response(response, etag):
+    """Attach the ETag and make clients revalidate before reusing the body."""
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def grades_not_modified(etag):
+    """A 304 response if the client already holds this representation, else None."""
+    if not flask.request.if_none_match.contains_weak(etag):
+        return None
+    return tag_grades_response(flask.Response(status=304), etag)
+
+
+@app.after_request
+def compress_json_response(response):
+    if (response.status_code != 200 or response.mimetype != 'application/json'
+            or response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    accepted = flask.request.accept_encodings
+    # Highest q-value wins, brotli on ties
+    available = ('br', 'gzip') if BROTLI_AVAILABLE else ('gzip',)
+    encoding = max((e for e in available if accepted.quality(e) > 0), key=accepted.quality, default=None)
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < JSON_COMPRESS_MIN_SIZE:
+        return response
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=JSON_BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, JSON_GZIP_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
 # =============================================================================
 # API ENDPOINTS
 # =============================================================================
@@ -320,17 +1187,18 @@ def login_route():
                 return flask.jsonify({'success': False, 'error': 'Token non valido. Riprova.'}), 401
             
             # Store token, webidentity and login type in session
-            flask.session['token'] = token
+            new_store_session()
+            start_upstream_auth('email', user_id, user_pass, login_response)
             flask.session['user_id'] = user_id
             flask.session['webidentity'] = webidentity
             flask.session['login_type'] = 'email'
             
             # Get grades using email login method (HTML scraping)
-            grades_data = get_grades_email(token, webidentity)
-            grades_avr = calculate_avr(grades_data)
+            document = fetch_student_grades('email', token, user_id, webidentity)
             
-            # Store grades in session for other pages
-            flask.session['grades_avr'] = grades_avr
+            # Store grades server-side for other pages
+            save_grade_document(document)
+            track_active_session(checked=True)
             
             # Log session initialization (avoid logging sensitive data)
             logger.info(f"Login success - Session initialized with {len(flask.session)} keys")
@@ -344,15 +1212,16 @@ def login_route():
                 return flask.jsonify({'success': False, 'error': 'Token non valido. Riprova.'}), 401
             
             # Store token and user_id in session
-            flask.session['token'] = token
+            new_store_session()
+            start_upstream_auth('userid', user_id, user_pass, login_response)
             flask.session['user_id'] = user_id
             flask.session['login_type'] = 'userid'
             
-            student_id = "".join(filter(str.isdigit, user_id))
-            grades_avr = calculate_avr(get_grades(student_id, token))
+            document = fetch_student_grades('userid', token, user_id)
             
-            # Store grades in session for other pages
-            flask.session['grades_avr'] = grades_avr
+            # Store grades server-side for other pages
+            save_grade_document(document)
+            track_active_session(checked=True)
             
             # Log session initialization (avoid logging sensitive data)
             logger.info(f"Login success - Session initialized with {len(flask.session)} keys")
@@ -374,7 +1243,7 @@ def login_route():
 @app.route('/logout', methods=['POST'])
 def logout():
     """API endpoint for logout - returns JSON response."""
-    flask.session.clear()
+    clear_session()
     return flask.jsonify({'success': True}), 200
 
 @app.route('/refresh_grades', methods=['POST'])
@@ -384,47 +1253,73 @@ def refresh_grades():
         return flask.jsonify({'error': 'No active session'}), 401
     
     try:
-        token = flask.session['token']
-        login_type = flask.session.get('login_type', 'userid')
+        if 'user_id' not in flask.session:
+            return flask.jsonify({'error': 'User ID not found in session'}), 400
         
-        if login_type == 'email':
-            # html scraping
-            webidentity = flask.session.get('webidentity', '')
-            grades_data = get_grades_email(token, webidentity)
-            grades_avr = calculate_avr(grades_data)
-        else:
-            # rest api
-            if 'user_id' not in flask.session:
-                return flask.jsonify({'error': 'User ID not found in session'}), 400
-            
-            user_id = flask.session['user_id']
-            student_id = "".join(filter(str.isdigit, user_id))
-            
-            # fetch grades
-            grades_avr = calculate_avr(get_grades(student_id, token))
+        document = load_grade_document()
+        
+        # fetch grades (shared with concurrent refreshes of the same student, and
+        # skipped or revalidated when the upstream cache allows it); html scraping
+        # for email logins, rest api otherwise. An expired ClasseViva session is
+        # renewed and the fetch retried before giving up.
+        new_document = call_with_upstream_auth(lambda auth: refresh_student_grades(
+            auth['login_type'], auth['token'], auth['user_id'], auth.get('webidentity', ''), document))
         
-        # update session
-        flask.session['grades_avr'] = grades_avr
+        # update stored grades
+        if new_document is not None:
+            save_grade_document(new_document)
+        track_active_session(checked=True)
         
-        return flask.jsonify({'success': True, 'message': 'Voti aggiornati'}), 200
+        return flask.jsonify({'success': True, 'message': 'Voti aggiornati', 'changed': new_document is not None}), 200
     except requests.exceptions.HTTPError as e:
         error_code = getattr(e.response, 'status_code', None) if hasattr(e, 'response') else None
         if error_code == 401:
-            # token expired so redirect to login
-            flask.session.clear()
+            # token expired and could not be renewed so redirect to login
+            clear_session()
             return flask.jsonify({'error': 'Sessione scaduta', 'redirect': '/'}), 401
         return flask.jsonify({'error': 'Errore durante l\'aggiornamento'}), 500
     except Exception as e:
         logger.error(f"Error refreshing grades: {e}", exc_info=True)
         return flask.jsonify({'error': 'Errore durante l\'aggiornamento dei voti'}), 500
 
+def requested_grade_fields():
+    """
+    Subject keys selected with ?fields=count,avr,grades, or None for all of them.
+    Raises ValueError on unknown keys, or if none is given.
+    """
+    raw = flask.request.args.get('fields')
+    if raw is None:
+        return None
+    fields = {field.strip() for field in raw.split(',') if field.strip()}
+    if not fields:
+        raise ValueError("Indica almeno un campo: count, avr o grades")
+    unknown = fields.difference(GradeTable.SUBJECT_FIELDS)
+    if unknown:
+        raise ValueError(f"Campi non validi: {', '.join(sorted(unknown))}")
+    return fields
+
+def grades_tree_response(document):
+    """The grades tree (projected with ?fields=) as a conditional JSON response."""
+    try:
+        fields = requested_grade_fields()
+    except ValueError as e:
+        return flask.make_response(flask.jsonify({'error': str(e)}), 400)
+    
+    etag = grades_etag(document, 'grades', '*' if fields is None else ','.join(sorted(fields)))
+    response = grades_not_modified(etag)
+    if response is None:
+        grades_avr = document_table(document).to_grades_avr(current_view(document), fields)
+        response = tag_grades_response(flask.jsonify(grades_avr), etag)
+    return response
+
 @app.route('/grades')
 def grades_page():
     """API endpoint for grades - returns JSON data."""
     # debug logging (without sensitive data)
     cookie_present = bool(flask.request.headers.get('Cookie'))
     session_count = len(flask.session)
-    has_grades = 'grades_avr' in flask.session
+    document = load_grade_document()
+    has_grades = document is not None
     
     logger.info(f"Grades request - Session has {session_count} keys, has_grades={has_grades}, cookie_present={cookie_present}")
     
@@ -442,8 +1337,120 @@ def grades_page():
             }), 401
         return flask.jsonify({'error': 'No active session', 'authenticated': False}), 401
     
-    grades_avr = flask.session['grades_avr']
-    return flask.jsonify(grades_avr), 200
+    # Serve the stored copy right away; if it is stale the background
+    # refresher picks this session up on its next tick
+    response = grades_tree_response(document)
+    response.headers.update(staleness_headers(document))
+    if document.get('version') is not None:
+        response.headers['X-Grades-Version'] = str(document['version'])
+    return response
+
+def grade_changes_payload(document, changes):
+    """Changed grades of a document (see grade_changes_since), or None if it lacks some."""
+    table = document_table(document)
+    by_event = table.rows_by_event()
+    payload = {'added': [], 'modified': [], 'removed': []}
+    for event, kind in changes.items():
+        if kind == 'removed':
+            payload['removed'].append(event)
+            continue
+        row = by_event.get(event)
+        if row is None:
+            return None
+        period, subject = table.location(row)
+        payload[kind].append({'period': period, 'subject': subject, **table.grade(row)})
+    payload['averages'] = table.to_grades_avr(current_view(document), ('count', 'avr'))
+    return payload
+
+@app.route('/grades/changes')
+def grade_changes_page():
+    """
+    Grades added, modified or removed since ?since=<version> (X-Grades-Version
+    of /grades), with the count and average of every subject, so that a client
+    holding that version of the grades tree can patch it instead of downloading
+    it again. 'reset': true means it has to download /grades instead.
+    """
+    document = load_grade_document()
+    if document is None:
+        return flask.jsonify({'error': 'No active session', 'authenticated': False}), 401
+    try:
+        since = int(flask.request.args.get('since', ''))
+    except ValueError:
+        return flask.jsonify({'error': 'Parametro since non valido'}), 400
+    
+    version = document.get('version')
+    changes = None
+    if version is not None:
+        log = grade_store.get(grade_log_key(flask.session.get('login_type', 'userid'), flask.session.get('user_id', '')))
+        if log is not None:
+            if document_log_version(document, log) is not None:
+                changes = grade_changes_since(log, since, version)
+        elif since == version:
+            changes = {}
+    
+    payload = grade_changes_payload(document, changes) if changes is not None else None
+    if payload is None:
+        payload = {'reset': True}
+    payload.update(version=version, etag=f'W/"{grades_etag(document, "grades", "*")}"')
+    response = flask.jsonify(payload)
+    response.headers.update(staleness_headers(document))
+    return response
+
+@app.route('/grades/stream')
+def grade_stream_page():
+    """
+    Server-sent events: 'grades' with the version and ETag of the new grades
+    tree whenever it changes, instead of polling /refresh_grades. Resumes from
+    the Last-Event-ID header (the ETag the client holds, without W/"...").
+    See LIVE GRADE UPDATES.
+    """
+    document = load_grade_document()
+    if document is None:
+        return flask.jsonify({'error': 'No active session', 'authenticated': False}), 401
+    
+    state = {
+        'source_hash': document.get('source_hash') or _payload_hash(document['table']),
+        'version': document.get('version')
+    }
+    last_id = flask.request.headers.get('Last-Event-ID', '').strip() or None
+    events = grade_stream_events(flask.session['sid'], state, current_view_name(), last_id, cooperative_workers())
+    response = flask.Response(events, mimetype='text/event-stream')
+    # Every (re)connection keeps the session in the background refresher
+    response.headers.update(staleness_headers(document))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # proxies must not hold events back
+    return response
+
+@app.route('/grades/history')
+def grade_history_page():
+    """
+    How an average evolved, for trend charts. ?period= and ?subject= select
+    it (neither: the overall average; period: that period's; both: the
+    subject's in that period), ?resolution=day|week|sync and ?from= / ?to=
+    (YYYY-MM-DD) the points. Answered from the GRADE HISTORY rollups.
+    """
+    if grade_history is None:
+        return flask.jsonify({'error': 'Storico non disponibile'}), 404
+    if 'token' not in flask.session or 'user_id' not in flask.session:
+        return flask.jsonify({'error': 'No active session', 'authenticated': False}), 401
+    
+    args = flask.request.args
+    period = args.get('period', '')
+    subject = args.get('subject', '')
+    resolution = args.get('resolution', 'day')
+    if subject and not period:
+        return flask.jsonify({'error': 'Indica il periodo della materia'}), 400
+    if resolution not in HISTORY_RESOLUTIONS:
+        return flask.jsonify({'error': 'Parametro resolution non valido'}), 400
+    try:
+        start = datetime.strptime(args['from'], '%Y-%m-%d').date() if args.get('from') else None
+        end = datetime.strptime(args['to'], '%Y-%m-%d').date() if args.get('to') else None
+    except ValueError:
+        return flask.jsonify({'error': 'Data non valida (AAAA-MM-GG)'}), 400
+    
+    student = history_student(flask.session.get('login_type', 'userid'), flask.session['user_id'])
+    points = grade_history.points(student, current_view_name(), period, subject, resolution, start, end)
+    return flask.jsonify({'period': period, 'subject': subject, 'resolution': resolution, 'points': points})
 
 @app.route('/export')
 def export_page():
@@ -461,30 +1468,32 @@ def settings_page():
 @app.route('/overall_average_detail')
 def overall_average_detail_page():
     """API endpoint for overall average detail - returns JSON data."""
-    if 'grades_avr' not in flask.session:
+    document = load_grade_document()
+    if document is None:
         return flask.jsonify({'error': 'No active session', 'authenticated': False}), 401
     
-    grades_avr = flask.session['grades_avr']
-    return flask.jsonify(grades_avr), 200
+    return grades_tree_response(document)
 
 @app.route('/subject_detail/<subject_name>')
 def subject_detail_page(subject_name):
     """API endpoint for subject detail - returns JSON data."""
-    if 'grades_avr' not in flask.session:
+    document = load_grade_document()
+    if document is None:
         return flask.jsonify({'error': 'No active session', 'authenticated': False}), 401
     
-    grades_avr = flask.session['grades_avr']
-    
-    subject_found = False
-    for period in grades_avr:
-        if period != 'all_avr' and subject_name in grades_avr[period]:
-            subject_found = True
-            break
+    # A matching ETag means the client got this subject before, so it exists
+    etag = grades_etag(document, 'subject_detail', subject_name)
+    response = grades_not_modified(etag)
+    if response is not None:
+        return response
     
-    if not subject_found:
+    table = document_table(document)
+    if not table.has_subject(subject_name):
         return flask.jsonify({'error': 'Subject not found'}), 404
     
-    return flask.jsonify({'grades_avr': grades_avr, 'subject_name': subject_name}), 200
+    # Only this subject's periods: the page renders a single subject
+    grades_avr = table.to_subject_slice(subject_name, current_view(document))
+    return tag_grades_response(flask.jsonify({'grades_avr': grades_avr, 'subject_name': subject_name}), etag)
 
 @app.route('/set_blue_grade_preference', methods=['POST'])
 def set_blue_grade_preference():
@@ -493,15 +1502,12 @@ def set_blue_grade_preference():
         data = flask.request.get_json()
         include_blue_grades = data.get('include_blue_grades', True)
         
-        # store preference
+        # store preference - averages for both settings are precomputed,
+        # so the next request simply picks the other view
         flask.session['include_blue_grades'] = include_blue_grades
-        
-        # if we have grades, recalculate
-        if 'grades_avr' in flask.session:
-            grades_avr = flask.session['grades_avr']
-            recalculate_averages(grades_avr, not include_blue_grades)
-            flask.session['grades_avr'] = grades_avr
-            flask.session.modified = True
+        if flask.session.get('sid'):
+            # Other tabs show the averages of the other view now
+            grade_stream_hub.publish(flask.session['sid'], view=current_view_name())
         
         return flask.jsonify({'success': True, 'include_blue_grades': include_blue_grades}), 200
         
@@ -511,49 +1517,14 @@ def set_blue_grade_preference():
 
 def recalculate_averages(grades_avr, exclude_blue=False):
     """Recalculate subject, period, and overall averages based on blue grade preference"""
-    # recalculate subject averages
-    for period in grades_avr:
-        if period == 'all_avr':
-            continue
-        for subject in grades_avr[period]:
-            if subject == 'period_avr':
-                continue
-            filtered_grades = [g for g in grades_avr[period][subject]['grades'] 
-                           if not (exclude_blue and g.get('isBlue', False))]
-            effective = _get_effective_grades(filtered_grades)
-            grades_avr[period][subject]["avr"] = sum(effective) / len(effective) if effective else 0
-    
-    # recalculate period averages
-    for period in grades_avr:
-        if period == 'all_avr':
-            continue
-        period_grades = []
-        for subject in grades_avr[period]:
-            if subject == 'period_avr':
-                continue
-            filtered_grades = [g for g in grades_avr[period][subject]['grades']
-                                if not (exclude_blue and g.get('isBlue', False))]
-            period_grades.extend(_get_effective_grades(filtered_grades))
-        grades_avr[period]["period_avr"] = sum(period_grades) / len(period_grades) if period_grades else 0
-    
-    # recalculate overall average
-    all_grades = []
-    for period in grades_avr:
-        if period == 'all_avr':
-            continue
-        for subject in grades_avr[period]:
-            if subject == 'period_avr':
-                continue
-            filtered_grades = [g for g in grades_avr[period][subject]['grades']
-                             if not (exclude_blue and g.get('isBlue', False))]
-            all_grades.extend(_get_effective_grades(filtered_grades))
-    grades_avr["all_avr"] = sum(all_grades) / len(all_grades) if all_grades else 0
+    GradeAggregator.from_grades_avr(grades_avr, exclude_blue).apply_to(grades_avr)
 
 @app.route('/calculate_goal', methods=['POST'])
 def calculate_goal():
     """Calculate what grade is needed to reach a target average in a specific period.
     If subject is not provided, returns intelligent suggestions for all subjects in the period."""
-    if 'grades_avr' not in flask.session:
+    table, view = load_grades_view()
+    if table is None:
         return flask.jsonify({'error': 'No active session'}), 401
     
     try:
@@ -563,9 +1534,7 @@ def calculate_goal():
         target_average = float(data.get('target_average'))
         num_grades = int(data.get('num_grades', 1))
         
-        grades_avr = flask.session['grades_avr']
-        
-        if not period or period not in grades_avr:
+        if not period or not table.has(period):
             return flask.jsonify({'error': 'Periodo non trovato'}), 400
         
         if target_average < 1 or target_average > 10:
@@ -576,7 +1545,8 @@ def calculate_goal():
         
         # return intelligent suggestions if no subject
         if not subject:
-            suggestions = calculate_period_subject_suggestions(grades_avr, period, target_average, num_grades)
+            suggestions = calculate_period_subject_suggestions(view, period, target_average, num_grades,
+                                                                requested_suggestion_limit(data))
             
             return flask.jsonify({
                 'success': True,
@@ -587,26 +1557,18 @@ def calculate_goal():
                 'message': get_period_suggestion_message(suggestions, target_average, num_grades, period)
             }), 200
         
-        if subject not in grades_avr[period]:
+        if not table.has(period, subject):
             return flask.jsonify({'error': 'Materia non trovata nel periodo selezionato'}), 400
         
-        # get current grades
-        subject_data = grades_avr[period][subject]
-        if 'grades' not in subject_data or not isinstance(subject_data['grades'], list):
-            return flask.jsonify({'error': 'Dati dei voti non validi'}), 400
+        # precomputed effective grades (component grades averaged per event)
+        bucket = view_subject(view, period, subject)
         
-        # extract effective grades (component grades averaged per event)
-        current_grades = _get_effective_grades(
-            [g for g in subject_data['grades'] 
-             if isinstance(g, dict) and 'decimalValue' in g and g['decimalValue'] is not None]
-        )
-        
-        if not current_grades:
+        if not bucket or not bucket['count']:
             return flask.jsonify({'error': 'Nessun voto disponibile per questa materia'}), 400
         
-        current_count = len(current_grades)
-        current_sum = sum(current_grades)
-        current_average = subject_data.get('avr', current_sum / current_count if current_count > 0 else 0)
+        current_count = bucket['count']
+        current_sum = bucket['sum']
+        current_average = current_sum / current_count
         
         # check if current grade already meets or exceed target
         if current_average >= target_average:
@@ -692,7 +1654,8 @@ def get_goal_message_multiple(raw_grade, display_grade, target_average, current_
 @app.route('/predict_average', methods=['POST'])
 def predict_average():
     """Predict how hypothetical grades will affect the average"""
-    if 'grades_avr' not in flask.session:
+    table, view = load_grades_view()
+    if table is None:
         return flask.jsonify({'error': 'No active session'}), 401
     
     try:
@@ -701,9 +1664,7 @@ def predict_average():
         subject = data.get('subject')
         predicted_grades = data.get('predicted_grades', [])
         
-        grades_avr = flask.session['grades_avr']
-        
-        if period not in grades_avr or subject not in grades_avr[period]:
+        if not table.has(period, subject):
             return flask.jsonify({'error': 'Materia o periodo non trovato'}), 400
         
         if not predicted_grades or not isinstance(predicted_grades, list):
@@ -713,22 +1674,14 @@ def predict_average():
             if not isinstance(grade, (int, float)) or grade < 1 or grade > 10:
                 return flask.jsonify({'error': 'Tutti i voti devono essere tra 1 e 10'}), 400
         
-        subject_data = grades_avr[period][subject]
-        if 'grades' not in subject_data or not isinstance(subject_data['grades'], list):
-            return flask.jsonify({'error': 'Dati dei voti non validi'}), 400
-        
-        current_grades = _get_effective_grades(
-            [g for g in subject_data['grades']
-             if isinstance(g, dict) and 'decimalValue' in g and g['decimalValue'] is not None]
-        )
+        bucket = view_subject(view, period, subject)
         
-        if not current_grades:
+        if not bucket or not bucket['count']:
             return flask.jsonify({'error': 'Nessun voto disponibile per questa materia'}), 400
         
-        current_average = subject_data.get('avr', sum(current_grades) / len(current_grades))
+        current_average = bucket['sum'] / bucket['count']
         
-        all_grades = current_grades + predicted_grades
-        predicted_average = sum(all_grades) / len(all_grades)
+        predicted_average = (bucket['sum'] + sum(predicted_grades)) / (bucket['count'] + len(predicted_grades))
         
         change = predicted_average - current_average
         
@@ -769,39 +1722,12 @@ def should_exclude_blue_grades():
     include_blue = flask.session.get('include_blue_grades', True)
     return not include_blue
 
-def get_all_grades(grades_avr, exclude_blue=None):
-    """
-    Collect all effective grades from all subjects in all periods.
-    Component grades of the same evaluation are averaged into a single grade.
-    
-    Args:
-        grades_avr: Dictionary containing grades organized by period and subject
-        exclude_blue: If True, excludes blue grades. If None, uses session preference.
-    
-    Returns:
-        List of decimal grade values (effective grades)
-    """
-    # Use session preference if exclude_blue not explicitly provided
-    if exclude_blue is None:
-        exclude_blue = should_exclude_blue_grades()
-    
-    all_grades_list = []
-    for period in grades_avr:
-        if period == 'all_avr':
-            continue
-        for subject in grades_avr[period]:
-            if subject == 'period_avr':
-                continue
-            filtered_grades = [g for g in grades_avr[period][subject].get('grades', [])
-                             if not (exclude_blue and g.get('isBlue', False))]
-            all_grades_list.extend(_get_effective_grades(filtered_grades))
-    return all_grades_list
-
 @app.route('/calculate_goal_overall', methods=['POST'])
 def calculate_goal_overall():
     """Calculate what grades are needed to reach a target overall average.
     If subject is provided, calculates for that subject. Otherwise, suggests best subjects to focus on."""
-    if 'grades_avr' not in flask.session:
+    table, view = load_grades_view()
+    if table is None:
         return flask.jsonify({'error': 'No active session'}), 401
     
     try:
@@ -810,12 +1736,10 @@ def calculate_goal_overall():
         target_overall_average = float(data.get('target_average'))
         num_grades_input = data.get('num_grades')  # optional - will auto-calculate if not provided
         
-        grades_avr = flask.session['grades_avr']
-        
         if target_overall_average < 1 or target_overall_average > 10:
             return flask.jsonify({'error': 'La media target deve essere tra 1 e 10'}), 400
         
-        current_overall_average = grades_avr.get('all_avr', 0)
+        current_overall_average = _view_avr(view)
         
         if current_overall_average >= target_overall_average:
             return flask.jsonify({
@@ -829,13 +1753,11 @@ def calculate_goal_overall():
                 'message': f"🎉 Obiettivo già raggiunto! La tua media generale attuale ({round(current_overall_average, 2)}) è già pari o superiore all'obiettivo di {target_overall_average}."
             }), 200
         
-        all_grades_list = get_all_grades(grades_avr)
-        
-        if not all_grades_list:
+        if not view['count']:
             return flask.jsonify({'error': 'Nessun voto disponibile'}), 400
         
-        current_total = sum(all_grades_list)
-        current_count = len(all_grades_list)
+        current_total = view['sum']
+        current_count = view['count']
         
         if num_grades_input is None:
             num_grades, _ = calculate_optimal_grades_needed(current_total, current_count, target_overall_average)
@@ -852,7 +1774,8 @@ def calculate_goal_overall():
         
         # If no subject specified, suggest the best subjects to focus on
         if not subject:
-            suggestions = calculate_subject_suggestions(grades_avr, target_overall_average, num_grades, required_average_grade)
+            suggestions = calculate_subject_suggestions(view, target_overall_average, num_grades, required_average_grade,
+                                                        requested_suggestion_limit(data))
             
             return flask.jsonify({
                 'success': True,
@@ -866,15 +1789,7 @@ def calculate_goal_overall():
         
         # If subject is specified, calculate for that specific subject
         # Find the subject in any period
-        subject_found = False
-        for period in grades_avr:
-            if period == 'all_avr':
-                continue
-            if subject in grades_avr[period] and grades_avr[period][subject] != 'period_avr':
-                subject_found = True
-                break
-        
-        if not subject_found:
+        if not table.has_subject(subject):
             return flask.jsonify({'error': 'Materia non trovata'}), 400
         
         # Round to nearest allowed grade
@@ -901,45 +1816,138 @@ def calculate_goal_overall():
         logger.error(f"Error calculating overall goal: {e}", exc_info=True)
         return flask.jsonify({'error': 'Errore durante il calcolo'}), 500
 
-def calculate_optimal_grades_needed(current_total, current_count, target_average):
-    """Calculate the optimal/minimum number of grades needed to reach target average.
-    
-    Uses a heuristic: assume we can get perfect 10s, calculate minimum grades needed.
-    Then provide a realistic plan with achievable grades.
-    """
-    # If already at or above target, no grades needed
-    if current_count > 0 and (current_total / current_count) >= target_average:
-        return 0, []
-    
-    # Calculate minimum grades needed assuming perfect 10s
-    # Formula: (current_total + 10*n) / (current_count + n) = target_average
-    # Solving for n: n = (current_total - target_average * current_count) / (target_average - 10)
-    
-    min_grades_needed = 1
-    if target_average < 10:
-        numerator = target_average * current_count - current_total
-        denominator = 10 - target_average
-        if denominator > 0:
-            min_grades_needed = max(1, int(numerator / denominator) + 1)
+@app.route('/plan_goal', methods=['POST'])
+def plan_goal_route():
+    """Least-effort grade plans (Pareto frontier) to reach a target overall or period average."""
+    table, view = load_grades_view()
+    if table is None:
+        return flask.jsonify({'error': 'No active session'}), 401
     
-    # Cap at reasonable number
-    min_grades_needed = min(min_grades_needed, 5)
+    try:
+        data = flask.request.get_json()
+        period = data.get('period')  # optional - overall average if missing
+        target_average = float(data.get('target_average'))
+        max_grades = int(data.get('max_grades', PLANNER_MAX_GRADES))
+        max_per_subject = int(data.get('max_per_subject', PLANNER_MAX_PER_SUBJECT))
+        
+        if target_average < 1 or target_average > 10:
+            return flask.jsonify({'error': 'La media target deve essere tra 1 e 10'}), 400
+        
+        if max_grades < 1 or max_grades > PLANNER_MAX_GRADES:
+            return flask.jsonify({'error': f'Il numero di voti deve essere tra 1 e {PLANNER_MAX_GRADES}'}), 400
+        
+        if max_per_subject < 1 or max_per_subject > max_grades:
+            return flask.jsonify({'error': 'Numero di voti per materia non valido'}), 400
+        
+        if period and not table.has(period):
+            return flask.jsonify({'error': 'Periodo non trovato'}), 400
+        
+        scope = view['periods'].get(period) if period else view
+        current_average = _view_avr(scope)
+        plans = [] if current_average >= target_average else plan_goal(view, target_average, period or None, max_grades, max_per_subject)
+        
+        return flask.jsonify({
+            'success': True,
+            'period': period or None,
+            'current_average': round(current_average, 2),
+            'target_average': target_average,
+            'already_achieved': current_average >= target_average,
+            'achievable': current_average >= target_average or bool(plans),
+            'plans': plans
+        }), 200
+        
+    except ValueError as e:
+        return flask.jsonify({'error': 'Valori non validi'}), 400
+    except Exception as e:
+        logger.error(f"Error planning goal: {e}", exc_info=True)
+        return flask.jsonify({'error': 'Errore durante il calcolo'}), 500
+
+def calculate_optimal_grades_needed(current_total, current_count, target_average):
+    """Calculate the optimal/minimum number of grades needed to reach target average.
     
-    # Calculate what grades are actually needed (realistic, not just 10s)
-    required_sum = target_average * (current_count + min_grades_needed) - current_total
-    required_average_grade = required_sum / min_grades_needed
+    The minimum comes from assuming perfect 10s (closed form, at most
+    PLANNER_MAX_GRADES); the plan spreads the required sum over that many
+    allowed grades as evenly as possible.
+    """
+    # If already at or above target, no grades needed
+    if current_count > 0 and (current_total / current_count) >= target_average:
+        return 0, []
     
-    # If required grade is too high (>10), we need more grades at lower values
-    while required_average_grade > 10 and min_grades_needed < 10:
-        min_grades_needed += 1
-        required_sum = target_average * (current_count + min_grades_needed) - current_total
-        required_average_grade = required_sum / min_grades_needed
+    # Formula: (current_total + 10*n) / (current_count + n) = target_average
+    # Solving for n: n = (target_average * current_count - current_total) / (10 - target_average)
+    min_grades_needed = minimum_grades_needed(current_total, current_count, target_average)
+    if min_grades_needed is None:
+        min_grades_needed = PLANNER_MAX_GRADES
+    min_grades_needed = min(max(min_grades_needed, 1), PLANNER_MAX_GRADES)
     
-    grades_plan = [round(required_average_grade, 1)] * min_grades_needed
+    required_sum = target_average * (current_count + min_grades_needed) - current_total
+    grades_plan = even_grade_plan(required_sum, min_grades_needed)
     
     return min_grades_needed, grades_plan
 
-def calculate_subject_suggestions(grades_avr, target_overall_average, num_grades, baseline_required_grade):
+# -----------------------------------------------------------------------------
+# Suggestion solver
+# -----------------------------------------------------------------------------
+# The suggestion endpoints rank every subject at once: the view is laid out as
+# a subject x period matrix of effective-grade sums and counts in one pass,
+# then required grade, impact and combined score are computed for all subjects
+# together and only the best `limit` are fully sorted (heapq top-k).
+# -----------------------------------------------------------------------------
+
+def subject_period_matrix(view):
+    """
+    Lay out a view as (subjects, periods, sums, counts), where sums[i][j] and
+    counts[i][j] are the effective-grade sum and count of subjects[i] in
+    periods[j].
+    """
+    periods = list(view['periods'])
+    subject_index = {}
+    for period_view in view['periods'].values():
+        for subject in period_view['subjects']:
+            subject_index.setdefault(subject, len(subject_index))
+    
+    sums = [[0.0] * len(periods) for _ in subject_index]
+    counts = [[0] * len(periods) for _ in subject_index]
+    for j, period_view in enumerate(view['periods'].values()):
+        for subject, bucket in period_view['subjects'].items():
+            i = subject_index[subject]
+            sums[i][j] = bucket['sum']
+            counts[i][j] = bucket['count']
+    return list(subject_index), periods, sums, counts
+
+def rank_subject_suggestions(subjects, subject_sums, subject_counts, required_grade, num_grades, limit=MAX_SUGGESTIONS):
+    """
+    Score every subject and return the best `limit` suggestions (all of them
+    if limit is None), ordered by combined score: lower is better.
+    
+    Subjects without grades are skipped. The required grade is the same for
+    every subject; the impact of a new grade is higher when the subject has
+    fewer grades.
+    """
+    is_achievable = required_grade <= max(ALLOWED_GRADES)
+    display_required_grade = round_to_allowed_grade(required_grade)
+    
+    # (score, subject, count, sum, impact): ties on score are broken by name
+    rows = []
+    for subject, total, count in zip(subjects, subject_sums, subject_counts):
+        if not count:
+            continue
+        impact = 100.0 / (count + num_grades)
+        rows.append((required_grade - impact * SUGGESTION_IMPACT_WEIGHT, subject, count, total, impact))
+    rows = heapq.nsmallest(limit, rows) if limit is not None else sorted(rows)
+    
+    return [{
+        'subject': subject,
+        'current_average': round(total / count, 2),
+        'required_grade': display_required_grade,
+        'raw_required_grade': round(required_grade, 2),
+        'num_current_grades': count,
+        'difficulty': round(score, 2),
+        'impact': round(impact, 2),
+        'is_achievable': is_achievable
+    } for score, subject, count, total, impact in rows]
+
+def calculate_subject_suggestions(view, target_overall_average, num_grades, baseline_required_grade, limit=MAX_SUGGESTIONS):
     """Calculate which subjects would be easiest to focus on to reach the target overall average.
     Returns suggestions sorted by difficulty (easiest first).
     
@@ -947,103 +1955,40 @@ def calculate_subject_suggestions(grades_avr, target_overall_average, num_grades
     - Required grade: Lower required grades = easier to achieve
     - Impact: Fewer existing grades = higher impact per new grade
     - Combined score balances both factors to find optimal subjects
-    """
-    suggestions = []
     
-    all_grades_list = get_all_grades(grades_avr)
-    if not all_grades_list:
+    view holds the precomputed aggregates matching the blue-grade preference.
+    limit is the number of suggestions to return (None for the full ranking).
+    """
+    if not view['count']:
         return []
     
-    current_total = sum(all_grades_list)
-    current_count = len(all_grades_list)
-    
-    all_subjects = set()
-    for period in grades_avr:
-        if period == 'all_avr':
-            continue
-        for subject in grades_avr[period]:
-            if subject != 'period_avr':
-                all_subjects.add(subject)
-    
-    for subject in all_subjects:
-        subject_grades = []
-        for period in grades_avr:
-            if period == 'all_avr':
-                continue
-            if subject in grades_avr[period]:
-                subject_data = grades_avr[period][subject]
-                if 'grades' in subject_data:
-                    exclude_blue = should_exclude_blue_grades()
-                    filtered = [g for g in subject_data['grades'] 
-                                if not (exclude_blue and g.get('isBlue', False))]
-                    subject_grades.extend(_get_effective_grades(filtered))
-        
-        if not subject_grades:
-            continue
-        
-        current_subject_avg = sum(subject_grades) / len(subject_grades)
-        
-        # Formula: (current_total + required_sum) / (current_count + num_grades) = target_overall_average
-        # required_sum = target_overall_average * (current_count + num_grades) - current_total
-        required_sum = target_overall_average * (current_count + num_grades) - current_total
-        required_average_grade = required_sum / num_grades if num_grades > 0 else 10
-        
-        display_required_grade = round_to_allowed_grade(required_average_grade)
-        
-        is_achievable = required_average_grade <= max(ALLOWED_GRADES)
-        
-        # Lower score = better suggestion
-        impact_factor = 1.0 / (len(subject_grades) + num_grades) * 100
-        combined_score = required_average_grade - (impact_factor * SUGGESTION_IMPACT_WEIGHT)
-        
-        suggestions.append({
-            'subject': subject,
-            'current_average': round(current_subject_avg, 2),
-            'required_grade': display_required_grade,
-            'raw_required_grade': round(required_average_grade, 2),
-            'num_current_grades': len(subject_grades),
-            'difficulty': round(combined_score, 2),
-            'impact': round(impact_factor, 2),
-            'is_achievable': is_achievable
-        })
+    # Formula: (current_total + required_sum) / (current_count + num_grades) = target_overall_average
+    # required_sum = target_overall_average * (current_count + num_grades) - current_total
+    required_sum = target_overall_average * (view['count'] + num_grades) - view['sum']
+    required_average_grade = required_sum / num_grades if num_grades > 0 else 10
     
-    # Sort by combined difficulty score (ascending) - lower = better target
-    # Prioritize achievable suggestions
-    suggestions.sort(key=lambda x: (not x['is_achievable'], x['difficulty']))
+    subjects, _, sums, counts = subject_period_matrix(view)
+    subject_sums = [sum(row) for row in sums]
+    subject_counts = [sum(row) for row in counts]
     
-    # Return top suggestions
-    return suggestions[:MAX_SUGGESTIONS]
+    return rank_subject_suggestions(subjects, subject_sums, subject_counts, required_average_grade, num_grades, limit)
 
-def calculate_period_subject_suggestions(grades_avr, period, target_average, num_grades):
+def calculate_period_subject_suggestions(view, period, target_average, num_grades, limit=MAX_SUGGESTIONS):
     """Calculate which subjects within a period would be easiest to focus on to reach the target average.
     Returns suggestions sorted by difficulty (easiest first).
     
     The algorithm calculates the required grade for each subject individually
     to reach the period target, then ranks them by achievability and difficulty.
+    view holds the precomputed aggregates matching the blue-grade preference.
+    limit is the number of suggestions to return (None for the full ranking).
     """
-    suggestions = []
-    
     # Get all subjects in the period
-    if period not in grades_avr or period == 'all_avr':
-        return []
-    
-    period_subjects = [s for s in grades_avr[period].keys() if s != 'period_avr']
-    
-    # Gather all period grades respecting user preference
-    exclude_blue = should_exclude_blue_grades()
-    all_period_grades = []
-    for subject in period_subjects:
-        subject_data = grades_avr[period][subject]
-        if 'grades' in subject_data:
-            filtered = [g for g in subject_data['grades']
-                       if not (exclude_blue and g.get('isBlue', False))]
-            all_period_grades.extend(_get_effective_grades(filtered))
-    
-    if not all_period_grades:
+    period_view = view['periods'].get(period)
+    if not period_view or not period_view['count']:
         return []
     
-    current_period_total = sum(all_period_grades)
-    current_period_count = len(all_period_grades)
+    current_period_total = period_view['sum']
+    current_period_count = period_view['count']
     current_period_avg = current_period_total / current_period_count
     
     if current_period_avg >= target_average:
@@ -1052,50 +1997,134 @@ def calculate_period_subject_suggestions(grades_avr, period, target_average, num
     required_sum = target_average * (current_period_count + num_grades) - current_period_total
     baseline_required_grade = required_sum / num_grades if num_grades > 0 else 10
     
-    for subject in period_subjects:
-        subject_data = grades_avr[period][subject]
-        
-        # Get effective grades for this subject respecting user preference
-        subject_grades = []
-        if 'grades' in subject_data:
-            filtered = [g for g in subject_data['grades'] 
-                        if not (exclude_blue and g.get('isBlue', False))]
-            subject_grades = _get_effective_grades(filtered)
-        
-        if not subject_grades:
-            continue
-        
-        current_subject_avg = sum(subject_grades) / len(subject_grades)
-        num_subject_grades = len(subject_grades)
-        
-        required_grade = baseline_required_grade
-        
-        # Achievability check
-        is_achievable = required_grade <= max(ALLOWED_GRADES)
+    buckets = period_view['subjects']
+    return rank_subject_suggestions(list(buckets), [b['sum'] for b in buckets.values()],
+                                    [b['count'] for b in buckets.values()], baseline_required_grade, num_grades, limit)
+
+def requested_suggestion_limit(data):
+    """max_suggestions from a request body: MAX_SUGGESTIONS by default, 0 for the full ranking."""
+    limit = int(data.get('max_suggestions', MAX_SUGGESTIONS))
+    return limit if limit > 0 else None
+
+# -----------------------------------------------------------------------------
+# Goal planner
+# -----------------------------------------------------------------------------
+# For every number of new grades n, finds the least-effort set of grades (only
+# ALLOWED_GRADES values, spread over subjects) that reaches a target overall or
+# period average, and returns the Pareto frontier of (n, effort) plans.
+#
+# The effort of a new grade is how far it is above the student's current
+# average in that subject: a grade at or below your usual level costs nothing.
+# Every new grade is a new evaluation, i.e. one more effective grade (existing
+# component groups are already folded into the view's counts).
+#
+# The plan for n grades is exact without searching combinations: the n slots
+# (subject, k-th new grade in it) with the highest subject averages are always
+# the best choice, and on each slot the cost of raising the grade by one step
+# never decreases, so taking the cheapest steps first is optimal.
+# Grades are handled in integer steps of GRADE_STEP to avoid float drift.
+# -----------------------------------------------------------------------------
+GRADE_STEP = 0.25
+PLANNER_MAX_GRADES = 10       # upper bound for n, like num_grades in the other endpoints
+PLANNER_MAX_PER_SUBJECT = 3   # default number of upcoming grades assumed per subject
+
+_MIN_GRADE_STEPS = round(min(ALLOWED_GRADES) / GRADE_STEP)
+_MAX_GRADE_STEPS = round(max(ALLOWED_GRADES) / GRADE_STEP)
+
+def minimum_grades_needed(current_total, current_count, target_average, max_grade=max(ALLOWED_GRADES)):
+    """Fewest new grades that can reach target_average, all at max_grade (None if impossible)."""
+    missing = target_average * current_count - current_total
+    if missing <= 1e-9:
+        return 0
+    if target_average >= max_grade:
+        return None
+    # (current_total + max_grade * n) / (current_count + n) >= target_average
+    return math.ceil(missing / (max_grade - target_average) - 1e-9)
+
+def even_grade_plan(required_sum, num_grades):
+    """num_grades allowed grades, as equal as possible, adding up to at least required_sum."""
+    steps = max(math.ceil(required_sum / GRADE_STEP - 1e-9), _MIN_GRADE_STEPS * num_grades)
+    base, extra = divmod(steps, num_grades)
+    return [min(base + (i < extra), _MAX_GRADE_STEPS) * GRADE_STEP for i in range(num_grades)]
+
+@lru_cache(maxsize=256)
+def _plan_frontier(subject_averages, current_total, current_count, target_average, max_grades, max_per_subject):
+    """Memoized core of plan_goal; subject_averages is a tuple of (subject, average)."""
+    # Best slots first: a higher subject average makes every grade cheaper
+    slots = sorted(((average, subject) for subject, average in subject_averages for _ in range(max_per_subject)),
+                   key=lambda slot: (-slot[0], slot[1]))
+    
+    def effort(steps, average):
+        return max(0.0, steps * GRADE_STEP - average)
+    
+    frontier = []
+    best_effort = None
+    for n in range(1, min(max_grades, len(slots)) + 1):
+        required_steps = math.ceil((target_average * (current_count + n) - current_total) / GRADE_STEP - 1e-9)
+        if required_steps > _MAX_GRADE_STEPS * n:
+            continue  # not reachable with n grades
         
-        # Display grade (rounded to allowed values)
-        display_required_grade = round_to_allowed_grade(required_grade)
+        chosen = slots[:n]
+        # Free starting point: the highest allowed grade not above the subject average
+        grades = [min(max(math.floor(average / GRADE_STEP + 1e-9), _MIN_GRADE_STEPS), _MAX_GRADE_STEPS)
+                  for average, _ in chosen]
+        total_effort = sum(effort(g, average) for g, (average, _) in zip(grades, chosen))
         
-        impact_factor = 1.0 / (num_subject_grades + num_grades) * 100
+        missing = required_steps - sum(grades)
+        if missing > 0:
+            raises = sorted(
+                (effort(g + k, average) - effort(g + k - 1, average), i)
+                for i, (g, (average, _)) in enumerate(zip(grades, chosen))
+                for k in range(1, _MAX_GRADE_STEPS - g + 1)
+            )[:missing]
+            for cost, i in raises:
+                grades[i] += 1
+                total_effort += cost
         
-        combined_score = required_grade - (impact_factor * SUGGESTION_IMPACT_WEIGHT)
+        # Pareto frontier: more grades are only worth it if they take less effort
+        if best_effort is not None and total_effort >= best_effort - 1e-9:
+            continue
+        best_effort = total_effort
         
-        suggestions.append({
-            'subject': subject,
-            'current_average': round(current_subject_avg, 2),
-            'required_grade': display_required_grade,
-            'raw_required_grade': round(required_grade, 2),
-            'num_current_grades': num_subject_grades,
-            'difficulty': round(combined_score, 2),
-            'impact': round(impact_factor, 2),
-            'is_achievable': is_achievable
+        per_subject = {}
+        for g, (_, subject) in zip(grades, chosen):
+            per_subject.setdefault(subject, []).append(g * GRADE_STEP)
+        total = sum(grades) * GRADE_STEP
+        frontier.append({
+            'num_grades': n,
+            'effort': round(total_effort, 2),
+            'predicted_average': round((current_total + total) / (current_count + n), 2),
+            'grades': [{'subject': subject, 'grades': sorted(values, reverse=True)}
+                       for subject, values in per_subject.items()]
         })
+    return tuple(frontier)
+
+def plan_goal(view, target_average, period=None, max_grades=PLANNER_MAX_GRADES, max_per_subject=PLANNER_MAX_PER_SUBJECT):
+    """
+    Pareto frontier of plans reaching target_average for the overall average,
+    or for one period's average if period is given.
     
-    # Sort by achievability first, then by difficulty score (ascending)
-    suggestions.sort(key=lambda x: (not x.get('is_achievable', True), x['difficulty']))
+    Returns a list of plans sorted by number of grades, each with strictly less
+    effort than the previous: {'num_grades', 'effort', 'predicted_average',
+    'grades': [{'subject', 'grades'}]}. Empty if the target can't be reached.
+    """
+    if period is None:
+        subjects, _, sums, counts = subject_period_matrix(view)
+        subject_sums = [sum(row) for row in sums]
+        subject_counts = [sum(row) for row in counts]
+        scope = view
+    else:
+        scope = view['periods'].get(period) or {'sum': 0.0, 'count': 0, 'subjects': {}}
+        subjects = list(scope['subjects'])
+        subject_sums = [bucket['sum'] for bucket in scope['subjects'].values()]
+        subject_counts = [bucket['count'] for bucket in scope['subjects'].values()]
     
-    # Return top suggestions
-    return suggestions[:MAX_SUGGESTIONS]
+    subject_averages = tuple((subject, round(total / count, 6))
+                             for subject, total, count in zip(subjects, subject_sums, subject_counts) if count)
+    frontier = _plan_frontier(subject_averages, round(scope['sum'], 6), scope['count'],
+                              float(target_average), max_grades, max_per_subject)
+    return [dict(plan, grades=[dict(entry, grades=list(entry['grades'])) for entry in plan['grades']])
+            for plan in frontier]
 
 def get_period_suggestion_message(suggestions, target_average, num_grades, period):
     """Generate an intelligent message about which subjects to focus on within a period"""
@@ -1153,7 +2182,8 @@ def get_goal_overall_message(raw_grade, display_grade, target_average, current_a
 @app.route('/predict_average_overall', methods=['POST'])
 def predict_average_overall():
     """Predict how hypothetical grades in a subject will affect the overall average"""
-    if 'grades_avr' not in flask.session:
+    table, view = load_grades_view()
+    if table is None:
         return flask.jsonify({'error': 'No active session'}), 401
     
     try:
@@ -1162,9 +2192,7 @@ def predict_average_overall():
         subject = data.get('subject')
         predicted_grades = data.get('predicted_grades', [])
         
-        grades_avr = flask.session['grades_avr']
-        
-        if period not in grades_avr or subject not in grades_avr[period]:
+        if not table.has(period, subject):
             return flask.jsonify({'error': 'Materia o periodo non trovato'}), 400
         
         if not predicted_grades or not isinstance(predicted_grades, list):
@@ -1174,15 +2202,12 @@ def predict_average_overall():
             if not isinstance(grade, (int, float)) or grade < 1 or grade > 10:
                 return flask.jsonify({'error': 'Tutti i voti devono essere tra 1 e 10'}), 400
         
-        current_overall_average = grades_avr.get('all_avr', 0)
+        current_overall_average = _view_avr(view)
         
-        all_grades_list = get_all_grades(grades_avr)
-        
-        if not all_grades_list:
+        if not view['count']:
             return flask.jsonify({'error': 'Nessun voto disponibile'}), 400
         
-        all_grades_with_predicted = all_grades_list + predicted_grades
-        predicted_overall_average = sum(all_grades_with_predicted) / len(all_grades_with_predicted)
+        predicted_overall_average = (view['sum'] + sum(predicted_grades)) / (view['count'] + len(predicted_grades))
         
         change = predicted_overall_average - current_overall_average
         
@@ -1221,48 +2246,429 @@ def get_predict_overall_message(change, predicted_average, num_grades, subject):
     else:
         return f"Attenzione! Con {grade_text} in {subject} la tua media generale scenderebbe significativamente a {round(predicted_average, 2)} ({change:.2f}). 📉"
 
-@app.route('/export/csv', methods=['POST'])
-def export_csv():
-    """Export grades as CSV file"""
-    if 'grades_avr' not in flask.session:
-        return flask.jsonify({'error': 'No active session', 'authenticated': False}), 401
+# Upper bound on scenarios per /predict_batch call
+PREDICT_BATCH_MAX_SCENARIOS = 100
+
+def predict_scenario(view, period, subject, predicted_grades):
+    """
+    Subject, period and overall averages after adding predicted_grades to a
+    subject, from the precomputed sums and counts: O(len(predicted_grades)).
+    Returns an {'error': ...} dict if the scenario is not valid.
+    """
+    if not predicted_grades or not isinstance(predicted_grades, list):
+        return {'error': 'Inserisci almeno un voto previsto'}
     
-    grades_avr = flask.session['grades_avr']
+    for grade in predicted_grades:
+        if not isinstance(grade, (int, float)) or grade < 1 or grade > 10:
+            return {'error': 'Tutti i voti devono essere tra 1 e 10'}
     
-    output = io.StringIO()
-    writer = csv.writer(output)
+    bucket = view_subject(view, period, subject)
+    if not bucket or not bucket['count']:
+        return {'error': 'Materia o periodo non trovato'}
     
-    writer.writerow(['Periodo', 'Materia', 'Voto', 'Data', 'Tipo', 'Docente', 'Note'])
+    added_sum = sum(predicted_grades)
+    added_count = len(predicted_grades)
+    period_view = view['periods'][period]
     
-    for period in sorted(grades_avr.keys()):
-        if period == 'all_avr':
-            continue
+    result = {'subject': subject, 'period': period, 'num_predicted_grades': added_count}
+    for name, totals in (('average', bucket), ('period_average', period_view), ('overall_average', view)):
+        current = totals['sum'] / totals['count']
+        predicted = (totals['sum'] + added_sum) / (totals['count'] + added_count)
+        result[f'current_{name}'] = round(current, 2)
+        result[f'predicted_{name}'] = round(predicted, 2)
+        result[f'{name}_change'] = round(predicted - current, 2)
+    return result
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """Predict subject, period and overall averages for many what-if scenarios in one call"""
+    table, view = load_grades_view()
+    if table is None:
+        return flask.jsonify({'error': 'No active session'}), 401
+    
+    try:
+        data = flask.request.get_json()
+        scenarios = data.get('scenarios')
+        
+        if not scenarios or not isinstance(scenarios, list):
+            return flask.jsonify({'error': 'Inserisci almeno uno scenario'}), 400
         
-        for subject, data in grades_avr[period].items():
-            if subject == 'period_avr':
+        if len(scenarios) > PREDICT_BATCH_MAX_SCENARIOS:
+            return flask.jsonify({'error': f'Massimo {PREDICT_BATCH_MAX_SCENARIOS} scenari per richiesta'}), 400
+        
+        # Scenarios are independent: an invalid one gets an error entry,
+        # the others are still computed
+        results = []
+        for scenario in scenarios:
+            if not isinstance(scenario, dict):
+                results.append({'error': 'Scenario non valido'})
                 continue
-            
-            for grade in data.get('grades', []):
-                writer.writerow([
+            results.append(predict_scenario(view, scenario.get('period'), scenario.get('subject'),
+                                            scenario.get('predicted_grades', [])))
+        
+        return flask.jsonify({
+            'success': True,
+            'current_overall_average': round(_view_avr(view), 2),
+            'results': results
+        }), 200
+        
+    except ValueError as e:
+        return flask.jsonify({'error': 'Valori non validi'}), 400
+    except Exception as e:
+        logger.error(f"Error predicting batch: {e}", exc_info=True)
+        return flask.jsonify({'error': 'Errore durante il calcolo'}), 500
+
+# -----------------------------------------------------------------------------
+# Grade export (streaming)
+# -----------------------------------------------------------------------------
+# Exports are generated row by row and sent as they are produced, in chunks of
+# about EXPORT_CHUNK_SIZE bytes, so the file never has to exist in memory as a
+# whole. XLSX is written as a streamed zip (no spreadsheet library needed).
+# The PDF report needs reportlab; platypus lays out the whole document before
+# writing it, so the PDF is spooled to a temporary file (on disk once it is
+# big) and streamed from there.
+# -----------------------------------------------------------------------------
+EXPORT_CHUNK_SIZE = 64 * 1024
+PDF_TABLE_ROWS = 40  # detail rows per PDF table, about one A4 page
+
+EXPORT_HEADER = ['Periodo', 'Materia', 'Voto', 'Data', 'Tipo', 'Docente', 'Note']
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'pdf': 'application/pdf'
+}
+
+try:
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import cm
+    from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+    REPORTLAB_AVAILABLE = True
+except ImportError:
+    REPORTLAB_AVAILABLE = False
+
+def export_rows(table):
+    """Grades of a table as export rows (EXPORT_HEADER order), period by period."""
+    strings = table.strings
+    for period in sorted(table.index.keys()):
+        for subject, rows in table.index[period].items():
+            for row in rows:
+                yield [
                     f'Periodo {period}',
                     subject,
-                    grade.get('decimalValue', ''),
-                    grade.get('evtDate', ''),
-                    grade.get('componentDesc', ''),
-                    grade.get('teacherName', ''),
-                    grade.get('notesForFamily', '')
+                    table.decimal_value(row),
+                    strings[table.date[row]],
+                    strings[table.component[row]],
+                    strings[table.teacher[row]],
+                    strings[table.notes[row]]
+                ]
+
+def stream_csv(table):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_HEADER)
+    for row in export_rows(table):
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def stream_ndjson(table):
+    """One JSON object per grade and line, in the field names of the grades API."""
+    chunk = []
+    size = 0
+    for period, subject, value, date, component, teacher, notes in export_rows(table):
+        line = dumps_json({
+            'period': period[len('Periodo '):],
+            'subject': subject,
+            'decimalValue': value,
+            'evtDate': date,
+            'componentDesc': component,
+            'teacherName': teacher,
+            'notesForFamily': notes
+        }) + '\n'
+        chunk.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    yield ''.join(chunk)
+
+
+class _ChunkSink:
+    """Write-only, unseekable file object whose content is drained into a response."""
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+
+# Characters that are not allowed in XML 1.0 documents
+_XML_INVALID_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _xlsx_cell(column, row_number, value):
+    ref = f'{column}{row_number}'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}"><v>{value}</v></c>'
+    text = xml_escape(_XML_INVALID_RE.sub('', str(value or '')))
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+_XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Voti" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'),
+    'xl/styles.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'),
+}
+
+def stream_xlsx(table):
+    """Single-sheet workbook with inline strings, written as a streamed zip."""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_PARTS.items():
+            archive.writestr(name, content)
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            rows = itertools.chain([EXPORT_HEADER], export_rows(table))
+            for row_number, row in enumerate(rows, start=1):
+                cells = ''.join(_xlsx_cell(column, row_number, value) for column, value in zip('ABCDEFG', row))
+                sheet.write(f'<row r="{row_number}">{cells}</row>'.encode('utf-8'))
+                if sink.size >= EXPORT_CHUNK_SIZE:
+                    yield sink.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+def _pdf_detail_table(rows, table_style):
+    return Table([['Materia', 'Voto', 'Data', 'Tipo', 'Docente', 'Note']] + rows,
+                 colWidths=[4 * cm, 1.3 * cm, 2 * cm, 2 * cm, 3.5 * cm, 5 * cm],
+                 style=table_style, repeatRows=1, hAlign='LEFT')
+
+def _pdf_story(table, view):
+    """Platypus flowables of the per-period report, one period at a time."""
+    styles = getSampleStyleSheet()
+    note_style = styles['BodyText'].clone('ExportNote', fontSize=7, leading=8)
+    table_style = TableStyle([
+        ('FONTSIZE', (0, 0), (-1, -1), 8),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#e8eaf6')),
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.grey),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ])
+    yield Paragraph('Che media ho? - Report voti', styles['Title'])
+    yield Paragraph(f"Media generale: {_view_avr(view):.2f}", styles['Normal'])
+    strings = table.strings
+    for i, period in enumerate(sorted(table.index.keys())):
+        if i:
+            yield PageBreak()
+        period_view = view['periods'].get(period)
+        yield Paragraph(f'Periodo {period} - media {_view_avr(period_view):.2f}', styles['Heading2'])
+        
+        subjects = table.index[period]
+        summary = [['Materia', 'Voti', 'Media']]
+        for subject, rows in subjects.items():
+            bucket = period_view['subjects'].get(subject) if period_view else None
+            summary.append([subject, len(rows), f'{_view_avr(bucket):.2f}'])
+        yield Table(summary, colWidths=[9 * cm, 2 * cm, 2 * cm], style=table_style, hAlign='LEFT')
+        yield Spacer(1, 0.5 * cm)
+        
+        # Platypus re-splits a table for every page it spans, so a single detail
+        # table gets quadratic in the number of grades: emit page-sized ones.
+        detail = []
+        for subject, rows in subjects.items():
+            for row in rows:
+                notes = strings[table.notes[row]]
+                detail.append([
+                    subject,
+                    strings[table.display[row]] or table.decimal_value(row),
+                    strings[table.date[row]],
+                    strings[table.component[row]],
+                    strings[table.teacher[row]],
+                    Paragraph(xml_escape(notes), note_style) if notes else ''
                 ])
+                if len(detail) == PDF_TABLE_ROWS:
+                    yield _pdf_detail_table(detail, table_style)
+                    detail = []
+        if detail:
+            yield _pdf_detail_table(detail, table_style)
+
+def stream_pdf(table, view):
+    """Per-period PDF report, spooled to a temporary file and streamed from it."""
+    with tempfile.SpooledTemporaryFile(max_size=4 * EXPORT_CHUNK_SIZE) as spool:
+        document = SimpleDocTemplate(spool, pagesize=A4, title='Report voti',
+                                     leftMargin=1.5 * cm, rightMargin=1.5 * cm)
+        document.build(list(_pdf_story(table, view)))
+        spool.seek(0)
+        while True:
+            chunk = spool.read(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+@app.route('/export/<export_format>', methods=['POST'])
+def export_grades(export_format):
+    """Export grades as a streamed CSV, NDJSON, XLSX or PDF file"""
+    if export_format not in EXPORT_MIMETYPES:
+        return flask.jsonify({'error': 'Formato di esportazione non supportato'}), 404
+    
+    table, view = load_grades_view()
+    if table is None:
+        return flask.jsonify({'error': 'No active session', 'authenticated': False}), 401
+    
+    if export_format == 'csv':
+        stream = stream_csv(table)
+    elif export_format == 'ndjson':
+        stream = stream_ndjson(table)
+    elif export_format == 'xlsx':
+        stream = stream_xlsx(table)
+    else:
+        if not REPORTLAB_AVAILABLE:
+            return flask.jsonify({'error': 'Esportazione PDF non disponibile (reportlab non installato)'}), 501
+        stream = stream_pdf(table, view)
     
-    output.seek(0)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     
-    response = flask.Response(output.getvalue(), mimetype='text/csv')
-    response.headers['Content-Disposition'] = f'attachment; filename=voti_{timestamp}.csv'
+    response = flask.Response(stream, mimetype=EXPORT_MIMETYPES[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename=voti_{timestamp}.{export_format}'
     
     return response
 
+# =============================================================================
+# UPSTREAM HTTP CLIENT (ClasseViva)
+# =============================================================================
+# Every call to web.spaggiari.eu goes through one pooled requests.Session per
+# worker process: connections are kept alive between requests (no new TCP+TLS
+# handshake per call), every request has connect/read timeouts so a slow
+# ClasseViva response can't hold a gunicorn worker forever, and transient
+# failures (5xx, connection resets) are retried with jittered backoff.
+# =============================================================================
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', '10'))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '5'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', '20'))
+UPSTREAM_MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', '2'))
+UPSTREAM_BACKOFF = float(os.environ.get('UPSTREAM_BACKOFF', '0.5'))
+# Only changed to point the app at a local stub of ClasseViva (load tests)
+UPSTREAM_BASE_URL = os.environ.get('UPSTREAM_BASE_URL', 'https://web.spaggiari.eu').rstrip('/')
+
+
+class UpstreamSession(requests.Session):
+    """requests.Session that applies the upstream timeouts by default."""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+        endpoint = upstream_endpoint(url)
+        try:
+            with UPSTREAM_SECONDS.time(endpoint):
+                response = super().request(method, url, **kwargs)
+        except requests.exceptions.Timeout:
+            UPSTREAM_ERRORS.inc(endpoint, 'timeout')
+            raise
+        except requests.exceptions.RequestException:
+            UPSTREAM_ERRORS.inc(endpoint, 'connection')
+            raise
+        if response.status_code >= 400:
+            UPSTREAM_ERRORS.inc(endpoint, str(response.status_code))
+        return response
+
+
+def _build_upstream_adapter():
+    retry = Retry(
+        total=UPSTREAM_MAX_RETRIES,
+        backoff_factor=UPSTREAM_BACKOFF,
+        backoff_jitter=UPSTREAM_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        # The only POSTs we send are logins, which are safe to repeat
+        allowed_methods=frozenset(['GET', 'HEAD', 'POST']),
+        raise_on_status=False,
+        respect_retry_after_header=True,
+    )
+    return HTTPAdapter(pool_connections=4, pool_maxsize=UPSTREAM_POOL_SIZE, max_retries=retry)
+
+_upstream_lock = threading.Lock()
+_upstream_state = {'pid': None, 'adapter': None, 'session': None}
+
+def _upstream_adapter():
+    """Connection pool of the current worker, rebuilt after a fork."""
+    pid = os.getpid()
+    if _upstream_state['pid'] != pid:
+        with _upstream_lock:
+            if _upstream_state['pid'] != pid:
+                adapter = _build_upstream_adapter()
+                session = UpstreamSession()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                # Shared by every user of this worker: never keep cookies around
+                session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                _upstream_state.update(adapter=adapter, session=session, pid=pid)
+    return _upstream_state['adapter']
+
+def upstream_session():
+    """Shared, cookie-less session for stateless ClasseViva calls."""
+    _upstream_adapter()
+    return _upstream_state['session']
+
+def new_upstream_session():
+    """Private session (own cookie jar) that still uses the shared connection pool."""
+    adapter = _upstream_adapter()
+    session = UpstreamSession()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+GRADES_PAGE_URL = f"{UPSTREAM_BASE_URL}/cvv/app/default/genitori_voti.php"
+
 def login(user_id, user_pass):
-    url = "https://web.spaggiari.eu/rest/v1/auth/login"
+    url = f"{UPSTREAM_BASE_URL}/rest/v1/auth/login"
     headers = {
         "Content-Type": "application/json",
         "Z-Dev-ApiKey": "Tg1NWEwNGIgIC0K",
@@ -1274,7 +2680,7 @@ def login(user_id, user_pass):
         "uid": user_id
     }
     
-    response = requests.post(url, headers=headers, data=json.dumps(body))
+    response = upstream_session().post(url, headers=headers, data=json.dumps(body))
     
     if response.status_code == 200:
         return response.json()
@@ -1286,7 +2692,7 @@ def login_email(email, password):
     Login using email credentials via the web authentication endpoint.
     Returns a dictionary with the PHPSESSID token and user identity.
     """
-    url = "https://web.spaggiari.eu/auth-p7/app/default/AuthApi4.php?a=aLoginPwd"
+    url = f"{UPSTREAM_BASE_URL}/auth-p7/app/default/AuthApi4.php?a=aLoginPwd"
     
     headers = {
         "Content-Type": "application/x-www-form-urlencoded; charset=utf-8",
@@ -1301,7 +2707,7 @@ def login_email(email, password):
         "target": ""
     }
     
-    session = requests.Session()
+    session = new_upstream_session()
     
     response = session.post(url, headers=headers, data=data, allow_redirects=False)
     
@@ -1352,130 +2758,136 @@ def login_email(email, password):
         response=response
     )
 
-def extract_webidentity(phpsessid):
-    """
-    Extract the webidentity (student ID) from the session by fetching a page.
-    """
-    url = "https://web.spaggiari.eu/home/app/default/menu_webinfoschool_genitori.php"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-        "Cookie": f"PHPSESSID={phpsessid}"
-    }
-    
-    response = requests.get(url, headers=headers)
-    
-    if response.status_code == 200:
-        # Parse the HTML to extract webidentity
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Try to find user identity from various elements in the page
-        # The webidentity is typically in the format like "S1234567" or similar
-        
-        # Check for identity in scripts or data attributes
-        scripts = soup.find_all('script')
-        for script in scripts:
-            if script.string:
-                # Look for patterns like webidentity or student id
-                match = re.search(r'webidentity["\']?\s*[=:]\s*["\']?([A-Z]\d+)', script.string, re.IGNORECASE)
-                if match:
-                    return match.group(1)
-        
-        # Try to find it in any element's data attribute
-        for elem in soup.find_all(attrs={"data-id": True}):
-            data_id = elem.get("data-id", "")
-            if re.match(r'^[A-Z]\d+$', data_id):
-                return data_id
-        
-        # Check the page content for the school name (indicates successful login)
-        school_span = soup.find('span', class_='scuola')
-        if school_span:
-            # User is logged in - first try to get identity from the grades page
-            grades_identity = extract_webidentity_from_grades(phpsessid)
-            if grades_identity:
-                return grades_identity
-            # If grades page doesn't have materia_id elements (e.g., new student with no grades,
-            # or page structure changed), still return the placeholder since the session is valid.
-            # The school name presence confirms the session is authenticated.
-            logger.info("Session valid (school name found) but no webidentity extracted from grades page")
-            return EMAIL_LOGIN_WEBIDENTITY
-    
-    return None
+# -----------------------------------------------------------------------------
+# Grades page scraping
+# -----------------------------------------------------------------------------
+# genitori_voti.php is large and parsing it is the main CPU cost of an email
+# login refresh. The fast path only builds the period tables (SoupStrainer) and
+# uses lxml when available; html.parser on the whole page remains the fallback.
+# Set SCRAPER_FAST_PARSE=false to always use the original full parse.
+# -----------------------------------------------------------------------------
+SCRAPER_FAST_PARSE = os.environ.get('SCRAPER_FAST_PARSE', 'true').lower() == 'true'
 
-def extract_webidentity_from_grades(phpsessid):
-    """
-    Extract webidentity from the grades page where it's more likely to be present.
-    """
-    url = "https://web.spaggiari.eu/cvv/app/default/genitori_voti.php"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-        "Cookie": f"PHPSESSID={phpsessid}"
-    }
-    
-    response = requests.get(url, headers=headers)
-    
-    if response.status_code == 200:
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Look for student identity in various places
-        scripts = soup.find_all('script')
-        for script in scripts:
-            if script.string:
-                # Look for student ID patterns
-                match = re.search(r'(?:studente|student|alunno|uid|webidentity)["\']?\s*[=:]\s*["\']?([A-Z]?\d+)', script.string, re.IGNORECASE)
-                if match:
-                    return match.group(1)
-        
-        # Check for materia_id which indicates grades are accessible
-        grade_elements = soup.find_all(attrs={"materia_id": True})
-        if grade_elements:
-            # If grades are accessible, the session is valid
-            # Return a placeholder that indicates email login mode
-            return EMAIL_LOGIN_WEBIDENTITY
-    
-    return None
+try:
+    import lxml  # noqa: F401 - only needed as a BeautifulSoup tree builder
+    SCRAPER_PARSER = 'lxml'
+except ImportError:
+    SCRAPER_PARSER = 'html.parser'
+
+_PERIOD_TABLES_STRAINER = SoupStrainer('table', attrs={'sessione': True})
+_FORMS_STRAINER = SoupStrainer('form')
+_FORM_TAG_RE = re.compile(r'<form\b(?:[^>"\']|"[^"]*"|\'[^\']*\')*>', re.IGNORECASE)
+_LOGIN_FORM_ID_RE = re.compile(r'(?:^|\s)id\s*=\s*["\']?login_form(?:["\'\s>/]|$)', re.IGNORECASE)
+_LOGIN_FORM_ACTION_RE = re.compile(r'(?:^|\s)action\s*=\s*(?:"[^"]*(?:login|auth)|\'[^\']*(?:login|auth)|[^\s>"\']*(?:login|auth))', re.IGNORECASE)
 
 def get_grades_email(phpsessid, webidentity):
     """
     Get grades using the email login session by scraping the grades HTML page.
     Returns grades in the same format as the API for compatibility.
     """
-    url = "https://web.spaggiari.eu/cvv/app/default/genitori_voti.php"
+    return parse_grades_page(fetch_grades_page(phpsessid, webidentity).text)
+
+def fetch_grades_page(phpsessid, webidentity, extra_headers=None):
+    """
+    Download the grades HTML page of an email login session.
+    Returns the response (200, or 304 when extra_headers holds matching validators).
+    """
     headers = {
         "User-Agent": DEFAULT_USER_AGENT,
-        "Cookie": f"PHPSESSID={phpsessid}; webidentity={webidentity}"
+        "Cookie": f"PHPSESSID={phpsessid}; webidentity={webidentity}",
+        **(extra_headers or {})
     }
     
-    response = requests.get(url, headers=headers)
+    response = upstream_session().get(GRADES_PAGE_URL, headers=headers)
     
-    if response.status_code != 200:
+    if response.status_code not in (200, 304):
         response.raise_for_status()
     
-    soup = BeautifulSoup(response.text, 'html.parser')
+    return response
+
+def parse_grades_page(html, fast=None):
+    """
+    Parse the grades HTML page into the same format as the REST API.
+    Raises an HTTPError with status 401 if the page is the login page.
+    
+    By default the fast path is used (see SCRAPER_FAST_PARSE); if it fails
+    for any reason other than an expired session, the page is parsed again
+    with the full html.parser tree.
+    """
+    if fast is None:
+        fast = SCRAPER_FAST_PARSE
+    if fast:
+        try:
+            with PARSE_SECONDS.time('fast'):
+                return _parse_grades_page_fast(html)
+        except requests.exceptions.HTTPError:
+            raise
+        except Exception as e:
+            logger.warning(f"Fast grades parser failed ({e}), falling back to html.parser")
+    
+    with PARSE_SECONDS.time('full'):
+        return _parse_grades_page_full(html)
+
+def _parse_grades_page_full(html):
+    """Original parse_grades_page path: full html.parser tree of the page."""
+    soup = BeautifulSoup(html, 'html.parser')
     
     # Check if we were redirected to login page (session expired)
     # ClasseViva redirects to login page when session is invalid
-    login_form = soup.find('form', {'id': 'login_form'}) or soup.find('form', {'action': re.compile(r'login|auth', re.IGNORECASE)})
-    if login_form:
+    if _find_login_form(soup):
         logger.warning("Session expired: login form detected in grades page")
-        # Create a mock response to raise an appropriate HTTP error
-        error_response = requests.models.Response()
-        error_response.status_code = 401
-        raise requests.exceptions.HTTPError("Session expired", response=error_response)
+        _raise_session_expired()
     
     # Also check for common indicators of logged-out state
     body_text = soup.get_text().lower()
     if 'accedi' in body_text and 'password' in body_text and 'autenticazione' in body_text:
         logger.warning("Session expired: authentication page detected")
-        error_response = requests.models.Response()
-        error_response.status_code = 401
-        raise requests.exceptions.HTTPError("Session expired", response=error_response)
+        _raise_session_expired()
+    
+    return {"grades": _extract_grades(soup.find_all('table', attrs={'sessione': True}))}
+
+def _find_login_form(soup):
+    """The login form ClasseViva shows instead of the page of an expired session, or None."""
+    return soup.find('form', {'id': 'login_form'}) or soup.find('form', {'action': re.compile(r'login|auth', re.IGNORECASE)})
+
+def _raise_session_expired():
+    # Create a mock response to raise an appropriate HTTP error
+    error_response = requests.models.Response()
+    error_response.status_code = 401
+    raise requests.exceptions.HTTPError("Session expired", response=error_response)
+
+def _parse_grades_page_fast(html):
+    """
+    Fast path of parse_grades_page: detect the login page with a regex
+    pre-scan, then build a tree of the period tables only (SoupStrainer),
+    with lxml when it is installed.
+    """
+    # The regexes only pick the pages worth a closer look: a form tag can also
+    # be text in a comment or a script, so a tree of the forms confirms it
+    if any(_LOGIN_FORM_ID_RE.search(form.group(0)) or _LOGIN_FORM_ACTION_RE.search(form.group(0))
+           for form in _FORM_TAG_RE.finditer(html)):
+        if _find_login_form(BeautifulSoup(html, 'html.parser', parse_only=_FORMS_STRAINER)):
+            logger.warning("Session expired: login form detected in grades page")
+            _raise_session_expired()
+    
+    # The visible-text check needs a full tree, but it can only match if all
+    # three words appear somewhere in the raw page, which is rarely the case
+    lowered = html.lower()
+    if 'accedi' in lowered and 'password' in lowered and 'autenticazione' in lowered:
+        body_text = BeautifulSoup(html, SCRAPER_PARSER).get_text().lower()
+        if 'accedi' in body_text and 'password' in body_text and 'autenticazione' in body_text:
+            logger.warning("Session expired: authentication page detected")
+            _raise_session_expired()
     
+    soup = BeautifulSoup(html, SCRAPER_PARSER, parse_only=_PERIOD_TABLES_STRAINER)
+    return {"grades": _extract_grades(soup.find_all('table', attrs={'sessione': True}))}
+
+def _extract_grades(period_tables):
+    """Read the grades out of the period tables of the grades page."""
     mark_table = MARK_TABLE
     
     grades = []
     
-    period_tables = soup.find_all('table', attrs={'sessione': True})
-    
     for table in period_tables:
         period_code = table.get('sessione', '')
         period_match = re.search(r'(\d+)', period_code)
@@ -1544,17 +2956,17 @@ def get_grades_email(phpsessid, webidentity):
                                 "teacherName": ""
                             })
     
-    return {"grades": grades}
+    return grades
 
 def get_periods(student_id, token):
-    url = f"https://web.spaggiari.eu/rest/v1/students/{student_id}/periods"
+    url = f"{UPSTREAM_BASE_URL}/rest/v1/students/{student_id}/periods"
     headers = {
         "Content-Type": "application/json",
         "Z-Dev-ApiKey": "Tg1NWEwNGIgIC0K",
         "User-Agent": "CVVS/std/4.1.7 Android/10",
         "Z-Auth-Token": token
     }
-    response = requests.get(url, headers=headers)
+    response = upstream_session().get(url, headers=headers)
     
     if response.status_code == 200:
         return response.json()
@@ -1562,19 +2974,115 @@ def get_periods(student_id, token):
         response.raise_for_status()
 
 def get_grades(student_id, token):
-    url = f"https://web.spaggiari.eu/rest/v1/students/{student_id}/grades"
+    return fetch_grades_response(student_id, token).json()
+
+def fetch_grades_response(student_id, token, extra_headers=None):
+    """
+    Call the REST grades endpoint.
+    Returns the response (200, or 304 when extra_headers holds matching validators).
+    """
+    url = f"{UPSTREAM_BASE_URL}/rest/v1/students/{student_id}/grades"
     headers = {
         "Content-Type": "application/json",
         "Z-Dev-ApiKey": "Tg1NWEwNGIgIC0K",
         "User-Agent": "CVVS/std/4.1.7 Android/10",
-        "Z-Auth-Token": token
+        "Z-Auth-Token": token,
+        **(extra_headers or {})
     }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()
+    response = upstream_session().get(url, headers=headers)
+    if response.status_code in (200, 304):
+        return response
     else:
         response.raise_for_status()
 
+# =============================================================================
+# UPSTREAM RESPONSE CACHE
+# =============================================================================
+# Students tend to hit "sync" over and over, but grades rarely change. For each
+# student (keyed by login type + student id) we remember when the grades were
+# last downloaded, the HTTP validators (ETag/Last-Modified) and a hash of the
+# parsed payload. A refresh within UPSTREAM_CACHE_TTL seconds does not contact
+# ClasseViva at all; after that we revalidate, and if the payload hash matches
+# the one the session already has, calculate_avr is skipped entirely.
+# Entries live in the grade store, so they are shared by all workers.
+# =============================================================================
+UPSTREAM_CACHE_TTL = int(os.environ.get('UPSTREAM_CACHE_TTL', '120'))
+
+def _student_key(login_type, user_id):
+    """Stable per-student identifier used for upstream caching."""
+    if login_type == 'email':
+        return user_id.strip().lower()
+    return "".join(filter(str.isdigit, user_id))
+
+def _payload_hash(grades_data):
+    """Content hash of a parsed grades payload (independent of key order)."""
+    canonical = dumps_json(grades_data, sort_keys=True)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def fetch_student_grades(login_type, token, user_id, webidentity='', document=None):
+    """
+    Download and aggregate a student's grades, avoiding work whenever possible.
+    
+    Args:
+        login_type: 'userid' (REST API) or 'email' (HTML scraping)
+        token: Z-Auth-Token or PHPSESSID
+        user_id: login identifier of the student
+        webidentity: webidentity cookie (email login only)
+        document: the grade document the caller already has, if any
+    
+    Returns:
+        A new grade document (see build_student_document), or None when the
+        caller's document is still current and nothing was recalculated.
+    """
+    known_hash = document.get('source_hash') if document else None
+    student_key = _student_key(login_type, user_id)
+    cache_key = f"upstream:{login_type}:{student_key}"
+    entry = grade_store.get(cache_key) or {}
+    up_to_date = known_hash is not None and entry.get('content_hash') == known_hash
+    now = time.time()
+    
+    if up_to_date and now - entry.get('fetched_at', 0) < UPSTREAM_CACHE_TTL:
+        logger.info("Upstream cache hit - grades fetched recently, skipping ClasseViva")
+        CACHE_REQUESTS.inc('hit')
+        return None
+    
+    # Only revalidate when the caller has the data the validators refer to
+    conditional = {}
+    if up_to_date:
+        if entry.get('etag'):
+            conditional['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            conditional['If-Modified-Since'] = entry['last_modified']
+    
+    if login_type == 'email':
+        response = fetch_grades_page(token, webidentity, conditional)
+    else:
+        response = fetch_grades_response(student_key, token, conditional)
+    
+    if response.status_code == 304:
+        logger.info("Upstream cache revalidated - grades not modified")
+        CACHE_REQUESTS.inc('revalidated')
+        entry['fetched_at'] = now
+        grade_store.set(cache_key, entry, ttl=GRADE_STORE_TTL)
+        return None
+    
+    grades_data = parse_grades_page(response.text) if login_type == 'email' else response.json()
+    content_hash = _payload_hash(grades_data)
+    grade_store.set(cache_key, {
+        'fetched_at': now,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'content_hash': content_hash
+    }, ttl=GRADE_STORE_TTL)
+    
+    if content_hash == known_hash:
+        logger.info("Upstream payload unchanged - skipping average calculation")
+        CACHE_REQUESTS.inc('unchanged')
+        return None
+    
+    CACHE_REQUESTS.inc('miss')
+    return build_student_document(login_type, user_id, grades_data, content_hash, document)
+
 def _get_effective_grades(grades_list):
     """Compute effective grade values by averaging component grades of the same evaluation.
     
@@ -1606,20 +3114,1492 @@ def _get_effective_grades(grades_list):
     
     return effective
 
-def calculate_avr(grades):
-    grades_avr = {}
-    for grade in grades["grades"]:
-        # ClasseViva API returns periodPos values that are offset by 1 from user-facing period numbers
-        # For example, what users call "Periodo 2" has periodPos=3 in the API
-        # We decrement by 1 to match user expectations
-        period_pos = grade["periodPos"] - 1
-        # ensure period is at least 1
-        if period_pos < 1:
-            period_pos = 1
-        period = str(period_pos)
-        # Determine decimal value: use API value, or fall back to displayValue + MARK_TABLE
-        decimal_value = grade["decimalValue"]
-        if decimal_value is None:
+# =============================================================================
+# GRADE CHANGE LOG (delta sync)
+# =============================================================================
+# Every student has a version number that goes up whenever their grades change
+# on ClasseViva, and a log of the evtIds added, modified or removed by each of
+# the last GRADE_LOG_LENGTH versions. A grade document records the version it
+# was built from, so that:
+#
+# - a sync only patches the grades that changed into the stored document
+#   (merge_grade_changes) instead of building it again
+# - /grades/changes?since=<version> sends a client only those grades
+#
+# The grades known at a version are the rows of a document at that version,
+# so a new payload is diffed against the syncing session's own table (by evtId,
+# comparing whole rows). Payloads without unique evtIds, or syncs that can't be
+# diffed (no document at the latest version), start a new history: clients
+# download the whole tree again. Like the upstream cache, the log is shared by
+# all sessions of a student.
+#
+# The log can expire or be evicted from the grade store and start over, so
+# every copy of it has a random epoch: its versions count up from there, and
+# documents record the epoch they were built in. A document from another epoch
+# is never merged into, and its version never matches one of the new log.
+# =============================================================================
+GRADE_LOG_LENGTH = int(os.environ.get('GRADE_LOG_LENGTH', '50'))
+
+def grade_log_key(login_type, user_id):
+    """Store key of a student's grade change log."""
+    return f"gradelog:{login_type}:{_student_key(login_type, user_id)}"
+
+def diff_grade_rows(table, rows):
+    """Changes from a table to the rows of a new payload, as evtId -> kind."""
+    known = table.event_rows()
+    changes = {event: 'removed' for event in known if event not in rows}
+    for event, row in rows.items():
+        old_row = known.get(event)
+        if old_row is None:
+            changes[event] = 'added'
+        elif old_row != row:
+            changes[event] = 'modified'
+    return changes
+
+def document_log_version(document, log):
+    """Version of a document in a change log, or None if it was built in another epoch of it."""
+    if document is None or log is None or log.get('epoch') is None:
+        return None
+    if document.get('log_epoch') != log['epoch']:
+        return None
+    return document.get('version')
+
+def record_grade_log(log_key, log, content_hash, changes):
+    """
+    Add a version to a student's change log (log is its current value, or
+    None to start a new epoch). changes is evtId -> kind since the current
+    version, or None to start a new history. Returns the new log:
+    {epoch, version, content_hash, history}.
+    """
+    history = []
+    if log is None:
+        # Versions of different epochs must not collide: start at a random one
+        epoch = secrets.randbelow(1 << 40)
+        version = epoch + 1
+    else:
+        epoch = log['epoch']
+        version = log['version'] + 1
+        if changes is not None:
+            history = log['history'] + [[version, {str(event): kind for event, kind in changes.items()}]]
+    log = {
+        'epoch': epoch,
+        'version': version,
+        'content_hash': content_hash,
+        'history': history[-GRADE_LOG_LENGTH:]
+    }
+    grade_store.set(log_key, log, ttl=GRADE_STORE_TTL)
+    return log
+
+def grade_changes_since(log, since, until):
+    """
+    Net changes between two versions of a student's grades, as
+    evtId -> 'added' | 'modified' | 'removed', or None if the log doesn't go
+    back that far.
+    """
+    if since == until:
+        return {}
+    history = [entry for entry in log['history'] if since < entry[0] <= until]
+    if not history or history[0][0] != since + 1 or history[-1][0] != until:
+        return None
+    first, last = {}, {}
+    for _, changes in history:
+        for event, kind in changes.items():
+            first.setdefault(event, kind)
+            last[event] = kind
+    net = {}
+    for event, kind in last.items():
+        if first[event] != 'added':
+            net[int(event)] = 'removed' if kind == 'removed' else 'modified'
+        elif kind != 'removed':
+            net[int(event)] = 'added'
+    return net
+
+def build_student_document(login_type, user_id, grades_data, content_hash, document=None):
+    """
+    Grade document of a new payload of a student, at the version it gets in
+    the student's change log. When document is given and the log covers its
+    version, only the grades changed since are merged into it. New versions
+    are added to the grade history.
+    """
+    rows = {}
+    for event, row in grade_rows(grades_data):
+        if type(event) is not int or event in rows:
+            rows = None
+            break
+        rows[event] = row
+    
+    with AGGREGATION_SECONDS.time():
+        log_key = grade_log_key(login_type, user_id)
+        log = grade_store.get(log_key)
+        if log is not None and 'epoch' not in log:
+            # Written before logs had epochs
+            log = None
+        version = document_log_version(document, log) if rows is not None else None
+        table = document_table(document) if version is not None else None
+        new_version = log is None or log['content_hash'] != content_hash
+        if new_version:
+            # First session of the student to see this payload
+            changes = None
+            if table is not None and log['version'] == version:
+                changes = diff_grade_rows(table, rows)
+            log = record_grade_log(log_key, log, content_hash, changes)
+        
+        new_document = None
+        if table is not None:
+            changes = grade_changes_since(log, version, log['version'])
+            if changes is not None and merge_grade_changes(table, document['views'], changes, rows):
+                logger.info(f"Merged {len(changes)} changed grades into the stored document")
+                new_document = {
+                    'table': table.to_dict(),
+                    'views': document['views'],
+                    'source_hash': content_hash,
+                    'version': log['version'],
+                    'log_epoch': log['epoch'],
+                    'updated_at': time.time()
+                }
+        
+        if new_document is None:
+            new_rows = grade_rows(grades_data) if rows is None else rows.items()
+            new_document = _build_grade_document(new_rows, content_hash, log['version'], log['epoch'])
+    
+    if new_version:
+        record_grade_history(login_type, user_id, new_document)
+    return new_document
+
+# =============================================================================
+# GRADE HISTORY (average time series)
+# =============================================================================
+# Every new version of a student's grades (see GRADE CHANGE LOG) is appended
+# to a separate SQLite file, so that trend charts can show how the averages
+# evolved. A series is one average in one view: the overall average, a
+# period's average or a subject's average in a period. Only the series whose
+# value changed are written, usually three per view.
+#
+#   series     one row per series, with its latest value
+#   snapshots  append-only: every recorded value, with its time
+#   rollups    per series, the day and the week (starting on Monday, in
+#              HISTORY_TIMEZONE): last value, lowest, highest, samples
+#
+# Both point tables are clustered on (series, time), so /grades/history reads
+# a range of one series without scanning anything else. Students appear in
+# the file only as a hash of their login.
+# =============================================================================
+GRADE_HISTORY = os.environ.get('GRADE_HISTORY', 'true').lower() == 'true'
+GRADE_HISTORY_PATH = os.environ.get('GRADE_HISTORY_PATH', 'grade_history.sqlite3')
+HISTORY_TIMEZONE = os.environ.get('HISTORY_TIMEZONE', 'Europe/Rome')
+HISTORY_RESOLUTIONS = ('sync', 'day', 'week')
+
+
+def _history_timezone(name=HISTORY_TIMEZONE):
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f"Unknown HISTORY_TIMEZONE '{name}', history days are in UTC")
+        return timezone.utc
+
+def history_student(login_type, user_id):
+    """Id of a student in the history file: a hash, not the login itself."""
+    return hashlib.sha256(f"{login_type}:{_student_key(login_type, user_id)}".encode('utf-8')).hexdigest()[:32]
+
+def view_series(views):
+    """(view, period, subject) -> (sum, count) of every average of a document."""
+    series = {}
+    for view_name, view in views.items():
+        series[(view_name, '', '')] = (view['sum'], view['count'])
+        for period, period_view in view['periods'].items():
+            series[(view_name, period, '')] = (period_view['sum'], period_view['count'])
+            for subject, bucket in period_view['subjects'].items():
+                series[(view_name, period, subject)] = (bucket['sum'], bucket['count'])
+    return series
+
+
+class GradeHistory:
+    """Append-only SQLite store of average time series, with day/week rollups."""
+
+    def __init__(self, path=GRADE_HISTORY_PATH, tz=None):
+        self.path = path
+        self.tz = tz or _history_timezone()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = SqliteConnection(path)
+        self._db.run(self._create)
+
+    @staticmethod
+    def _create(conn):
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS series ("
+                " id INTEGER PRIMARY KEY,"
+                " student TEXT NOT NULL,"
+                " view TEXT NOT NULL,"
+                " period TEXT NOT NULL,"
+                " subject TEXT NOT NULL,"
+                " count INTEGER NOT NULL,"
+                " avr REAL NOT NULL,"
+                " UNIQUE (student, view, period, subject))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots ("
+                " series INTEGER NOT NULL,"
+                " at REAL NOT NULL,"
+                " count INTEGER NOT NULL,"
+                " avr REAL NOT NULL,"
+                " PRIMARY KEY (series, at)) WITHOUT ROWID"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rollups ("
+                " series INTEGER NOT NULL,"
+                " resolution TEXT NOT NULL,"
+                " bucket TEXT NOT NULL,"
+                " count INTEGER NOT NULL,"
+                " avr REAL NOT NULL,"
+                " low REAL NOT NULL,"
+                " high REAL NOT NULL,"
+                " samples INTEGER NOT NULL,"
+                " PRIMARY KEY (series, resolution, bucket)) WITHOUT ROWID"
+            )
+
+    def buckets(self, at):
+        """Day and week (ISO date of their first day) a timestamp falls in."""
+        day = datetime.fromtimestamp(at, self.tz).date()
+        return day.isoformat(), (day - timedelta(days=day.weekday())).isoformat()
+
+    def record(self, student, views, at=None):
+        """Append the averages of a grade document's views that changed. Returns how many."""
+        at = time.time() if at is None else at
+        return self._db.run(self._record, student, views, at)
+
+    def _record(self, conn, student, views, at):
+        day, week = self.buckets(at)
+        written = 0
+        with conn:
+            known = {(view, period, subject): (series_id, count, avr) for series_id, view, period, subject, count, avr
+                     in conn.execute("SELECT id, view, period, subject, count, avr FROM series WHERE student = ?", (student,))}
+            for key, (total, count) in view_series(views).items():
+                if not count:
+                    continue
+                avr = total / count
+                latest = known.get(key)
+                if latest is None:
+                    series_id = conn.execute(
+                        "INSERT INTO series (student, view, period, subject, count, avr) VALUES (?, ?, ?, ?, ?, ?)",
+                        (student, *key, count, avr)
+                    ).lastrowid
+                elif latest[1] == count and abs(latest[2] - avr) < 1e-9:
+                    continue
+                else:
+                    series_id = latest[0]
+                    conn.execute("UPDATE series SET count = ?, avr = ? WHERE id = ?", (count, avr, series_id))
+                conn.execute("INSERT OR IGNORE INTO snapshots (series, at, count, avr) VALUES (?, ?, ?, ?)",
+                             (series_id, at, count, avr))
+                for resolution, bucket in (('day', day), ('week', week)):
+                    conn.execute(
+                        "INSERT INTO rollups (series, resolution, bucket, count, avr, low, high, samples) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, 1) "
+                        "ON CONFLICT (series, resolution, bucket) DO UPDATE SET"
+                        " count = excluded.count, avr = excluded.avr,"
+                        " low = min(low, excluded.low), high = max(high, excluded.high), samples = samples + 1",
+                        (series_id, resolution, bucket, count, avr, avr, avr)
+                    )
+                written += 1
+        return written
+
+    def points(self, student, view, period, subject, resolution='day', start=None, end=None):
+        """
+        Points of a series between two dates (datetime.date, both included),
+        oldest first, preceded by the last point before start: the value the
+        series had when the range begins.
+        """
+        return self._db.run(self._points, student, view, period, subject, resolution, start, end)
+
+    def _points(self, conn, student, view, period, subject, resolution, start, end):
+        row = conn.execute(
+            "SELECT id FROM series WHERE student = ? AND view = ? AND period = ? AND subject = ?",
+            (student, view, period, subject)
+        ).fetchone()
+        if row is None:
+            return []
+        series_id = row[0]
+        
+        if resolution == 'sync':
+            low = datetime.combine(start, datetime.min.time(), self.tz).timestamp() if start else float('-inf')
+            high = datetime.combine(end + timedelta(days=1), datetime.min.time(), self.tz).timestamp() if end else float('inf')
+            rows = conn.execute(
+                "SELECT at, count, avr FROM snapshots WHERE series = ? AND at >= ? AND at < ? ORDER BY at",
+                (series_id, low, high)
+            ).fetchall()
+            before = conn.execute(
+                "SELECT at, count, avr FROM snapshots WHERE series = ? AND at < ? ORDER BY at DESC LIMIT 1",
+                (series_id, low)
+            ).fetchall()
+            return [{
+                'at': datetime.fromtimestamp(at, self.tz).isoformat(timespec='seconds'),
+                'count': count,
+                'avr': avr
+            } for at, count, avr in before + rows]
+        
+        low = start.isoformat() if start else ''
+        high = end.isoformat() if end else '9999-12-31'
+        rows = conn.execute(
+            "SELECT bucket, count, avr, low, high, samples FROM rollups"
+            " WHERE series = ? AND resolution = ? AND bucket >= ? AND bucket <= ? ORDER BY bucket",
+            (series_id, resolution, low, high)
+        ).fetchall()
+        before = conn.execute(
+            "SELECT bucket, count, avr, low, high, samples FROM rollups"
+            " WHERE series = ? AND resolution = ? AND bucket < ? ORDER BY bucket DESC LIMIT 1",
+            (series_id, resolution, low)
+        ).fetchall()
+        return [{
+            'date': bucket,
+            'count': count,
+            'avr': avr,
+            'min': low_avr,
+            'max': high_avr,
+            'samples': samples
+        } for bucket, count, avr, low_avr, high_avr, samples in before + rows]
+
+grade_history = GradeHistory() if GRADE_HISTORY else None
+
+def record_grade_history(login_type, user_id, document):
+    """Add a new version of a student's grades to the history, if enabled."""
+    if grade_history is None:
+        return
+    try:
+        written = grade_history.record(history_student(login_type, user_id), document['views'])
+        logger.info(f"Recorded {written} changed averages in the grade history")
+    except sqlite3.Error as e:
+        # The history is an extra: a sync must not fail because of it
+        logger.warning(f"Could not record grade history: {e}")
+
+# =============================================================================
+# REQUEST COALESCING (single-flight)
+# =============================================================================
+# Several tabs, or the PWA and the browser, often refresh the same student at
+# the same moment. Refreshes are coalesced per student + token: one request
+# (the leader) talks to ClasseViva and aggregates, the others wait and reuse
+# its result. Within a worker waiters share a Future; across gunicorn workers
+# the leader holds a lease in the grade store and publishes the result there.
+# =============================================================================
+REFRESH_LEASE_TTL = int(os.environ.get('REFRESH_LEASE_TTL', '90'))   # > worst-case upstream time
+REFRESH_RESULT_TTL = int(os.environ.get('REFRESH_RESULT_TTL', '10'))  # coalescing window
+REFRESH_POLL_INTERVAL = 0.2
+
+
+class SingleFlight:
+    """Run func once per key, sharing the result with concurrent callers."""
+
+    def __init__(self, store, lease_ttl=REFRESH_LEASE_TTL, result_ttl=REFRESH_RESULT_TTL):
+        self.store = store
+        self.lease_ttl = lease_ttl
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._local = {}
+
+    def do(self, key, func):
+        """
+        Return func()'s JSON-serializable result, or the result of the call
+        already in progress for key in this or another worker.
+        """
+        with self._lock:
+            future = self._local.get(key)
+            owner = future is None
+            if owner:
+                future = self._local[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            result = self._do_shared(key, func)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._local.pop(key, None)
+
+    def _do_shared(self, key, func):
+        lease_key = f"flight:lease:{key}"
+        result_key = f"flight:result:{key}"
+        deadline = time.time() + self.lease_ttl
+        while True:
+            shared = self.store.get(result_key)
+            if shared is not None:
+                return self._unwrap(shared)
+            if self.store.add(lease_key, os.getpid(), ttl=self.lease_ttl):
+                try:
+                    result = func()
+                    self.store.set(result_key, {'result': result}, ttl=self.result_ttl)
+                    return result
+                except requests.exceptions.HTTPError as e:
+                    # Let waiters fail the same way instead of retrying upstream
+                    status = getattr(e.response, 'status_code', None)
+                    self.store.set(result_key, {'error_status': status}, ttl=self.result_ttl)
+                    raise
+                finally:
+                    self.store.delete(lease_key)
+            if time.time() > deadline:
+                # The leader died without releasing its lease: do the work ourselves
+                logger.warning("Single-flight leader timed out, running request directly")
+                return func()
+            time.sleep(REFRESH_POLL_INTERVAL)
+
+    @staticmethod
+    def _unwrap(shared):
+        if 'error_status' in shared:
+            error_response = requests.models.Response()
+            error_response.status_code = shared['error_status']
+            raise requests.exceptions.HTTPError("Shared upstream request failed", response=error_response)
+        return shared['result']
+
+refresh_flight = SingleFlight(grade_store)
+
+# =============================================================================
+# UPSTREAM AUTHENTICATION (token manager)
+# =============================================================================
+# The ClasseViva session behind a login (REST token or PHPSESSID) lives in the
+# grade store under auth:<sid>, with its expiry, so every worker uses - and
+# renews - the same one:
+#
+# - REST tokens expire at the 'expire' time of rest/v1/auth/login
+# - PHPSESSIDs are assumed to expire EMAIL_SESSION_TTL seconds after their last
+#   use; every call to ClasseViva (background refreshes included) extends them
+# - UPSTREAM_AUTH_RENEW_MARGIN seconds before expiry the next request logs in
+#   again, so requests don't have to fail first
+# - a 401 from ClasseViva renews the session and retries the call once
+# - concurrent renewals of a session are coalesced (single-flight), also
+#   across workers
+#
+# ClasseViva has no refresh tokens, so renewing means logging in again, which
+# needs the password. Keeping it is opt-in (UPSTREAM_AUTH_KEEP_PASSWORD);
+# without it the upstream session is used until ClasseViva rejects it, and
+# then the user logs in again. When enabled, the password is split in two: a
+# random one-time pad in the (signed, not encrypted) session cookie and the
+# password XOR the pad in the store under authsecret:<sid>, which expires
+# with the upstream session and is deleted on logout. Neither half reveals it
+# alone, and a renewal needs both. Requests that write (a refresh, a 401 from
+# ClasseViva) renew on the spot; /grades never logs in itself: when it finds
+# the grades stale and the upstream session expiring, it hands its half to the
+# background refresher for one pass (authpad:<sid>, AUTH_HANDOFF_TTL seconds)
+# and marks the session due.
+# =============================================================================
+UPSTREAM_AUTH_KEEP_PASSWORD = os.environ.get('UPSTREAM_AUTH_KEEP_PASSWORD', 'false').lower() == 'true'
+UPSTREAM_AUTH_RENEW_MARGIN = int(os.environ.get('UPSTREAM_AUTH_RENEW_MARGIN', '300'))
+EMAIL_SESSION_TTL = int(os.environ.get('EMAIL_SESSION_TTL', '1200'))
+REST_TOKEN_TTL = 5400  # when the login response has no usable 'expire'
+AUTH_TOUCH_INTERVAL = 60  # don't rewrite the entry on every use of a PHPSESSID
+AUTH_HANDOFF_TTL = 60  # a few passes of the background refresher
+SECRET_BLOCK = 32  # the sealed password only reveals its length in these steps
+
+
+def auth_key(sid):
+    """Store key of the upstream session of a session."""
+    return f"auth:{sid}"
+
+def auth_secret_key(sid):
+    """Store key of the sealed half of a session's password."""
+    return f"authsecret:{sid}"
+
+def auth_pad_key(sid):
+    """Store key of the pad handed to the background refresher for a renewal."""
+    return f"authpad:{sid}"
+
+def _store_secret(sid, sealed, expires_at):
+    """Keep the sealed password half only as long as the upstream session."""
+    ttl = int(expires_at - time.time())
+    if ttl > 0:
+        grade_store.set(auth_secret_key(sid), sealed, ttl=ttl)
+    else:
+        grade_store.delete(auth_secret_key(sid))
+
+def _seal_secret(password):
+    """Split a password into (pad, sealed), both urlsafe base64."""
+    data = password.encode('utf-8')
+    data = data.ljust(max(SECRET_BLOCK, -(-len(data) // SECRET_BLOCK) * SECRET_BLOCK), b'\0')
+    pad = secrets.token_bytes(len(data))
+    sealed = bytes(a ^ b for a, b in zip(data, pad))
+    return base64.urlsafe_b64encode(pad).decode('ascii'), base64.urlsafe_b64encode(sealed).decode('ascii')
+
+def _unseal_secret(pad, sealed):
+    pad, sealed = base64.urlsafe_b64decode(pad), base64.urlsafe_b64decode(sealed)
+    return bytes(a ^ b for a, b in zip(sealed, pad)).rstrip(b'\0').decode('utf-8')
+
+def _login_expiry(login_type, login_response, now):
+    """Expiry timestamp of the upstream session returned by a login."""
+    if login_type == 'email':
+        return now + EMAIL_SESSION_TTL
+    try:
+        return datetime.fromisoformat(login_response['expire']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return now + REST_TOKEN_TTL
+
+def start_upstream_auth(login_type, user_id, password, login_response):
+    """
+    Remember the upstream session of a fresh login for the current session.
+    Call after new_store_session(), so that the session has its sid.
+    """
+    now = time.time()
+    auth = {
+        'login_type': login_type,
+        'user_id': user_id,
+        'webidentity': login_response.get('webidentity', ''),
+        'token': login_response['token'],
+        'expires_at': _login_expiry(login_type, login_response, now),
+        'used_at': now
+    }
+    grade_store.set(auth_key(flask.session['sid']), auth, ttl=GRADE_STORE_TTL)
+    if UPSTREAM_AUTH_KEEP_PASSWORD:
+        pad, sealed = _seal_secret(password)
+        _store_secret(flask.session['sid'], sealed, auth['expires_at'])
+        flask.session['auth_pad'] = pad
+    else:
+        flask.session.pop('auth_pad', None)
+    flask.session['token'] = auth['token']
+    UPSTREAM_LOGINS.inc(login_type, 'login')
+    return auth
+
+def upstream_auth():
+    """
+    Upstream credentials of the current session ({login_type, user_id,
+    webidentity, token, ...}), renewed first if they are about to expire.
+    Returns None if the session is not logged in.
+    """
+    sid = flask.session.get('sid')
+    if not sid or 'token' not in flask.session:
+        return None
+    auth = grade_store.get(auth_key(sid))
+    if auth is None:
+        # Logged in before the token manager: the cookie holds all there is
+        return {
+            'login_type': flask.session.get('login_type', 'userid'),
+            'user_id': flask.session.get('user_id', ''),
+            'webidentity': flask.session.get('webidentity', ''),
+            'token': flask.session['token']
+        }
+    if upstream_auth_due(auth) and _can_renew(auth):
+        try:
+            auth = renew_upstream_auth(auth, 'expiring')
+        except requests.exceptions.RequestException as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if status == 401 or auth['expires_at'] <= time.time():
+                raise
+            # ClasseViva unreachable: the current session still works for a while
+            logger.warning(f"Upstream session renewal failed, keeping the current one: {e}")
+    return auth
+
+def _can_renew(auth):
+    return UPSTREAM_AUTH_KEEP_PASSWORD and 'expires_at' in auth and 'auth_pad' in flask.session
+
+def renew_upstream_auth(auth, reason):
+    """
+    Log in to ClasseViva again with the session's stored credentials.
+    Concurrent renewals of the session, in any worker, share one login.
+    Raises a 401 HTTPError if the credentials are no longer valid.
+    """
+    if not _can_renew(auth):
+        _raise_session_expired()
+    renewed = _renew_upstream_session(flask.session['sid'], auth, flask.session['auth_pad'], reason)
+    flask.session['token'] = renewed['token']
+    return renewed
+
+def upstream_auth_due(auth):
+    """True if an upstream session is about to expire and should be renewed."""
+    return 'expires_at' in auth and auth['expires_at'] - UPSTREAM_AUTH_RENEW_MARGIN <= time.time()
+
+def _renew_upstream_session(sid, auth, pad, reason):
+    """renew_upstream_auth for any session, given the pad of its password."""
+    stale_token = auth['token']
+
+    def leader():
+        current = grade_store.get(auth_key(sid))
+        if current is None:
+            _raise_session_expired()
+        if current['token'] != stale_token:
+            return current  # renewed by a request that just finished
+        sealed = grade_store.get(auth_secret_key(sid))
+        if sealed is None:
+            # Expired with the upstream session
+            _raise_session_expired()
+        password = _unseal_secret(pad, sealed)
+        try:
+            if current['login_type'] == 'email':
+                login_response = login_email(current['user_id'], password)
+            else:
+                login_response = login(current['user_id'], password)
+        except requests.exceptions.HTTPError as e:
+            if getattr(e.response, 'status_code', None) in (401, 403, 422):
+                # Password changed on ClasseViva: the user has to log in again
+                grade_store.delete(auth_secret_key(sid))
+                _raise_session_expired()
+            raise
+        now = time.time()
+        current.update({
+            'token': login_response['token'],
+            'expires_at': _login_expiry(current['login_type'], login_response, now),
+            'used_at': now
+        })
+        grade_store.set(auth_key(sid), current, ttl=GRADE_STORE_TTL)
+        _store_secret(sid, sealed, current['expires_at'])
+        UPSTREAM_LOGINS.inc(current['login_type'], reason)
+        logger.info(f"Upstream session renewed ({reason})")
+        return current
+
+    return refresh_flight.do(f"auth:{sid}", leader)
+
+def _note_upstream_use(sid, auth):
+    """Extend the assumed lifetime of a PHPSESSID after a successful call."""
+    now = time.time()
+    if auth.get('login_type') != 'email' or 'expires_at' not in auth or now - auth.get('used_at', 0) < AUTH_TOUCH_INTERVAL:
+        return
+    auth['used_at'] = now
+    auth['expires_at'] = now + EMAIL_SESSION_TTL
+    grade_store.set(auth_key(sid), auth, ttl=GRADE_STORE_TTL)
+    sealed = grade_store.get(auth_secret_key(sid))
+    if sealed is not None:
+        _store_secret(sid, sealed, auth['expires_at'])
+
+def call_with_upstream_auth(func):
+    """
+    Return func(auth) called with the current session's upstream credentials.
+    If ClasseViva answers 401, the session is renewed and func is retried once.
+    A session without upstream credentials (such as a cookie from before
+    sessions had a sid) is treated as expired.
+    """
+    auth = upstream_auth()
+    if auth is None:
+        _raise_session_expired()
+    try:
+        result = func(auth)
+    except requests.exceptions.HTTPError as e:
+        if getattr(e.response, 'status_code', None) != 401 or not _can_renew(auth):
+            raise
+        logger.info("Upstream session rejected, renewing it and retrying once")
+        auth = renew_upstream_auth(auth, 'rejected')
+        result = func(auth)
+    _note_upstream_use(flask.session['sid'], auth)
+    return result
+
+def refresh_student_grades(login_type, token, user_id, webidentity, document):
+    """
+    Refresh a session's grades, coalesced with concurrent refreshes of the
+    same student and token.
+    
+    Args:
+        document: the session's current grade document, or None
+    
+    Returns:
+        The new grade document, or None if document is still current.
+    """
+    known_hash = document.get('source_hash') if document else None
+    flight_key = hashlib.sha256(f"{login_type}:{_student_key(login_type, user_id)}:{token}".encode('utf-8')).hexdigest()
+    
+    def leader():
+        new_document = fetch_student_grades(login_type, token, user_id, webidentity, document)
+        # Waiters may hold older grades than the leader: always share a full document
+        return new_document if new_document is not None else document
+    
+    shared = refresh_flight.do(flight_key, leader)
+    if shared is None or shared.get('source_hash') == known_hash:
+        return None
+    return shared
+
+# =============================================================================
+# BACKGROUND REFRESH (stale-while-revalidate)
+# =============================================================================
+# Every worker runs a daemon thread that keeps the grades of recently active
+# sessions fresh, so /grades can always answer from the store immediately and
+# report how old the data is (X-Grades-Age / X-Grades-Stale headers).
+#
+# - a session is "active" for BACKGROUND_ACTIVE_WINDOW seconds after its last request
+# - each active session is refreshed every BACKGROUND_REFRESH_INTERVAL seconds (+/-20% jitter)
+# - at most BACKGROUND_MAX_PER_MINUTE background refreshes run per minute, across all workers
+# - a store lease makes sure only one worker refreshes a given session
+# =============================================================================
+BACKGROUND_REFRESH = os.environ.get('BACKGROUND_REFRESH', 'true').lower() == 'true'
+BACKGROUND_REFRESH_INTERVAL = int(os.environ.get('BACKGROUND_REFRESH_INTERVAL', '900'))
+BACKGROUND_ACTIVE_WINDOW = int(os.environ.get('BACKGROUND_ACTIVE_WINDOW', '1800'))
+BACKGROUND_MAX_PER_MINUTE = int(os.environ.get('BACKGROUND_MAX_PER_MINUTE', '20'))
+BACKGROUND_TICK = 10  # seconds between scheduler passes
+ACTIVE_TOUCH_INTERVAL = 60  # don't rewrite the registry entry on every request
+
+def active_key(sid):
+    """Store key of a session's entry in the active-session registry."""
+    return f"active:{sid}"
+
+def _next_refresh_time(now):
+    return now + BACKGROUND_REFRESH_INTERVAL * random.uniform(0.8, 1.2)
+
+def track_active_session(checked=False, due_now=False):
+    """
+    Register the current session for background refreshes (or extend it).
+    
+    Args:
+        checked: the grades were just confirmed current with ClasseViva
+        due_now: ask the scheduler to refresh this session on its next pass
+    
+    Returns:
+        The registry entry, or None if the session is not logged in.
+    """
+    sid = flask.session.get('sid')
+    if not sid or 'token' not in flask.session:
+        return None
+    key = active_key(sid)
+    now = time.time()
+    entry = grade_store.get(key) or {}
+    if not (checked or due_now or 'token' not in entry or now - entry.get('last_seen', 0) > ACTIVE_TOUCH_INTERVAL):
+        return entry
+    entry.update({
+        'login_type': flask.session.get('login_type', 'userid'),
+        'token': flask.session['token'],
+        'user_id': flask.session.get('user_id', ''),
+        'webidentity': flask.session.get('webidentity', ''),
+        'last_seen': now
+    })
+    if checked:
+        entry['checked_at'] = now
+    if checked or 'next_refresh' not in entry:
+        entry['next_refresh'] = _next_refresh_time(now)
+    if due_now:
+        entry['next_refresh'] = now
+    grade_store.set(key, entry, ttl=BACKGROUND_ACTIVE_WINDOW)
+    return entry
+
+def staleness_headers(document):
+    """Freshness metadata of the current session's grades, as response headers."""
+    entry = track_active_session()
+    checked_at = (entry or {}).get('checked_at') or document.get('updated_at') or time.time()
+    age = max(0, int(time.time() - checked_at))
+    stale = age > BACKGROUND_REFRESH_INTERVAL
+    if stale and entry is not None:
+        # The background refresh needs a live upstream session: let it log in
+        # again if needed, rather than making this read wait for ClasseViva
+        sid = flask.session['sid']
+        auth = grade_store.get(auth_key(sid))
+        if BACKGROUND_REFRESH and auth is not None and upstream_auth_due(auth) and _can_renew(auth):
+            grade_store.set(auth_pad_key(sid), flask.session['auth_pad'], ttl=AUTH_HANDOFF_TTL)
+        if entry.get('next_refresh', 0) > time.time():
+            track_active_session(due_now=True)
+    return {
+        'X-Grades-Checked-At': datetime.fromtimestamp(checked_at, timezone.utc).isoformat(timespec='seconds'),
+        'X-Grades-Age': str(age),
+        'X-Grades-Stale': 'true' if stale else 'false'
+    }
+
+
+class BackgroundRefresher:
+    """Per-worker daemon thread refreshing the grades of active sessions."""
+
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """Start the thread in this process if needed (gunicorn forks after import)."""
+        pid = os.getpid()
+        if not BACKGROUND_REFRESH or self._pid == pid:
+            return
+        with self._lock:
+            if self._pid != pid:
+                self._pid = pid
+                threading.Thread(target=self._run, name='grade-refresher', daemon=True).start()
+                logger.info(f"Background refresher started in worker {pid}")
+
+    def _run(self):
+        while True:
+            time.sleep(BACKGROUND_TICK * random.uniform(0.5, 1.5))
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Background refresh pass failed: {e}", exc_info=True)
+
+    def tick(self):
+        """Refresh every active session that is due, within the global rate cap."""
+        now = time.time()
+        for key in grade_store.keys('active:'):
+            entry = grade_store.get(key)
+            if not entry or entry.get('next_refresh', 0) > now:
+                continue
+            sid = key[len('active:'):]
+            lease_key = f"bg:lease:{sid}"
+            if not grade_store.add(lease_key, os.getpid(), ttl=REFRESH_LEASE_TTL):
+                continue  # another worker has it
+            try:
+                if grade_store.incr(f"bg:rate:{int(now // 60)}", ttl=120) > BACKGROUND_MAX_PER_MINUTE:
+                    logger.info("Background refresh rate cap reached, waiting for the next minute")
+                    return
+                self.refresh_session(sid, entry)
+            finally:
+                grade_store.delete(lease_key)
+
+    def refresh_session(self, sid, entry):
+        document = grade_store.get(grades_key(sid))
+        if document is None:
+            grade_store.delete(active_key(sid))
+            return
+        # The upstream session as last renewed by any worker
+        auth = grade_store.get(auth_key(sid))
+        if auth is None:
+            auth = entry  # logged in before the token manager
+        elif upstream_auth_due(auth):
+            auth = self.renew_auth(sid, auth)
+        new_document = None
+        if auth is not None:
+            try:
+                new_document = refresh_student_grades(auth['login_type'], auth['token'], auth['user_id'],
+                                                      auth.get('webidentity', ''), document)
+            except requests.exceptions.HTTPError as e:
+                if getattr(e.response, 'status_code', None) != 401:
+                    logger.warning(f"Background refresh failed: {e}")
+                elif auth is entry:
+                    # Token expired: stop refreshing until the user logs in again
+                    grade_store.delete(active_key(sid))
+                    return
+                else:
+                    # Renewed once the user's next request hands over its pad
+                    auth['expires_at'] = 0
+                    grade_store.set(auth_key(sid), auth, ttl=GRADE_STORE_TTL)
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Background refresh failed: {e}")
+            else:
+                entry['checked_at'] = time.time()
+                # Keeps an email session alive between the user's visits
+                _note_upstream_use(sid, auth)
+        
+        if new_document is not None:
+            grade_store.set(grades_key(sid), new_document, ttl=GRADE_STORE_TTL)
+            publish_grade_document(sid, new_document)
+        
+        # Keep the entry only until the user's activity window runs out
+        now = time.time()
+        remaining = entry.get('last_seen', 0) + BACKGROUND_ACTIVE_WINDOW - now
+        if remaining > 0:
+            entry['next_refresh'] = _next_refresh_time(now)
+            grade_store.set(active_key(sid), entry, ttl=remaining)
+
+    def renew_auth(self, sid, auth):
+        """
+        Renew an expiring upstream session with the pad a request of the user
+        handed over (see staleness_headers). Returns the session to refresh
+        with, or None if there is no usable one.
+        """
+        pad = grade_store.get(auth_pad_key(sid))
+        if pad is not None:
+            grade_store.delete(auth_pad_key(sid))
+            try:
+                return _renew_upstream_session(sid, auth, pad, 'background')
+            except requests.exceptions.RequestException as e:
+                logger.info(f"Upstream session not renewed: {e}")
+        return auth if auth['expires_at'] > time.time() else None
+
+background_refresher = BackgroundRefresher()
+
+@app.before_request
+def start_background_refresher():
+    background_refresher.ensure_started()
+
+# =============================================================================
+# LIVE GRADE UPDATES (server-sent events)
+# =============================================================================
+# /grades/stream keeps a connection open and sends a 'grades' event whenever
+# the grades tree of the session changes: after a refresh by the background
+# refresher or by any tab, in any worker, or when the blue-grade preference is
+# toggled. The event id is the ETag the new tree has on /grades, so a client
+# reconnecting with Last-Event-ID only gets an event if it missed a change; the
+# data has the version to ask /grades/changes for.
+#
+# Every save publishes the session's new state (source hash, version, view) in
+# the store under stream:<sid> and wakes the session's streams in the same
+# worker right away. Each worker has one hub: a single thread reads the state
+# of the sessions it has streams for every STREAM_POLL_INTERVAL seconds, to see
+# changes made by other workers, and fans it out to all of their streams
+# (several tabs, the PWA and the browser).
+#
+# Under gevent workers an open stream is a greenlet waiting on a queue. Other
+# worker classes would spend a thread, or a whole sync worker, per connection:
+# there the stream sends the current state and closes, and clients reconnect
+# after STREAM_FALLBACK_RETRY seconds.
+# =============================================================================
+STREAM_HEARTBEAT = int(os.environ.get('STREAM_HEARTBEAT', '15'))
+STREAM_POLL_INTERVAL = float(os.environ.get('STREAM_POLL_INTERVAL', '2'))
+STREAM_MAX_AGE = int(os.environ.get('STREAM_MAX_AGE', '600'))  # < BACKGROUND_ACTIVE_WINDOW, see below
+STREAM_FALLBACK_RETRY = int(os.environ.get('STREAM_FALLBACK_RETRY', '60'))
+STREAM_RETRY = 3  # seconds before a client reconnects to a stream that ended
+
+def stream_key(sid):
+    """Store key of the published grade state of a session."""
+    return f"stream:{sid}"
+
+class GradeStreamHub:
+    """Per-worker fan-out of grade states to the open streams of each session."""
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._streams = {}  # sid -> set of queues, one per open stream
+        self._states = {}   # sid -> last state handed to its streams
+        self._pid = None
+
+    def subscribe(self, sid):
+        """Queue receiving the new states of a session; pass it to unsubscribe when done."""
+        self._ensure_started()
+        stream = queue.Queue()
+        with self._lock:
+            self._streams.setdefault(sid, set()).add(stream)
+        return stream
+
+    def unsubscribe(self, sid, stream):
+        with self._lock:
+            streams = self._streams.get(sid, set())
+            streams.discard(stream)
+            if not streams:
+                self._streams.pop(sid, None)
+                self._states.pop(sid, None)
+
+    def publish(self, sid, **changes):
+        """
+        Update the published state of a session (source_hash, version, view)
+        and notify its streams: in this worker now, in the others on their
+        next poll.
+        """
+        state = dict(self.store.get(stream_key(sid)) or {}, **changes)
+        self.store.set(stream_key(sid), state, ttl=GRADE_STORE_TTL)
+        self._dispatch(sid, state)
+
+    def poll(self):
+        """Hand the published state of every session with streams to them, if it changed."""
+        with self._lock:
+            sids = list(self._streams)
+        for sid in sids:
+            state = self.store.get(stream_key(sid))
+            if state is not None:
+                self._dispatch(sid, state)
+
+    def _dispatch(self, sid, state):
+        with self._lock:
+            if sid not in self._streams or self._states.get(sid) == state:
+                return
+            self._states[sid] = state
+            streams = list(self._streams[sid])
+        for stream in streams:
+            stream.put(state)
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid != pid:
+                self._pid = pid
+                threading.Thread(target=self._run, name='grade-stream-hub', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(STREAM_POLL_INTERVAL)
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"Grade stream poll failed: {e}", exc_info=True)
+
+grade_stream_hub = GradeStreamHub(grade_store)
+
+def publish_grade_document(sid, document):
+    """Tell the streams of a session that it has a new grade document."""
+    source = document.get('source_hash') or _payload_hash(document['table'])
+    grade_stream_hub.publish(sid, source_hash=source, version=document.get('version'))
+
+def grade_stream_events(sid, state, view_name, last_id, cooperative):
+    """
+    Server-sent events of a session's stream, starting from its current state
+    ({source_hash, version}): a 'grades' event whenever the tree's ETag stops
+    matching last_id, and a comment every STREAM_HEARTBEAT seconds so that
+    proxies keep the connection open and closed ones are noticed.
+    """
+    stream = grade_stream_hub.subscribe(sid) if cooperative else None
+    try:
+        yield f"retry: {(STREAM_RETRY if cooperative else STREAM_FALLBACK_RETRY) * 1000}\n\n"
+        # Clients come back before their session leaves the background refresher
+        deadline = time.time() + STREAM_MAX_AGE
+        while True:
+            if state is not None and 'source_hash' in state:
+                view_name = state.get('view') or view_name
+                event_id = view_etag(state['source_hash'], view_name, 'grades', '*')
+                if event_id != last_id:
+                    last_id = event_id
+                    data = dumps_json({'version': state.get('version'), 'etag': f'W/"{event_id}"'})
+                    yield f"id: {event_id}\nevent: grades\ndata: {data}\n\n"
+            remaining = deadline - time.time()
+            if stream is None or remaining <= 0:
+                return
+            try:
+                state = stream.get(timeout=min(STREAM_HEARTBEAT, remaining))
+            except queue.Empty:
+                state = None
+                yield ": ping\n\n"
+    finally:
+        if stream is not None:
+            grade_stream_hub.unsubscribe(sid, stream)
+
+# =============================================================================
+# COMPACT GRADE TABLE
+# =============================================================================
+# A student's grades are kept as parallel columns (one row per grade) instead
+# of one 7-key dict per grade: values live in an array('d'), and every text
+# field (subject, date, teacher, component, notes...) is an index into a single
+# table of interned strings, so each teacher name or component is stored once.
+# An index maps period -> subject -> row numbers. The stored document holds
+# the table in this form; the usual JSON tree is only built when a route sends
+# it to the frontend (to_grades_avr), and it is identical to the old one.
+# =============================================================================
+
+class GradeTable:
+    """Columnar table of a student's grades with interned strings."""
+    __slots__ = ('_strings', '_string_ids', 'period', 'subject', 'value', 'display',
+                 'date', 'notes', 'component', 'teacher', 'flags', 'event', 'index', 'subject_periods')
+
+    TEXT_COLUMNS = ('period', 'subject', 'display', 'date', 'notes', 'component', 'teacher')
+    SUBJECT_FIELDS = ('count', 'avr', 'grades')  # keys of a subject in the grades tree
+    BLUE = 1
+    INTEGER = 2  # the upstream value was an int, give it back as one
+
+    def __init__(self):
+        self._strings = []
+        self._string_ids = {}  # text -> id, in id order
+        for column in self.TEXT_COLUMNS:
+            setattr(self, column, array('I'))
+        self.value = array('d')
+        self.flags = array('B')
+        self.event = array('q')  # upstream evtId, identifies a grade across syncs
+        self.index = {}  # period -> subject -> array('I') of row numbers
+        self.subject_periods = {}  # subject -> periods it has grades in
+
+    def __len__(self):
+        return len(self.value)
+
+    @property
+    def strings(self):
+        """Interned strings, indexed by the ids stored in the text columns."""
+        if len(self._strings) != len(self._string_ids):
+            self._strings = list(self._string_ids)
+        return self._strings
+
+    def intern(self, text):
+        """Id of text in the string table, adding it if needed."""
+        ids = self._string_ids
+        return ids.setdefault(text, len(ids))
+
+    def append(self, period, subject, value, display='', date='', notes='', component='', teacher='', is_blue=False,
+               event=0):
+        """Add a grade, returning its row number."""
+        row = len(self.value)
+        # intern() inlined: this runs once per grade of every login and refresh
+        ids = self._string_ids
+        self.period.append(ids.setdefault(period, len(ids)))
+        self.subject.append(ids.setdefault(subject, len(ids)))
+        self.value.append(value)
+        self.display.append(ids.setdefault(display, len(ids)))
+        self.date.append(ids.setdefault(date, len(ids)))
+        self.notes.append(ids.setdefault(notes, len(ids)))
+        self.component.append(ids.setdefault(component, len(ids)))
+        self.teacher.append(ids.setdefault(teacher, len(ids)))
+        self.flags.append((self.BLUE if is_blue else 0) | (self.INTEGER if type(value) is int else 0))
+        self.event.append(event)
+        self._index_row(period, subject, row)
+        return row
+
+    def replace(self, row, period, subject, value, display='', date='', notes='', component='', teacher='',
+                is_blue=False, event=0):
+        """Overwrite a grade in place; it must stay in the same period and subject."""
+        intern = self.intern
+        self.value[row] = value
+        self.display[row] = intern(display)
+        self.date[row] = intern(date)
+        self.notes[row] = intern(notes)
+        self.component[row] = intern(component)
+        self.teacher[row] = intern(teacher)
+        self.flags[row] = (self.BLUE if is_blue else 0) | (self.INTEGER if type(value) is int else 0)
+        self.event[row] = event
+
+    def delete(self, rows):
+        """Remove a set of row numbers; the rows after them are renumbered."""
+        keep = [row for row in range(len(self.value)) if row not in rows]
+        for column in self.TEXT_COLUMNS + ('value', 'flags', 'event'):
+            values = getattr(self, column)
+            setattr(self, column, array(values.typecode, [values[row] for row in keep]))
+        self._reindex()
+
+    def _reindex(self):
+        self.index = {}
+        self.subject_periods = {}
+        strings = self.strings
+        for row, (period, subject) in enumerate(zip(self.period, self.subject)):
+            self._index_row(strings[period], strings[subject], row)
+
+    def rows_by_event(self):
+        """evtId -> row number."""
+        return {event: row for row, event in enumerate(self.event)}
+
+    def event_rows(self):
+        """evtId -> row in the grade_rows() format, to compare with a new payload."""
+        strings = self.strings
+        columns = [[strings[i] for i in getattr(self, column)] for column in self.TEXT_COLUMNS]
+        integer_flag, blue_flag = self.INTEGER, self.BLUE
+        values = [int(value) if flags & integer_flag else value for value, flags in zip(self.value, self.flags)]
+        blue = [bool(flags & blue_flag) for flags in self.flags]
+        period, subject, display, date, notes, component, teacher = columns
+        return dict(zip(self.event, zip(period, subject, values, display, date, notes, component, teacher, blue)))
+
+    def location(self, row):
+        """(period, subject) of a row."""
+        strings = self.strings
+        return strings[self.period[row]], strings[self.subject[row]]
+
+    def _index_row(self, period, subject, row):
+        subjects = self.index.get(period)
+        if subjects is None:
+            subjects = self.index[period] = {}
+        rows = subjects.get(subject)
+        if rows is None:
+            rows = subjects[subject] = array('I')
+            self.subject_periods.setdefault(subject, []).append(period)
+        rows.append(row)
+
+    def has(self, period, subject=None):
+        """Whether the period (and subject in it, if given) has any grade."""
+        subjects = self.index.get(period)
+        if subjects is None:
+            return False
+        return subject is None or subject in subjects
+
+    def has_subject(self, subject):
+        """Whether the subject has grades in any period."""
+        return subject in self.subject_periods
+
+    def is_blue(self, row):
+        return bool(self.flags[row] & self.BLUE)
+
+    def decimal_value(self, row):
+        value = self.value[row]
+        return int(value) if self.flags[row] & self.INTEGER else value
+
+    def grade(self, row):
+        """A row in the grade dict format used by the JSON API."""
+        strings = self.strings
+        return {
+            "evtId": self.event[row],
+            "decimalValue": self.decimal_value(row),
+            "displayValue": strings[self.display[row]],
+            "evtDate": strings[self.date[row]],
+            "notesForFamily": strings[self.notes[row]],
+            "componentDesc": strings[self.component[row]],
+            "teacherName": strings[self.teacher[row]],
+            "isBlue": self.is_blue(row)
+        }
+
+    def grades(self, period, subject):
+        """Grade dicts of a subject in a period, in upstream order."""
+        rows = self.index.get(period, {}).get(subject, ())
+        return [self.grade(row) for row in rows]
+
+    def to_grades_avr(self, view, fields=None):
+        """
+        Build the JSON grades tree, with the averages of a precomputed view.
+        fields, if given, keeps only those SUBJECT_FIELDS in every subject.
+        """
+        with_grades = fields is None or 'grades' in fields
+        if with_grades:
+            # Strings are resolved once per table rather than once per grade
+            strings = self.strings
+            value, flags, event = self.value, self.flags, self.event
+            display, date, notes = [strings[i] for i in self.display], [strings[i] for i in self.date], [strings[i] for i in self.notes]
+            component, teacher = [strings[i] for i in self.component], [strings[i] for i in self.teacher]
+            blue_flag, integer_flag = self.BLUE, self.INTEGER
+        
+        grades_avr = {}
+        for period, subjects in self.index.items():
+            period_view = view['periods'].get(period)
+            period_tree = grades_avr[period] = {}
+            for subject, rows in subjects.items():
+                bucket = period_view['subjects'].get(subject) if period_view else None
+                node = period_tree[subject] = {"count": len(rows), "avr": _view_avr(bucket)}
+                if with_grades:
+                    node["grades"] = [{
+                        "evtId": event[row],
+                        "decimalValue": int(value[row]) if flags[row] & integer_flag else value[row],
+                        "displayValue": display[row],
+                        "evtDate": date[row],
+                        "notesForFamily": notes[row],
+                        "componentDesc": component[row],
+                        "teacherName": teacher[row],
+                        "isBlue": bool(flags[row] & blue_flag)
+                    } for row in rows]
+                if fields is not None:
+                    period_tree[subject] = {key: node[key] for key in self.SUBJECT_FIELDS if key in fields}
+            period_tree["period_avr"] = _view_avr(period_view)
+        grades_avr["all_avr"] = _view_avr(view)
+        return grades_avr
+
+    def to_subject_slice(self, subject, view):
+        """
+        The grades tree cut down to one subject: only the periods it has grades
+        in, each with that subject and the period average, plus the overall one.
+        """
+        grades_avr = {}
+        for period in self.subject_periods.get(subject, ()):
+            period_view = view['periods'].get(period)
+            bucket = period_view['subjects'].get(subject) if period_view else None
+            rows = self.index[period][subject]
+            grades_avr[period] = {
+                subject: {
+                    "count": len(rows),
+                    "avr": _view_avr(bucket),
+                    "grades": [self.grade(row) for row in rows]
+                },
+                "period_avr": _view_avr(period_view)
+            }
+        grades_avr["all_avr"] = _view_avr(view)
+        return grades_avr
+
+    def to_dict(self):
+        """JSON-friendly form of the table, for the grade store."""
+        data = {'strings': self.strings, 'value': self.value.tolist(), 'flags': self.flags.tolist(),
+                'event': self.event.tolist()}
+        for column in self.TEXT_COLUMNS:
+            data[column] = getattr(self, column).tolist()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        table = cls()
+        table._strings = data['strings']
+        table._string_ids = {text: i for i, text in enumerate(table._strings)}
+        for column in cls.TEXT_COLUMNS:
+            setattr(table, column, array('I', data[column]))
+        table.value = array('d', data['value'])
+        table.flags = array('B', data['flags'])
+        # Tables stored before evtIds were kept have none
+        table.event = array('q', data.get('event') or [0] * len(table.value))
+        table._reindex()
+        return table
+
+    @classmethod
+    def from_grades_avr(cls, grades_avr):
+        """Convert a grades tree (documents stored before the table existed)."""
+        table = cls()
+        for period, subjects in grades_avr.items():
+            if period == 'all_avr':
+                continue
+            for subject, subject_data in subjects.items():
+                if subject == 'period_avr':
+                    continue
+                for g in subject_data.get('grades', []):
+                    table.append(period, subject, g['decimalValue'], g.get('displayValue', ''),
+                                 g.get('evtDate', ''), g.get('notesForFamily', ''),
+                                 g.get('componentDesc', ''), g.get('teacherName', ''), g.get('isBlue', False),
+                                 g.get('evtId', 0))
+        return table
+
+# =============================================================================
+# AVERAGE AGGREGATION ENGINE
+# =============================================================================
+# Subject, period and overall averages are all averages of *effective* grades
+# (see _get_effective_grades). GradeAggregator keeps running sums and counts
+# per component group, subject, period and overall, so the whole tree is
+# aggregated in a single pass over the grades, and adding or removing one
+# grade later only touches its own group: O(1) instead of rescanning.
+# =============================================================================
+
+class SubjectAggregate:
+    """Running effective-grade sum/count of one subject in one period."""
+    __slots__ = ('groups', 'effective_sum', 'effective_count')
+
+    def __init__(self):
+        self.groups = {}  # evtDate -> [sum, count] of component grades
+        self.effective_sum = 0.0
+        self.effective_count = 0
+
+    def add(self, value, component_key=None):
+        """Add a grade, returning the (sum, count) change of the effective grades."""
+        if component_key is None:
+            self.effective_sum += value
+            self.effective_count += 1
+            return value, 1
+        group = self.groups.get(component_key)
+        if group is None:
+            self.groups[component_key] = [value, 1]
+            self.effective_sum += value
+            self.effective_count += 1
+            return value, 1
+        old_mean = group[0] / group[1]
+        group[0] += value
+        group[1] += 1
+        delta = group[0] / group[1] - old_mean
+        self.effective_sum += delta
+        return delta, 0
+
+    def remove(self, value, component_key=None):
+        """Remove a grade, returning the (sum, count) change of the effective grades."""
+        if component_key is None:
+            delta = (-value, -1)
+        else:
+            group = self.groups[component_key]
+            old_mean = group[0] / group[1]
+            if group[1] == 1:
+                del self.groups[component_key]
+                delta = (-old_mean, -1)
+            else:
+                group[0] -= value
+                group[1] -= 1
+                delta = (group[0] / group[1] - old_mean, 0)
+        self.effective_sum += delta[0]
+        self.effective_count += delta[1]
+        return delta
+
+    @property
+    def average(self):
+        return self.effective_sum / self.effective_count if self.effective_count else 0
+
+
+class GradeAggregator:
+    """Effective-grade sums and counts per subject, per period and overall."""
+
+    def __init__(self):
+        self.subjects = {}  # (period, subject) -> SubjectAggregate
+        self.periods = {}   # period -> [sum, count]
+        self.total = 0.0
+        self.count = 0
+
+    def _apply(self, period, delta):
+        bucket = self.periods.setdefault(period, [0.0, 0])
+        bucket[0] += delta[0]
+        bucket[1] += delta[1]
+        self.total += delta[0]
+        self.count += delta[1]
+
+    def add(self, period, subject, value, component_key=None):
+        aggregate = self.subjects.get((period, subject))
+        if aggregate is None:
+            aggregate = self.subjects[(period, subject)] = SubjectAggregate()
+        self._apply(period, aggregate.add(value, component_key))
+
+    def remove(self, period, subject, value, component_key=None):
+        self._apply(period, self.subjects[(period, subject)].remove(value, component_key))
+
+    def _load(self, period, subject, value, component_key=None):
+        """Bulk-loading add: only the subject is updated, call _sum_up() when done."""
+        aggregate = self.subjects.get((period, subject))
+        if aggregate is None:
+            aggregate = self.subjects[(period, subject)] = SubjectAggregate()
+        aggregate.add(value, component_key)
+
+    def _sum_up(self):
+        """Derive period and overall sums from the subjects (O(subjects))."""
+        self.periods = {}
+        self.total = 0.0
+        self.count = 0
+        for (period, _), aggregate in self.subjects.items():
+            self._apply(period, (aggregate.effective_sum, aggregate.effective_count))
+
+    def subject_avr(self, period, subject):
+        aggregate = self.subjects.get((period, subject))
+        return aggregate.average if aggregate else 0
+
+    def period_avr(self, period):
+        total, count = self.periods.get(period, (0, 0))
+        return total / count if count else 0
+
+    def overall_avr(self):
+        return self.total / self.count if self.count else 0
+
+    @classmethod
+    def from_grades_avr(cls, grades_avr, exclude_blue=False):
+        """Aggregate an existing grades tree in one pass."""
+        aggregator = cls()
+        for period, subjects in grades_avr.items():
+            if period == 'all_avr':
+                continue
+            for subject, subject_data in subjects.items():
+                if subject == 'period_avr':
+                    continue
+                aggregate = aggregator.subjects[(period, subject)] = SubjectAggregate()
+                add = aggregate.add
+                for g in subject_data.get('grades', []):
+                    if exclude_blue and g.get('isBlue', False):
+                        continue
+                    add(g['decimalValue'], g['evtDate'] if g.get('componentDesc') else None)
+        aggregator._sum_up()
+        return aggregator
+
+    def apply_to(self, grades_avr):
+        """Write subject, period and overall averages into a grades tree."""
+        for period, subjects in grades_avr.items():
+            if period == 'all_avr':
+                continue
+            for subject in subjects:
+                if subject != 'period_avr':
+                    subjects[subject]["avr"] = self.subject_avr(period, subject)
+            subjects["period_avr"] = self.period_avr(period)
+        grades_avr["all_avr"] = self.overall_avr()
+
+    def to_view(self):
+        """JSON-friendly snapshot of all sums and counts (see GradeTable.to_grades_avr)."""
+        view = {'sum': self.total, 'count': self.count, 'periods': {}}
+        for period, (total, count) in self.periods.items():
+            view['periods'][period] = {'sum': total, 'count': count, 'subjects': {}}
+        for (period, subject), aggregate in self.subjects.items():
+            view['periods'][period]['subjects'][subject] = {
+                'sum': aggregate.effective_sum,
+                'count': aggregate.effective_count
+            }
+        return view
+
+
+# Precomputed aggregate views stored next to every grade table. Toggling the
+# blue-grade preference just selects the other view, no grade is rescanned.
+VIEW_WITH_BLUE = 'with_blue'
+VIEW_WITHOUT_BLUE = 'without_blue'
+
+def _view_avr(bucket):
+    """Average of a view bucket ({'sum', 'count'}), 0 if missing or empty."""
+    if not bucket or not bucket['count']:
+        return 0
+    return bucket['sum'] / bucket['count']
+
+def view_subject(view, period, subject):
+    """Sum/count bucket of a subject in a period, or None."""
+    period_view = view['periods'].get(period)
+    return period_view['subjects'].get(subject) if period_view else None
+
+def calculate_avr(grades):
+    document = build_grade_document(grades)
+    return document_table(document).to_grades_avr(document['views'][VIEW_WITH_BLUE])
+
+def build_grade_document(grades, source_hash=None):
+    """
+    Build the stored grade document from a ClasseViva grades payload.
+    
+    A single pass produces the grade table and both precomputed views,
+    with and without blue grades.
+    """
+    with AGGREGATION_SECONDS.time():
+        return _build_grade_document(grade_rows(grades), source_hash)
+
+def grade_rows(grades):
+    """
+    Yield (evtId, row) for every usable grade of a payload, in upstream order,
+    where row holds the GradeTable.append() arguments.
+    """
+    for grade in grades["grades"]:
+        # ClasseViva API returns periodPos values that are offset by 1 from user-facing period numbers
+        # For example, what users call "Periodo 2" has periodPos=3 in the API
+        # We decrement by 1 to match user expectations
+        period_pos = grade["periodPos"] - 1
+        # ensure period is at least 1
+        if period_pos < 1:
+            period_pos = 1
+        # Determine decimal value: use API value, or fall back to displayValue + MARK_TABLE
+        decimal_value = grade["decimalValue"]
+        if decimal_value is None:
             display_value = grade.get("displayValue", "")
             decimal_value = MARK_TABLE.get(display_value, None)
             if decimal_value is not None:
@@ -1630,50 +4610,119 @@ def calculate_avr(grades):
         if decimal_value is None:
             continue
         # Take all grades from Spaggiari as-is without filtering
-        if period not in grades_avr:
-            grades_avr[period] = {}
-        if grades_avr[period].get(grade["subjectDesc"]) is None:
-            grades_avr[period][grade["subjectDesc"]] = {"count": 0, "avr": 0, "grades": []}
-        
-        grades_avr[period][grade["subjectDesc"]]["count"] += 1
-        
-        # append grade as a dictionary with additional fields
-        grades_avr[period][grade["subjectDesc"]]["grades"].append({
-            "decimalValue": decimal_value,
-            "displayValue": grade.get("displayValue", ""),
-            "evtDate": grade["evtDate"],
-            "notesForFamily": grade["notesForFamily"],
-            "componentDesc": grade["componentDesc"],
-            "teacherName": grade["teacherName"],
-            "isBlue": grade["color"] == "blue"
-        })
+        yield grade.get("evtId"), (str(period_pos), grade["subjectDesc"], decimal_value, grade.get("displayValue", ""),
+                                   grade["evtDate"], grade["notesForFamily"], grade["componentDesc"],
+                                   grade["teacherName"], grade["color"] == "blue")
+
+def _build_grade_document(rows, source_hash, version=None, log_epoch=None):
+    table = GradeTable()
+    aggregator = GradeAggregator()
+    aggregator_no_blue = GradeAggregator()
+    append = table.append
+    for event, row in rows:
+        period, subject, decimal_value, _, date, _, component, _, is_blue = row
+        append(*row, event=event if type(event) is int else 0)
+        
+        # Component grades (same evtDate, non-empty componentDesc within a subject) are
+        # averaged into a single effective grade, so that multi-component evaluations
+        # (e.g., Scritto + Orale) count as one grade in every average.
+        component_key = date if component else None
+        aggregator._load(period, subject, decimal_value, component_key)
+        if not is_blue:
+            aggregator_no_blue._load(period, subject, decimal_value, component_key)
+    
+    aggregator._sum_up()
+    aggregator_no_blue._sum_up()
+    
+    return {
+        'table': table.to_dict(),
+        'views': {
+            VIEW_WITH_BLUE: aggregator.to_view(),
+            VIEW_WITHOUT_BLUE: aggregator_no_blue.to_view()
+        },
+        'source_hash': source_hash,
+        'version': version,
+        'log_epoch': log_epoch,
+        'updated_at': time.time()
+    }
+
+# -----------------------------------------------------------------------------
+# Incremental updates
+# -----------------------------------------------------------------------------
+# Most syncs add or change one grade. Instead of rebuilding the document, the
+# changed rows are patched into the table and only the subjects they belong to
+# are aggregated again; period and overall sums are re-derived from the
+# subject buckets of the view.
+# -----------------------------------------------------------------------------
+
+def update_view_subjects(view, table, pairs, exclude_blue=False):
+    """Recompute the (period, subject) buckets of a view from the table."""
+    strings = table.strings
+    for period, subject in pairs:
+        aggregate = SubjectAggregate()
+        for row in table.index.get(period, {}).get(subject, ()):
+            if exclude_blue and table.is_blue(row):
+                continue
+            aggregate.add(table.value[row], strings[table.date[row]] if strings[table.component[row]] else None)
+        period_view = view['periods'].setdefault(period, {'sum': 0.0, 'count': 0, 'subjects': {}})
+        if aggregate.effective_count:
+            period_view['subjects'][subject] = {'sum': aggregate.effective_sum, 'count': aggregate.effective_count}
+        else:
+            period_view['subjects'].pop(subject, None)
+    for period in {period for period, _ in pairs}:
+        period_view = view['periods'][period]
+        if not period_view['subjects']:
+            del view['periods'][period]
+            continue
+        period_view['sum'] = sum(bucket['sum'] for bucket in period_view['subjects'].values())
+        period_view['count'] = sum(bucket['count'] for bucket in period_view['subjects'].values())
+    view['sum'] = sum(period_view['sum'] for period_view in view['periods'].values())
+    view['count'] = sum(period_view['count'] for period_view in view['periods'].values())
+
+def merge_grade_changes(table, views, changes, rows):
+    """
+    Apply grade changes to a table and its views.
+    
+    Args:
+        changes: evtId -> 'added', 'modified' or 'removed' since the table's version
+        rows: evtId -> row of the new payload (see grade_rows)
+    
+    Returns:
+        False if the changes don't fit the table (the caller then builds the
+        document again from scratch); the views are only updated on success.
+    """
+    by_event = table.rows_by_event()
+    touched = set()
+    deleted = set()
+    appended = set()
+    for event, kind in changes.items():
+        old_row = by_event.get(event)
+        row = rows.get(event) if kind != 'removed' else None
+        if (old_row is None) != (kind == 'added') or (kind != 'removed' and row is None):
+            return False
+        if old_row is not None:
+            touched.add(table.location(old_row))
+        if row is None:
+            deleted.add(old_row)
+            continue
+        touched.add((row[0], row[1]))
+        if old_row is not None and table.location(old_row) == (row[0], row[1]):
+            table.replace(old_row, *row, event=event)
+        else:
+            if old_row is not None:
+                deleted.add(old_row)
+            appended.add(event)
+    if deleted:
+        table.delete(deleted)
+    for event, row in rows.items():
+        if event in appended:
+            table.append(*row, event=event)
+    if len(table) != len(rows):
+        return False
     
-    # calculate average per subject
-    # Component grades (grades with the same evtDate and non-empty componentDesc within a subject)
-    # are averaged together into a single effective grade before computing the subject average.
-    # This ensures that multi-component evaluations (e.g., Scritto + Orale) count as one grade.
-    for period in grades_avr:
-        for subject in grades_avr[period]:
-            effective_grades = _get_effective_grades(grades_avr[period][subject]['grades'])
-            grades_avr[period][subject]["avr"] = sum(effective_grades) / len(effective_grades) if effective_grades else 0
-    
-    # Calculate period averages (using effective grades per subject)
-    for period in grades_avr:
-        period_grades = []
-        for subject in grades_avr[period]:
-            period_grades.extend(_get_effective_grades(grades_avr[period][subject]['grades']))
-        grades_avr[period]["period_avr"] = sum(period_grades) / len(period_grades) if period_grades else 0
-    
-    # Calculate overall average - use weighted average of all effective grades
-    # Include all grades (including blue) for consistency with displayed averages
-    all_grades = []
-    for period in grades_avr:
-        for subject in grades_avr[period]:
-            if subject != 'period_avr':
-                all_grades.extend(_get_effective_grades(grades_avr[period][subject]['grades']))
-    grades_avr["all_avr"] = sum(all_grades) / len(all_grades) if all_grades else 0
-    
-    return grades_avr
+    update_view_subjects(views[VIEW_WITH_BLUE], table, touched)
+    update_view_subjects(views[VIEW_WITHOUT_BLUE], table, touched, exclude_blue=True)
+    return True
     
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8001)
@@ -0,0 +1,168 @@
+"""
+Micro-benchmark: single-pass GradeAggregator vs the previous calculate_avr.
+
+The previous implementation built the period -> subject tree and then walked
+it three more times (subject, period and overall averages), calling
+_get_effective_grades on every list each time.
+
+The last two columns compare the JSON size of the grades as the grade store
+used to hold them (one dict per grade) with the columnar GradeTable.
+
+Usage:
+    python benchmarks/bench_aggregation.py [--sizes 1000 10000 100000] [--repeat 5]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ.setdefault('GRADE_STORE', 'memory')
+os.environ.setdefault('GRADE_HISTORY', 'false')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+
+SUBJECTS = [
+    'MATEMATICA', 'ITALIANO', 'INGLESE', 'STORIA', 'FISICA', 'CHIMICA', 'LATINO',
+    'FILOSOFIA', 'SCIENZE MOTORIE', 'INFORMATICA', 'ARTE', 'RELIGIONE'
+]
+VALUES = [4, 4.5, 5, 5.5, 6, 6.25, 6.5, 7, 7.5, 8, 8.5, 9, 10]
+
+
+def synthetic_payload(num_grades, seed=42):
+    """REST-like grades payload with ~25% component grades and ~20% blue grades."""
+    rng = random.Random(seed)
+    grades = []
+    for evt_id in range(num_grades):
+        component = rng.choice(['', '', '', 'Scritto', 'Orale', 'Pratico'])
+        grades.append({
+            "subjectId": 0,
+            "subjectDesc": rng.choice(SUBJECTS),
+            "evtId": evt_id,
+            "evtDate": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "decimalValue": rng.choice(VALUES),
+            "displayValue": "",
+            "color": "blue" if rng.random() < 0.2 else "green",
+            "periodPos": rng.choice([2, 3]),
+            "periodDesc": "",
+            "componentDesc": component,
+            "notesForFamily": "",
+            "teacherName": "DOCENTE",
+        })
+    return {"grades": grades}
+
+
+def legacy_calculate_avr(grades):
+    """calculate_avr as it was before the aggregation engine (multi-pass)."""
+    grades_avr = {}
+    for grade in grades["grades"]:
+        period = str(max(grade["periodPos"] - 1, 1))
+        decimal_value = grade["decimalValue"]
+        if decimal_value is None:
+            decimal_value = app.MARK_TABLE.get(grade.get("displayValue", ""), None)
+        if decimal_value is None:
+            continue
+        if period not in grades_avr:
+            grades_avr[period] = {}
+        if grades_avr[period].get(grade["subjectDesc"]) is None:
+            grades_avr[period][grade["subjectDesc"]] = {"count": 0, "avr": 0, "grades": []}
+        grades_avr[period][grade["subjectDesc"]]["count"] += 1
+        grades_avr[period][grade["subjectDesc"]]["grades"].append({
+            "decimalValue": decimal_value,
+            "displayValue": grade.get("displayValue", ""),
+            "evtDate": grade["evtDate"],
+            "notesForFamily": grade["notesForFamily"],
+            "componentDesc": grade["componentDesc"],
+            "teacherName": grade["teacherName"],
+            "isBlue": grade["color"] == "blue"
+        })
+    for period in grades_avr:
+        for subject in grades_avr[period]:
+            effective_grades = app._get_effective_grades(grades_avr[period][subject]['grades'])
+            grades_avr[period][subject]["avr"] = sum(effective_grades) / len(effective_grades) if effective_grades else 0
+    for period in grades_avr:
+        period_grades = []
+        for subject in grades_avr[period]:
+            period_grades.extend(app._get_effective_grades(grades_avr[period][subject]['grades']))
+        grades_avr[period]["period_avr"] = sum(period_grades) / len(period_grades) if period_grades else 0
+    all_grades = []
+    for period in grades_avr:
+        for subject in grades_avr[period]:
+            if subject != 'period_avr':
+                all_grades.extend(app._get_effective_grades(grades_avr[period][subject]['grades']))
+    grades_avr["all_avr"] = sum(all_grades) / len(all_grades) if all_grades else 0
+    return grades_avr
+
+
+def best_of(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def check_same_averages(old, new):
+    assert abs(old['all_avr'] - new['all_avr']) < 1e-9
+    for period, subjects in old.items():
+        if period == 'all_avr':
+            continue
+        assert abs(subjects['period_avr'] - new[period]['period_avr']) < 1e-9
+        for subject, data in subjects.items():
+            if subject != 'period_avr':
+                assert abs(data['avr'] - new[period][subject]['avr']) < 1e-9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'grades':>8} | {'legacy ms':>10} | {'engine ms':>10} | {'speedup':>7} | {'toggle legacy':>13} | {'toggle engine':>13} | {'add+remove us':>13} | {'tree KB':>8} | {'table KB':>8}")
+    for size in args.sizes:
+        payload = synthetic_payload(size)
+        legacy = best_of(lambda: legacy_calculate_avr(payload), args.repeat)
+        engine = best_of(lambda: app.build_grade_document(payload), args.repeat)
+        check_same_averages(legacy_calculate_avr(payload), app.calculate_avr(payload))
+
+        # Blue-grade toggle: previous recalculate_averages vs one aggregation pass
+        tree = app.calculate_avr(payload)
+
+        def legacy_toggle():
+            for period in tree:
+                if period == 'all_avr':
+                    continue
+                for subject in tree[period]:
+                    if subject == 'period_avr':
+                        continue
+                    for _ in range(3):
+                        app._get_effective_grades([g for g in tree[period][subject]['grades'] if not g['isBlue']])
+
+        toggle_legacy = best_of(legacy_toggle, args.repeat)
+        toggle_engine = best_of(lambda: app.recalculate_averages(tree, True), args.repeat)
+
+        # Incremental update: add then remove one component grade
+        aggregator = app.GradeAggregator.from_grades_avr(tree)
+        rounds = 10000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            aggregator.add('1', 'MATEMATICA', 7.5, '2025-06-01')
+            aggregator.remove('1', 'MATEMATICA', 7.5, '2025-06-01')
+        incremental = (time.perf_counter() - start) / rounds
+
+        tree_size = len(json.dumps(tree)) / 1024
+        table_size = len(json.dumps(app.build_grade_document(payload)['table'])) / 1024
+
+        print(f"{size:>8} | {legacy * 1000:>10.2f} | {engine * 1000:>10.2f} | {legacy / engine:>6.2f}x | "
+              f"{toggle_legacy * 1000:>11.2f}ms | {toggle_engine * 1000:>11.2f}ms | {incremental * 1e6:>13.2f} | "
+              f"{tree_size:>8.0f} | {table_size:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
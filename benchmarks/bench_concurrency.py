@@ -0,0 +1,82 @@
+"""
+Concurrency benchmark of a running server: many students logging in at once.
+
+Each simulated student loops over login, /grades and logout for --duration
+seconds; every login waits on two upstream calls (REST login and grades), so
+with a slow upstream the result is bound by how many requests the server can
+keep waiting at the same time. Run it against the app pointed at the
+ClasseViva stub (see classeviva_stub.py):
+
+    python benchmarks/classeviva_stub.py --latency-ms 300 &
+    UPSTREAM_BASE_URL=http://127.0.0.1:9001 GRADE_STORE=memory GRADE_HISTORY=false gunicorn -c gunicorn.conf.py app:app &
+    python benchmarks/bench_concurrency.py --url http://127.0.0.1:8001 --users 50
+
+Usage:
+    python benchmarks/bench_concurrency.py [--url http://127.0.0.1:8001] [--users 50] [--duration 30]
+"""
+
+import argparse
+import threading
+import time
+
+import requests
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def student(base_url, number, deadline, timings, errors):
+    session = requests.Session()
+    steps = (
+        ('login', 'POST', '/login', {'user_id': f'S{number:07d}', 'user_pass': 'stub'}),
+        ('grades', 'GET', '/grades', None),
+        ('logout', 'POST', '/logout', None),
+    )
+    while time.time() < deadline:
+        for name, method, path, data in steps:
+            start = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, data=data, timeout=60)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                timings[name].append(time.perf_counter() - start)
+            else:
+                errors[name] += 1
+                break
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8001')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30.0)
+    args = parser.parse_args()
+
+    timings = {'login': [], 'grades': [], 'logout': []}
+    errors = dict.fromkeys(timings, 0)
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target=student, args=(args.url.rstrip('/'), n, deadline, timings, errors))
+               for n in range(args.users)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.users} students for {elapsed:.1f}s against {args.url}")
+    print(f"{'endpoint':>8} | {'req/s':>7} | {'p50 ms':>8} | {'p95 ms':>8} | {'errors':>6}")
+    for name, samples in timings.items():
+        if not samples:
+            print(f"{name:>8} | {0:>7.1f} | {'-':>8} | {'-':>8} | {errors[name]:>6}")
+            continue
+        print(f"{name:>8} | {len(samples) / elapsed:>7.1f} | {percentile(samples, 50) * 1000:>8.0f} | "
+              f"{percentile(samples, 95) * 1000:>8.0f} | {errors[name]:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Micro-benchmark: delta sync vs rebuilding the grade document on every change.
+
+For every size, a student's grades change by --changes grades (one added, the
+others modified) and the new payload is turned into a grade document twice:
+from scratch, and by merging only the changed grades into the previous
+document (build_student_document with the session's document). Both include
+reading and updating the student's change log.
+
+The last columns compare what a client downloads after the sync: the whole
+grades tree from /grades, or the changes from /grades/changes.
+
+Usage:
+    python benchmarks/bench_delta.py [--sizes 200 1000 10000] [--changes 1 5] [--repeat 20]
+"""
+
+import argparse
+import copy
+import gc
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ.setdefault('GRADE_STORE', 'memory')
+os.environ.setdefault('GRADE_HISTORY', 'false')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+from bench_aggregation import check_same_averages, synthetic_payload  # noqa: E402
+
+LOGIN_TYPE, USER_ID = 'userid', 'S1234567'
+
+
+def changed_payload(payload, changes):
+    """Copy of payload with one grade added and changes - 1 grades modified."""
+    changed = copy.deepcopy(payload)
+    grades = changed['grades']
+    new_grade = dict(grades[0], evtId=len(grades), decimalValue=8, evtDate='2025-12-20')
+    grades.append(new_grade)
+    for grade in grades[1:changes]:
+        grade['decimalValue'] = 10 if grade['decimalValue'] != 10 else 9
+    return changed
+
+
+def timed_build(base_log, payload, content_hash, document, repeat):
+    """Best time of build_student_document, starting from base_log every time."""
+    log_key = app.grade_log_key(LOGIN_TYPE, USER_ID)
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        app.grade_store.set(log_key, base_log)
+        previous = copy.deepcopy(document) if document is not None else None
+        # Like timeit: no collections of the copies' garbage inside the timing
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        result = app.build_student_document(LOGIN_TYPE, USER_ID, payload, content_hash, previous)
+        best = min(best, time.perf_counter() - start)
+        gc.enable()
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[200, 1000, 10000])
+    parser.add_argument('--changes', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'grades':>8} | {'changes':>7} | {'rebuild ms':>10} | {'merge ms':>9} | {'speedup':>7} | "
+          f"{'/grades KB':>10} | {'changes KB':>10}")
+    for size in args.sizes:
+        payload = synthetic_payload(size)
+        log_key = app.grade_log_key(LOGIN_TYPE, USER_ID)
+        app.grade_store.delete(log_key)
+        document = app.build_student_document(LOGIN_TYPE, USER_ID, payload, app._payload_hash(payload))
+        base_log = app.grade_store.get(log_key)
+
+        for changes in args.changes:
+            changed = changed_payload(payload, changes)
+            content_hash = app._payload_hash(changed)
+            rebuild, rebuilt = timed_build(base_log, changed, content_hash, None, args.repeat)
+            merge, merged = timed_build(base_log, changed, content_hash, document, args.repeat)
+            assert merged['version'] == rebuilt['version'] == document['version'] + 1
+
+            with app.app.test_request_context():
+                tree = app.document_table(merged).to_grades_avr(app.current_view(merged))
+                check_same_averages(app.document_table(rebuilt).to_grades_avr(app.current_view(rebuilt)), tree)
+                delta = app.grade_changes_payload(merged, app.grade_changes_since(
+                    app.grade_store.get(log_key), document['version'], merged['version']))
+            tree_size = len(json.dumps(tree)) / 1024
+            delta_size = len(json.dumps(delta)) / 1024
+
+            print(f"{size:>8} | {changes:>7} | {rebuild * 1000:>10.2f} | {merge * 1000:>9.2f} | "
+                  f"{rebuild / merge:>6.2f}x | {tree_size:>10.1f} | {delta_size:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
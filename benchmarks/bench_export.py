@@ -0,0 +1,111 @@
+"""
+Benchmark of the grade export: the previous /export/csv (whole file built in a
+StringIO, then copied by getvalue()) against the streaming exports.
+
+For each format it reports the time to the first chunk (what the client waits
+for before the download starts), the total time and the peak memory allocated
+while producing the file (tracemalloc), and checks that the streamed CSV is
+byte-for-byte the same as the previous one. The PDF is only built up to
+--pdf-limit grades: platypus layout under tracemalloc takes minutes beyond that.
+
+Usage:
+    python benchmarks/bench_export.py [--sizes 1000 10000 100000] [--formats csv ndjson xlsx pdf] [--pdf-limit 10000]
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ.setdefault('GRADE_STORE', 'memory')
+os.environ.setdefault('GRADE_HISTORY', 'false')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+from bench_aggregation import synthetic_payload  # noqa: E402
+
+
+def legacy_export_csv(grades_avr):
+    """export_csv as it was before streaming: the body of the old route."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['Periodo', 'Materia', 'Voto', 'Data', 'Tipo', 'Docente', 'Note'])
+    for period in sorted(grades_avr.keys()):
+        if period == 'all_avr':
+            continue
+        for subject, data in grades_avr[period].items():
+            if subject == 'period_avr':
+                continue
+            for grade in data.get('grades', []):
+                writer.writerow([
+                    f'Periodo {period}',
+                    subject,
+                    grade.get('decimalValue', ''),
+                    grade.get('evtDate', ''),
+                    grade.get('componentDesc', ''),
+                    grade.get('teacherName', ''),
+                    grade.get('notesForFamily', '')
+                ])
+    output.seek(0)
+    return [output.getvalue()]
+
+
+def measure(make_stream):
+    """(time to first chunk, total time, peak traced memory, body size) of one export."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    first = None
+    size = 0
+    for chunk in make_stream():
+        if first is None:
+            first = time.perf_counter() - start
+        size += len(chunk)
+    total = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return first, total, peak, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--formats', nargs='+', default=['csv', 'ndjson', 'xlsx', 'pdf'])
+    parser.add_argument('--pdf-limit', type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'grades':>8} | {'export':>12} | {'first chunk ms':>14} | {'total ms':>9} | {'peak KB':>9} | {'size KB':>9}")
+    for size in args.sizes:
+        document = app.build_grade_document(synthetic_payload(size))
+        table = app.document_table(document)
+        view = document['views'][app.VIEW_WITH_BLUE]
+        # the previous route worked on the grades tree of the session
+        grades_avr = table.to_grades_avr(view)
+
+        streams = {
+            'legacy csv': lambda: legacy_export_csv(grades_avr),
+            'csv': lambda: app.stream_csv(table),
+            'ndjson': lambda: app.stream_ndjson(table),
+            'xlsx': lambda: app.stream_xlsx(table),
+            'pdf': lambda: app.stream_pdf(table, view),
+        }
+        assert ''.join(app.stream_csv(table)) == legacy_export_csv(grades_avr)[0]
+
+        for name, make_stream in streams.items():
+            if name != 'legacy csv' and name not in args.formats:
+                continue
+            if name == 'pdf' and not app.REPORTLAB_AVAILABLE:
+                print(f"{size:>8} | {name:>12} | reportlab not installed")
+                continue
+            if name == 'pdf' and size > args.pdf_limit:
+                continue
+            first, total, peak, body = measure(make_stream)
+            print(f"{size:>8} | {name:>12} | {first * 1000:>14.2f} | {total * 1000:>9.2f} | "
+                  f"{peak / 1024:>9.0f} | {body / 1024:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
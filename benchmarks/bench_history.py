@@ -0,0 +1,149 @@
+"""
+Benchmark: grade history of a whole school.
+
+Fills a grade history file with --students students over one school year
+(mid September to early June). Each student starts from a synthetic grades
+payload; then, --syncs times, one new grade changes a subject and the new
+averages are recorded at that moment, like a sync that found a new grade.
+
+Then it times --queries random range queries of the kind /grades/history
+answers (overall, period or subject average; day, week or sync points; the
+whole year or one month), directly and through the endpoint.
+
+Usage:
+    python benchmarks/bench_history.py [--students 1500] [--syncs 60] [--grades 150] [--queries 2000]
+"""
+
+import argparse
+import copy
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+WORKDIR = tempfile.mkdtemp(prefix='bench_history_')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ.setdefault('GRADE_STORE', 'memory')
+os.environ['GRADE_HISTORY'] = 'true'
+os.environ['GRADE_HISTORY_PATH'] = os.path.join(WORKDIR, 'grade_history.sqlite3')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+from bench_aggregation import VALUES, synthetic_payload  # noqa: E402
+
+YEAR_START = datetime(2025, 9, 15, 8, 0, tzinfo=app.grade_history.tz)
+YEAR_DAYS = 268
+
+
+def student_login(number):
+    return f'S{number:07d}'
+
+
+def add_grade(views, rng):
+    """Add one grade to a random subject of both views, like a sync would."""
+    value = rng.choice(VALUES)
+    period = rng.choice(sorted(views[app.VIEW_WITH_BLUE]['periods']))
+    subject = rng.choice(sorted(views[app.VIEW_WITH_BLUE]['periods'][period]['subjects']))
+    for view in views.values():
+        period_view = view['periods'].setdefault(period, {'sum': 0.0, 'count': 0, 'subjects': {}})
+        bucket = period_view['subjects'].setdefault(subject, {'sum': 0.0, 'count': 0})
+        for node in (bucket, period_view, view):
+            node['sum'] += value
+            node['count'] += 1
+
+
+def fill(history, args):
+    """Record every sync of every student, in time order; return (records, seconds)."""
+    rng = random.Random(1)
+    template = app.build_grade_document(synthetic_payload(args.grades))['views']
+    views = {}
+    sync_times = []
+    for number in range(args.students):
+        views[number] = copy.deepcopy(template)
+        offsets = sorted(rng.uniform(0, YEAR_DAYS * 86400) for _ in range(args.syncs))
+        sync_times.extend((offset, number) for offset in offsets)
+    sync_times.sort()
+
+    start = time.perf_counter()
+    written = 0
+    for number in range(args.students):
+        written += history.record(app.history_student('userid', student_login(number)), views[number],
+                                  at=YEAR_START.timestamp())
+    for offset, number in sync_times:
+        add_grade(views[number], rng)
+        written += history.record(app.history_student('userid', student_login(number)), views[number],
+                                  at=YEAR_START.timestamp() + offset)
+    return len(sync_times) + args.students, written, time.perf_counter() - start
+
+
+def random_query(rng, args):
+    number = rng.randrange(args.students)
+    kind = rng.choice(['overall', 'period', 'subject'])
+    period = rng.choice(['2', '3']) if kind != 'overall' else ''
+    subject = rng.choice(['MATEMATICA', 'ITALIANO', 'INGLESE', 'STORIA']) if kind == 'subject' else ''
+    resolution = rng.choice(app.HISTORY_RESOLUTIONS)
+    if rng.random() < 0.5:
+        start, end = None, None
+    else:
+        first = YEAR_START.date() + timedelta(days=rng.randrange(YEAR_DAYS - 30))
+        start, end = first, first + timedelta(days=30)
+    return number, period, subject, resolution, start, end
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    return [ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000 for p in (50, 95, 99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--students', type=int, default=1500)
+    parser.add_argument('--syncs', type=int, default=60, help='syncs with a new grade per student')
+    parser.add_argument('--grades', type=int, default=150, help='grades of every student at the start')
+    parser.add_argument('--queries', type=int, default=2000)
+    args = parser.parse_args()
+
+    history = app.grade_history
+    syncs, written, elapsed = fill(history, args)
+    conn = history._conn()
+    counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+              for table in ('series', 'snapshots', 'rollups')}
+    size = sum(os.path.getsize(os.path.join(WORKDIR, name)) for name in os.listdir(WORKDIR))
+    print(f"{args.students} students, {syncs} recorded syncs in {elapsed:.1f}s "
+          f"({elapsed / syncs * 1000:.2f} ms per sync, {written / syncs:.1f} averages written per sync)")
+    print(f"rows: {counts['series']} series, {counts['snapshots']} snapshots, {counts['rollups']} rollups; "
+          f"file {size / 1024 / 1024:.1f} MB")
+
+    rng = random.Random(2)
+    queries = [random_query(rng, args) for _ in range(args.queries)]
+    direct, points = [], 0
+    for number, period, subject, resolution, start, end in queries:
+        student = app.history_student('userid', student_login(number))
+        began = time.perf_counter()
+        points += len(history.points(student, app.VIEW_WITH_BLUE, period, subject, resolution, start, end))
+        direct.append(time.perf_counter() - began)
+
+    client = app.app.test_client()
+    endpoint = []
+    for number, period, subject, resolution, start, end in queries:
+        with client.session_transaction() as session:
+            session.update(token='benchmark', user_id=student_login(number), login_type='userid')
+        query = {'period': period, 'subject': subject, 'resolution': resolution}
+        if start:
+            query.update({'from': start.isoformat(), 'to': end.isoformat()})
+        began = time.perf_counter()
+        response = client.get('/grades/history', query_string=query)
+        endpoint.append(time.perf_counter() - began)
+        assert response.status_code == 200, response.get_json()
+
+    print(f"{args.queries} range queries, {points / args.queries:.0f} points on average")
+    print(f"{'':>20} | {'p50 ms':>7} | {'p95 ms':>7} | {'p99 ms':>7}")
+    for name, samples in (('GradeHistory.points', direct), ('/grades/history', endpoint)):
+        p50, p95, p99 = percentiles(samples)
+        print(f"{name:>20} | {p50:>7.2f} | {p95:>7.2f} | {p99:>7.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Micro-benchmark: JSON encoding and decoding with orjson vs the json module.
+
+For every size, times what a /grades request does with JSON:
+
+    document decode   grade store get() of the stored grade document
+    document encode   grade store set() of it (after a sync)
+    tree encode       flask.jsonify of the grades tree (grades_avr)
+    tree decode       parsing the tree, as the frontend cache or a client does
+
+"json" is how the app did it before (Flask's default provider: sorted keys,
+ASCII escapes); "orjson" is FastJSONProvider / dumps_json / loads_json.
+The last rows time GET /grades end to end with FAST_JSON off and on.
+
+The sizes go from a realistic year (200 grades) to worst cases (a student
+with 2000 grades, a synthetic 20000).
+
+Usage:
+    python benchmarks/bench_json.py [--sizes 200 2000 20000] [--repeat 20]
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ.setdefault('GRADE_STORE', 'memory')
+os.environ.setdefault('GRADE_HISTORY', 'false')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+from bench_aggregation import synthetic_payload  # noqa: E402
+
+
+def best_time(func, repeat):
+    """Best time of func() over repeat runs, without collections inside the timing."""
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+        gc.enable()
+    return best
+
+
+def with_accents(payload):
+    """Realistic strings: half-marks and accented subjects need escaping without orjson."""
+    for number, grade in enumerate(payload['grades']):
+        if number % 3 == 0:
+            grade['displayValue'] = '6½'
+        if number % 7 == 0:
+            grade['subjectDesc'] = 'ATTIVITÀ ALTERNATIVA'
+            grade['notesForFamily'] = 'verifica di metà quadrimestre, è andata bene'
+    return payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[200, 2000, 20000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    if not app.FAST_JSON:
+        sys.exit("orjson is not installed (or FAST_JSON=false): nothing to compare")
+
+    default_provider = DefaultJSONProvider(app.app)
+    fast_provider = app.app.json
+    print(f"{'grades':>7} | {'step':>16} | {'KB':>7} | {'json ms':>8} | {'orjson ms':>9} | {'speedup':>7}")
+    for size in args.sizes:
+        document = app.build_grade_document(with_accents(synthetic_payload(size)), 'benchmark')
+        tree = app.document_table(document).to_grades_avr(document['views'][app.VIEW_WITH_BLUE])
+        stored = json.dumps(document)
+        tree_text = default_provider.response(tree).get_data()
+
+        with app.app.app_context():
+            steps = (
+                ('document decode', len(stored),
+                 lambda: json.loads(stored), lambda: app.loads_json(stored)),
+                ('document encode', len(stored),
+                 lambda: json.dumps(document), lambda: app.dumps_json(document)),
+                ('tree encode', len(tree_text),
+                 lambda: default_provider.response(tree), lambda: fast_provider.response(tree)),
+                ('tree decode', len(tree_text),
+                 lambda: json.loads(tree_text), lambda: app.loads_json(tree_text)),
+            )
+            for name, length, stdlib, fast in steps:
+                slow_time, fast_time = best_time(stdlib, args.repeat), best_time(fast, args.repeat)
+                print(f"{size:>7} | {name:>16} | {length / 1024:>7.1f} | {slow_time * 1000:>8.2f} | "
+                      f"{fast_time * 1000:>9.2f} | {slow_time / fast_time:>6.1f}x")
+
+        # The whole request: store get, tree, jsonify (the ETag is not sent, so no 304)
+        client = app.app.test_client()
+        with client.session_transaction() as session:
+            session['sid'] = f'benchmark-{size}'
+        app.grade_store.set(app.grades_key(f'benchmark-{size}'), document)
+        timings = []
+        for fast_json in (False, True):
+            app.FAST_JSON = fast_json
+            timings.append(best_time(lambda: client.get('/grades'), args.repeat))
+        app.FAST_JSON = True
+        print(f"{size:>7} | {'GET /grades':>16} | {len(tree_text) / 1024:>7.1f} | {timings[0] * 1000:>8.2f} | "
+              f"{timings[1] * 1000:>9.2f} | {timings[0] / timings[1]:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
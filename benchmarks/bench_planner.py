@@ -0,0 +1,92 @@
+"""
+Latency benchmark of the goal planner (/plan_goal).
+
+Times plan_goal on random students with 15 subjects, planning up to 10 new
+grades with up to 10 per subject (every subject can take every grade), for
+both the overall and a period average. The memoization cache is cleared
+before every call, so all timings are cold. Fails if the worst case is over
+the budget.
+
+Usage:
+    python benchmarks/bench_planner.py [--subjects 15] [--grades 10] [--students 200] [--budget-ms 20]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ.setdefault('GRADE_STORE', 'memory')
+os.environ.setdefault('GRADE_HISTORY', 'false')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+
+
+def synthetic_view(num_subjects, periods=2, seed=0):
+    """Aggregate view of a student with 4-15 effective grades per subject and period."""
+    rng = random.Random(seed)
+    view = {'sum': 0.0, 'count': 0, 'periods': {}}
+    for period in range(1, periods + 1):
+        period_view = {'sum': 0.0, 'count': 0, 'subjects': {}}
+        for i in range(num_subjects):
+            level = rng.uniform(4.5, 9.5)
+            count = rng.randint(4, 15)
+            total = sum(min(10, max(3, rng.gauss(level, 1))) for _ in range(count))
+            period_view['subjects'][f'MATERIA {i}'] = {'sum': total, 'count': count}
+            period_view['sum'] += total
+            period_view['count'] += count
+        view['periods'][str(period)] = period_view
+        view['sum'] += period_view['sum']
+        view['count'] += period_view['count']
+    return view
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subjects', type=int, default=15)
+    parser.add_argument('--grades', type=int, default=10)
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--budget-ms', type=float, default=20.0)
+    args = parser.parse_args()
+
+    timings = {'overall': [], 'period': []}
+    frontier_sizes = []
+    for seed in range(args.students):
+        view = synthetic_view(args.subjects, seed=seed)
+        rng = random.Random(seed)
+        for scope, period in (('overall', None), ('period', '1')):
+            # A target between the current average and the best reachable one
+            totals = view if period is None else view['periods'][period]
+            current = totals['sum'] / totals['count']
+            reachable = (totals['sum'] + 10 * args.grades) / (totals['count'] + args.grades)
+            target = current + rng.uniform(0.2, 0.95) * (reachable - current)
+            app._plan_frontier.cache_clear()
+            start = time.perf_counter()
+            plans = app.plan_goal(view, target, period, args.grades, args.grades)
+            timings[scope].append(time.perf_counter() - start)
+            frontier_sizes.append(len(plans))
+
+    print(f"{args.subjects} subjects x {args.grades} grades, {args.students} students (cold cache)")
+    print(f"{'scope':>8} | {'p50 ms':>8} | {'p95 ms':>8} | {'max ms':>8}")
+    worst = 0.0
+    for scope, samples in timings.items():
+        worst = max(worst, max(samples))
+        print(f"{scope:>8} | {percentile(samples, 50) * 1000:>8.3f} | {percentile(samples, 95) * 1000:>8.3f} | "
+              f"{max(samples) * 1000:>8.3f}")
+    print(f"average frontier size: {sum(frontier_sizes) / len(frontier_sizes):.1f} plans")
+
+    if worst * 1000 > args.budget_ms:
+        sys.exit(f"FAIL: worst case {worst * 1000:.2f}ms is over the {args.budget_ms}ms budget")
+    print(f"OK: worst case {worst * 1000:.2f}ms is within the {args.budget_ms}ms budget")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark of the email-login grades page parser (genitori_voti.php).
+
+Compares the original full html.parser tree with the fast path
+(regex login pre-scan + SoupStrainer on the period tables, lxml if installed)
+and checks that both return exactly the same grades.
+
+Pass recorded pages (saved from the browser while logged in) to benchmark
+them; without arguments a synthetic page with the same structure is used.
+
+Usage:
+    python benchmarks/bench_scraper.py [page.html ...] [--repeat 20]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ.setdefault('GRADE_STORE', 'memory')
+os.environ.setdefault('GRADE_HISTORY', 'false')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+
+SUBJECTS = ['MATEMATICA', 'ITALIANO', 'INGLESE', 'STORIA', 'FISICA', 'CHIMICA',
+            'LATINO', 'FILOSOFIA', 'SCIENZE MOTORIE', 'INFORMATICA', 'ARTE', 'RELIGIONE']
+
+
+def synthetic_grades_page(grades_per_subject=25, periods=2, seed=7):
+    """Page shaped like genitori_voti.php: navigation, scripts and one table per period."""
+    rng = random.Random(seed)
+    marks = list(app.MARK_TABLE)
+    parts = ['<!DOCTYPE html><html><head><title>ClasseViva</title>']
+    parts += ['<script>var cfg%d = {"menu": "%s"};</script>' % (i, 'x' * 400) for i in range(30)]
+    parts.append('<style>' + '.c{color:red}' * 500 + '</style></head><body>')
+    parts.append('<div id="menu">' + ''.join(
+        f'<a href="/link{i}.php" class="voce_menu">Voce {i}</a>' for i in range(200)) + '</div>')
+    parts.append('<span class="scuola">ISTITUTO DI PROVA</span>')
+    evt_id = 1000
+    for period in range(1, periods + 1):
+        parts.append(f'<table sessione="S{period}" class="registro"><thead><tr><th>Materia</th></tr></thead><tbody>')
+        for subject_id, subject in enumerate(SUBJECTS, start=1):
+            parts.append(f'<tr class="riga_competenza_default" materia_id="{subject_id}"><td>{subject}</td></tr>')
+            parts.append(f'<tr class="riga_materia_componente"><td class="materia">{subject.lower()}</td>')
+            for _ in range(grades_per_subject):
+                evt_id += 1
+                css = 'f_reg_voto_dettaglio' if rng.random() < 0.2 else 'voto_verde'
+                parts.append(
+                    f'<td class="cella_voto" evento_id="{evt_id}">'
+                    f'<span class="voto_data">{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}</span>'
+                    f'<p class="{css}">{rng.choice(marks)}</p></td>'
+                )
+            parts.append('</tr>')
+        parts.append('</tbody></table>')
+    parts.append('<div id="footer">' + '<p>Informativa privacy e cookie</p>' * 100 + '</div></body></html>')
+    return ''.join(parts)
+
+
+def best_of(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pages', nargs='*', help='recorded genitori_voti.php pages')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    samples = []
+    for path in args.pages:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            samples.append((os.path.basename(path), f.read()))
+    if not samples:
+        samples = [
+            ('synthetic (25 grades/subject)', synthetic_grades_page(25)),
+            ('synthetic (60 grades/subject)', synthetic_grades_page(60)),
+        ]
+
+    print(f"fast parser tree builder: {app.SCRAPER_PARSER}")
+    print(f"{'page':<32} | {'KB':>6} | {'grades':>6} | {'full ms':>8} | {'fast ms':>8} | {'speedup':>7}")
+    for name, html in samples:
+        full = app.parse_grades_page(html, fast=False)
+        fast = app.parse_grades_page(html, fast=True)
+        assert full == fast, f"{name}: fast parser returned different grades"
+        full_time = best_of(lambda: app.parse_grades_page(html, fast=False), args.repeat)
+        fast_time = best_of(lambda: app.parse_grades_page(html, fast=True), args.repeat)
+        print(f"{name:<32} | {len(html) / 1024:>6.0f} | {len(full['grades']):>6} | "
+              f"{full_time * 1000:>8.2f} | {fast_time * 1000:>8.2f} | {full_time / fast_time:>6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
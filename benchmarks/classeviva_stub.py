@@ -0,0 +1,245 @@
+"""
+Local stand-in for ClasseViva, for load tests.
+
+Mimics the calls the app makes:
+
+    POST rest/v1/auth/login                          REST login (token)
+    GET  rest/v1/students/{id}/grades                REST grades (JSON)
+    POST auth-p7/app/default/AuthApi4.php            email login (PHPSESSID cookie)
+    GET  cvv/app/default/genitori_voti.php           grades page (HTML)
+    GET  home/app/default/menu_webinfoschool_genitori.php
+
+Every answer comes after a configurable delay (what matters when measuring
+how many slow upstream calls the app can wait on at once), with synthetic
+grades that are the same on every call for a student and different between
+students. Grades support ETag revalidation, like the real endpoints, and REST
+tokens stop working (401) after --token-ttl seconds. Point
+the app at it with UPSTREAM_BASE_URL:
+
+    python benchmarks/classeviva_stub.py --port 9001 --latency-ms 300
+    UPSTREAM_BASE_URL=http://127.0.0.1:9001 gunicorn -c gunicorn.conf.py app:app
+
+Usage:
+    python benchmarks/classeviva_stub.py [--port 9001] [--latency-ms 300] [--jitter-ms 100]
+                                         [--grades 200] [--error-rate 0] [--token-ttl 5400]
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import time
+import urllib.parse
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GRADES_PATH_RE = re.compile(r'^/rest/v1/students/(\d+)/grades$')
+EMAIL_LOGIN_PATH = '/auth-p7/app/default/AuthApi4.php'
+GRADES_PAGE_PATH = '/cvv/app/default/genitori_voti.php'
+MENU_PAGE_PATH = '/home/app/default/menu_webinfoschool_genitori.php'
+
+SUBJECTS = [
+    'MATEMATICA', 'ITALIANO', 'INGLESE', 'STORIA', 'FISICA', 'CHIMICA', 'LATINO',
+    'FILOSOFIA', 'SCIENZE MOTORIE', 'INFORMATICA', 'ARTE', 'RELIGIONE'
+]
+VALUES = [3, 4, 4.5, 5, 5.5, 6, 6.25, 6.5, 6.75, 7, 7.5, 8, 8.5, 9, 9.5, 10]
+MARKS = ['4', '5-', '5', '5½', '6-', '6', '6+', '6½', '7-', '7', '7+', '7½', '8', '8½', '9', '10']
+
+
+def stub_grades(num_grades, seed):
+    """REST grades payload of one student, with component and blue grades."""
+    rng = random.Random(seed)
+    grades = []
+    for evt_id in range(num_grades):
+        grades.append({
+            "subjectId": 0,
+            "subjectDesc": rng.choice(SUBJECTS),
+            "evtId": evt_id,
+            "evtDate": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "decimalValue": rng.choice(VALUES),
+            "displayValue": "",
+            "color": "blue" if rng.random() < 0.2 else "green",
+            "periodPos": rng.choice([2, 3]),
+            "periodDesc": "",
+            "componentDesc": rng.choice(['', '', '', 'Scritto', 'Orale', 'Pratico']),
+            "notesForFamily": "",
+            "teacherName": "DOCENTE",
+        })
+    return {"grades": grades}
+
+
+def stub_grades_page(num_grades, seed):
+    """genitori_voti.php of one student: one table per period, a row per subject."""
+    rng = random.Random(seed)
+    parts = ['<!DOCTYPE html><html><head><title>ClasseViva</title></head><body>',
+             '<span class="scuola">ISTITUTO DI PROVA</span>']
+    per_period = [num_grades // 2, num_grades - num_grades // 2]
+    evt_id = 0
+    for period, count in enumerate(per_period, start=1):
+        parts.append(f'<table sessione="S{period}" class="registro"><tbody>')
+        by_subject = {}
+        for _ in range(count):
+            by_subject.setdefault(rng.choice(SUBJECTS), []).append(rng.choice(MARKS))
+        for subject_id, (subject, marks) in enumerate(sorted(by_subject.items()), start=1):
+            parts.append(f'<tr class="riga_competenza_default" materia_id="{subject_id}"><td>{subject}</td></tr>')
+            parts.append(f'<tr class="riga_materia_componente"><td class="materia">{subject.lower()}</td>')
+            for mark in marks:
+                evt_id += 1
+                css = 'f_reg_voto_dettaglio' if rng.random() < 0.2 else 'voto_verde'
+                parts.append(
+                    f'<td class="cella_voto" evento_id="{evt_id}">'
+                    f'<span class="voto_data">{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}</span>'
+                    f'<p class="{css}">{mark}</p></td>'
+                )
+            parts.append('</tr>')
+        parts.append('</tbody></table>')
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def session_seed(uid):
+    """Stable student number of an email login (its PHPSESSID encodes it)."""
+    return int(hashlib.sha1(uid.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay(self):
+        config = self.server.config
+        time.sleep(max(0.0, random.gauss(config.latency_ms, config.jitter_ms)) / 1000)
+
+    def _fail(self):
+        """Answer 503 for --error-rate of the calls, to exercise retries."""
+        if random.random() < self.server.config.error_rate:
+            self._send(503, b'{}')
+            return True
+        return False
+
+    def _session(self):
+        """Student number of the PHPSESSID cookie, or None."""
+        cookie = SimpleCookie(self.headers.get('Cookie', ''))
+        morsel = cookie.get('PHPSESSID')
+        if morsel is None or not morsel.value.startswith('stub'):
+            return None
+        return int(morsel.value[len('stub'):])
+
+    def _token_expired(self):
+        expire = self.headers.get('Z-Auth-Token', '').rpartition('-')[2]
+        return not expire.isdigit() or int(expire) <= time.time()
+
+    def _send_cached(self, body, content_type='application/json'):
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, headers=[('ETag', etag)])
+        else:
+            self._send(200, body, content_type, headers=[('ETag', etag)])
+
+    def _send(self, status, body=b'', content_type='application/json', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self._delay()
+        if self._fail():
+            return
+        path = urllib.parse.urlsplit(self.path).path
+        if path == EMAIL_LOGIN_PATH:
+            uid = urllib.parse.parse_qs(body.decode('utf-8')).get('uid', [''])[0]
+            self._send(200, b'{"data":{"auth":{"loggedIn":true}}}',
+                       headers=[('Set-Cookie', f'PHPSESSID=stub{session_seed(uid)}; path=/')])
+        elif path == '/rest/v1/auth/login':
+            uid = json.loads(body or b'{}').get('uid') or 'S0'
+            expire = int(time.time() + self.server.config.token_ttl)
+            self._send(200, json.dumps({
+                'ident': uid,
+                'token': f'stub-{uid}-{expire}',
+                'release': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime()),
+                'expire': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(expire))
+            }).encode())
+        else:
+            self._send(404, b'{}')
+
+    def do_GET(self):
+        self._delay()
+        if self._fail():
+            return
+        path = urllib.parse.urlsplit(self.path).path
+        match = GRADES_PATH_RE.match(path)
+        if match is not None and self._token_expired():
+            self._send(401, b'{"error":"auth token expired"}')
+        elif match is not None:
+            self._send_cached(self.server.grades(int(match.group(1))))
+        elif path in (GRADES_PAGE_PATH, MENU_PAGE_PATH):
+            seed = self._session()
+            if seed is None:
+                # What ClasseViva shows an expired session
+                self._send(200, b'<html><body><form id="login_form" action="/auth-p7/">accedi</form></body></html>',
+                           'text/html; charset=utf-8')
+            elif path == MENU_PAGE_PATH:
+                self._send(200, b'<html><body><span class="scuola">ISTITUTO DI PROVA</span></body></html>',
+                           'text/html; charset=utf-8')
+            else:
+                self._send_cached(self.server.grades_page(seed), 'text/html; charset=utf-8')
+        else:
+            self._send(404, b'{}')
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, config):
+        super().__init__(address, StubHandler)
+        self.config = config
+        self._payloads = {}
+
+    def grades(self, student_id):
+        """Grades JSON of a student: the same on every call, different per student."""
+        key = ('json', student_id)
+        payload = self._payloads.get(key)
+        if payload is None:
+            payload = self._payloads[key] = json.dumps(stub_grades(self.config.grades, student_id)).encode()
+        return payload
+
+    def grades_page(self, seed):
+        """Grades page of an email login, built like the JSON once per student."""
+        key = ('html', seed)
+        payload = self._payloads.get(key)
+        if payload is None:
+            payload = self._payloads[key] = stub_grades_page(self.config.grades, seed).encode('utf-8')
+        return payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9001)
+    parser.add_argument('--latency-ms', type=float, default=300.0)
+    parser.add_argument('--jitter-ms', type=float, default=100.0)
+    parser.add_argument('--grades', type=int, default=200, help='grades per student')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls answered with a 503')
+    parser.add_argument('--token-ttl', type=float, default=5400.0, help='seconds a REST token stays valid')
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port), args)
+    print(f"ClasseViva stub on http://{args.host}:{args.port} "
+          f"({args.latency_ms:.0f}±{args.jitter_ms:.0f}ms, {args.grades} grades per student)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
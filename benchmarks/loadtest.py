@@ -0,0 +1,257 @@
+"""
+Load test of the whole app: simulated students replaying a realistic visit.
+
+Every student loops over the same visit for --duration seconds:
+
+    login -> grades -> subject detail -> goal for a subject -> prediction ->
+    overall goal -> overall average page -> sync -> changes since the first
+    grades -> CSV export -> grades again (revalidated with If-None-Match, 304)
+    -> live update stream (until its first bytes) -> logout
+
+logging in with a student code or, for --email-share of the students, an
+email (HTML scraping path), with a random pause of up to --think-ms between
+steps. It reports requests per second and p50/p95/p99 latency per endpoint,
+and exits with status 1 if a threshold (--max-p95-ms, --min-rps,
+--max-error-rate) is not met, so it can gate a release.
+
+By default it starts the ClasseViva stub and gunicorn (gunicorn.conf.py) from
+this tree on free local ports. With --url it tests a server that is already
+running instead, e.g. a release image started with UPSTREAM_BASE_URL pointing
+at a stub:
+
+    python benchmarks/classeviva_stub.py --host 0.0.0.0 --port 9001 &
+    docker run -p 8001:8001 -e UPSTREAM_BASE_URL=http://host.docker.internal:9001 IMAGE
+    python benchmarks/loadtest.py --url http://127.0.0.1:8001
+
+Usage:
+    python benchmarks/loadtest.py [--url URL] [--users 50] [--duration 60] [--think-ms 500]
+                                  [--email-share 0.2] [--stub-latency-ms 300] [--stub-grades 200]
+                                  [--max-p95-ms MS] [--min-rps RPS] [--max-error-rate 0.01]
+"""
+
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'classeviva_stub.py')
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def spawn_servers(args, workdir):
+    """Start the stub and gunicorn from this tree; return (base URL, processes)."""
+    stub_port, app_port = free_port(), free_port()
+    stub = subprocess.Popen([
+        sys.executable, STUB, '--port', str(stub_port), '--latency-ms', str(args.stub_latency_ms),
+        '--jitter-ms', str(args.stub_latency_ms / 3), '--grades', str(args.stub_grades)
+    ], stdout=subprocess.DEVNULL)
+    env = dict(
+        os.environ,
+        UPSTREAM_BASE_URL=f'http://127.0.0.1:{stub_port}',
+        GUNICORN_BIND=f'127.0.0.1:{app_port}',
+        GRADE_STORE_PATH=os.path.join(workdir, 'grade_store.sqlite3'),
+        GRADE_HISTORY_PATH=os.path.join(workdir, 'grade_history.sqlite3'),
+        SECRET_KEY='loadtest',
+    )
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'wb')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                              cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{app_port}'
+    wait_until_up(url + '/api/version')
+    return url, [server, stub]
+
+
+class Student:
+    """One simulated student: a cookie jar and the visit it keeps replaying."""
+
+    def __init__(self, base_url, number, email, think_ms, results):
+        self.base_url = base_url
+        self.number = number
+        self.email = email
+        self.think_ms = think_ms
+        self.results = results
+        self.rng = random.Random(number)
+
+    def call(self, name, method, path, expected=(200,), **kwargs):
+        """Timed request; returns the response, or None (and counts an error)."""
+        if self.think_ms:
+            time.sleep(self.rng.uniform(0, self.think_ms) / 1000)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=60, **kwargs)
+        except requests.RequestException:
+            response = None
+        elapsed = time.perf_counter() - start
+        if response is None or response.status_code not in expected:
+            self.results.errors[name] += 1
+            return None
+        self.results.timings[name].append(elapsed)
+        return response
+
+    def visit(self):
+        self.session = requests.Session()
+        if self.email:
+            credentials = {'user_id': f'studente{self.number}@example.com', 'user_pass': 'stub', 'login_type': 'email'}
+        else:
+            credentials = {'user_id': f'S{self.number:07d}', 'user_pass': 'stub', 'login_type': 'userid'}
+        if not self.call('login', 'POST', '/login', data=credentials):
+            return
+        response = self.call('grades', 'GET', '/grades')
+        if not response:
+            return
+        grades = response.json()
+        etag = response.headers.get('ETag')
+        version = response.headers.get('X-Grades-Version', '0')
+        periods = sorted(key for key in grades if key != 'all_avr')
+        if not periods:
+            return
+        period = self.rng.choice(periods)
+        subject = self.rng.choice([key for key in grades[period] if key != 'period_avr'])
+
+        steps = (
+            ('subject_detail', 'GET', f'/subject_detail/{subject}', {}),
+            ('calculate_goal', 'POST', '/calculate_goal',
+             {'json': {'period': period, 'subject': subject, 'target_average': 7.5, 'num_grades': 2}}),
+            ('predict_average', 'POST', '/predict_average',
+             {'json': {'period': period, 'subject': subject, 'predicted_grades': [7, 8]}}),
+            ('calculate_goal_overall', 'POST', '/calculate_goal_overall', {'json': {'target_average': 7.5}}),
+            ('overall_average_detail', 'GET', '/overall_average_detail?fields=avr', {}),
+            ('refresh_grades', 'POST', '/refresh_grades', {}),
+            ('grades_changes', 'GET', f'/grades/changes?since={version}', {}),
+            ('export_csv', 'POST', '/export/csv', {}),
+        )
+        for name, method, path, kwargs in steps:
+            if not self.call(name, method, path, **kwargs):
+                return
+        if etag and not self.call('grades_revalidate', 'GET', '/grades', expected=(200, 304),
+                                  headers={'If-None-Match': etag}):
+            return
+        # Resumed from the tree just fetched: no event is due, only the retry hint comes
+        headers = {'Accept': 'text/event-stream'}
+        if etag:
+            headers['Last-Event-ID'] = etag.removeprefix('W/').strip('"')
+        stream = self.call('grades_stream', 'GET', '/grades/stream', stream=True, headers=headers)
+        if not stream:
+            return
+        stream.close()
+        self.call('logout', 'POST', '/logout')
+
+    def run(self, deadline):
+        while time.time() < deadline:
+            self.visit()
+
+
+class Results:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+
+
+def report(results, elapsed, args):
+    """Print the table; return the list of failed thresholds."""
+    names = list(dict.fromkeys(list(results.timings) + list(results.errors)))
+    print(f"{'endpoint':>24} | {'requests':>8} | {'req/s':>7} | {'p50 ms':>7} | {'p95 ms':>7} | "
+          f"{'p99 ms':>7} | {'errors':>6}")
+    failures = []
+    total = total_errors = 0
+    for name in names:
+        samples = results.timings.get(name, [])
+        errors = results.errors.get(name, 0)
+        total += len(samples)
+        total_errors += errors
+        if samples:
+            p50, p95, p99 = (percentile(samples, p) * 1000 for p in (50, 95, 99))
+            print(f"{name:>24} | {len(samples):>8} | {len(samples) / elapsed:>7.1f} | {p50:>7.0f} | "
+                  f"{p95:>7.0f} | {p99:>7.0f} | {errors:>6}")
+            if args.max_p95_ms is not None and p95 > args.max_p95_ms:
+                failures.append(f"{name}: p95 {p95:.0f}ms > {args.max_p95_ms:.0f}ms")
+        else:
+            print(f"{name:>24} | {0:>8} | {0:>7.1f} | {'-':>7} | {'-':>7} | {'-':>7} | {errors:>6}")
+    rps = total / elapsed
+    error_rate = total_errors / max(1, total + total_errors)
+    print(f"{'total':>24} | {total:>8} | {rps:>7.1f} | {'':>7} | {'':>7} | {'':>7} | {total_errors:>6}")
+    if args.min_rps is not None and rps < args.min_rps:
+        failures.append(f"throughput {rps:.1f} req/s < {args.min_rps:.1f} req/s")
+    if error_rate > args.max_error_rate:
+        failures.append(f"error rate {error_rate:.2%} > {args.max_error_rate:.2%}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='server to test; default: start stub + gunicorn from this tree')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--think-ms', type=float, default=500.0)
+    parser.add_argument('--email-share', type=float, default=0.2)
+    parser.add_argument('--stub-latency-ms', type=float, default=300.0)
+    parser.add_argument('--stub-grades', type=int, default=200)
+    parser.add_argument('--max-p95-ms', type=float)
+    parser.add_argument('--min-rps', type=float)
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            if args.url:
+                url = args.url.rstrip('/')
+            else:
+                url, processes = spawn_servers(args, workdir)
+            results = Results()
+            rng = random.Random(0)
+            students = [Student(url, n, rng.random() < args.email_share, args.think_ms, results)
+                        for n in range(1, args.users + 1)]
+            deadline = time.time() + args.duration
+            threads = [threading.Thread(target=student.run, args=(deadline,)) for student in students]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    print(f"{args.users} students ({args.email_share:.0%} email logins) for {elapsed:.1f}s against {url}")
+    failures = report(results, elapsed, args)
+    if failures:
+        sys.exit("FAIL: " + "; ".join(failures))
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,49 @@
  *   apiFetch('/calculate_goal', { method: 'POST', body: JSON.stringify(data), headers: { 'Content-Type': 'application/json' } })
  */
 
+// GET responses that came with an ETag are kept in sessionStorage (per tab,
+// dropped on logout) and revalidated with If-None-Match: when the grades have
+// not changed the backend answers 304 without a body and the stored copy is
+// returned instead, as a normal 200 response.
+const ETAG_CACHE_PREFIX = 'apiFetch:';
+
+function readCachedResponse(cacheKey) {
+  try {
+    return JSON.parse(sessionStorage.getItem(cacheKey));
+  } catch (error) {
+    return null;
+  }
+}
+
+function storeCachedResponse(cacheKey, response) {
+  const etag = response.headers.get('ETag');
+  response.clone().text()
+    .then((body) => {
+      sessionStorage.setItem(cacheKey, JSON.stringify({
+        etag,
+        version: response.headers.get('X-Grades-Version'),
+        contentType: response.headers.get('Content-Type'),
+        body
+      }));
+    })
+    .catch((error) => {
+      // e.g. storage quota exceeded: just fetch in full next time
+      console.log('[apiFetch] Could not cache response:', error);
+    });
+}
+
+function apiUrl(path) {
+  // API_BASE can be empty (same-origin), a relative path, or full URL
+  const { API_BASE } = window.APP_CONFIG;
+  return API_BASE ? `${API_BASE}${path}` : path;
+}
+
+function clearCachedResponses() {
+  Object.keys(sessionStorage)
+    .filter((key) => key.startsWith(ETAG_CACHE_PREFIX))
+    .forEach((key) => sessionStorage.removeItem(key));
+}
+
 /**
  * Make a fetch request to the backend API
  * @param {string} path - The API path (e.g., '/login', '/grades')
@@ -26,16 +69,20 @@ function apiFetch(path, options = {}) {
     throw new Error('APP_CONFIG is not defined');
   }
   
-  const { API_BASE, API_KEY } = window.APP_CONFIG;
+  const { API_KEY } = window.APP_CONFIG;
   
   // Build the full URL
-  // API_BASE can be empty (same-origin), a relative path, or full URL
-  const url = API_BASE ? `${API_BASE}${path}` : path;
+  const url = apiUrl(path);
+  
+  // Only GET responses are revalidated
+  const cacheKey = (options.method || 'GET').toUpperCase() === 'GET' ? ETAG_CACHE_PREFIX + url : null;
+  const cached = cacheKey ? readCachedResponse(cacheKey) : null;
   
   // Merge headers - add API key if configured
   const headers = {
     ...(options.headers || {}),
-    ...(API_KEY ? { 'X-API-Key': API_KEY } : {})
+    ...(API_KEY ? { 'X-API-Key': API_KEY } : {}),
+    ...(cached ? { 'If-None-Match': cached.etag } : {})
   };
   
   // Make the request with credentials for cross-origin session support
@@ -43,9 +90,181 @@ function apiFetch(path, options = {}) {
     credentials: 'include',  // Required for cookies/session across origins
     ...options,
     headers
+  }).then((response) => {
+    if (!cacheKey) {
+      return response;
+    }
+    if (response.status === 304 && cached) {
+      const cachedHeaders = new Headers(response.headers);
+      cachedHeaders.set('Content-Type', cached.contentType);
+      return new Response(cached.body, { status: 200, headers: cachedHeaders });
+    }
+    if (response.ok && response.headers.get('ETag')) {
+      storeCachedResponse(cacheKey, response);
+    }
+    return response;
   });
 }
 
+// The grades tree kept by apiFetch is brought up to date with
+// /grades/changes: only the grades added, modified or removed since its
+// version (X-Grades-Version) are downloaded and patched into it, together
+// with the new count and average of every subject.
+
+function applyGradeChanges(tree, changes) {
+  const replaced = new Set([...changes.removed, ...changes.modified.map((grade) => grade.evtId)]);
+  for (const [period, subjects] of Object.entries(tree)) {
+    if (period === 'all_avr') continue;
+    for (const [subject, subjectData] of Object.entries(subjects)) {
+      if (subject === 'period_avr') continue;
+      subjectData.grades = subjectData.grades.filter((grade) => !replaced.has(grade.evtId));
+    }
+  }
+  for (const { period, subject, ...grade } of [...changes.added, ...changes.modified]) {
+    tree[period] = tree[period] || {};
+    tree[period][subject] = tree[period][subject] || { grades: [] };
+    tree[period][subject].grades.push(grade);
+  }
+  // Counts and averages of every subject: drop the ones that have no grades left
+  const averages = changes.averages;
+  for (const period of Object.keys(tree)) {
+    if (period === 'all_avr') continue;
+    if (!averages[period]) {
+      delete tree[period];
+      continue;
+    }
+    for (const subject of Object.keys(tree[period])) {
+      if (subject === 'period_avr') continue;
+      if (averages[period][subject]) {
+        Object.assign(tree[period][subject], averages[period][subject]);
+      } else {
+        delete tree[period][subject];
+      }
+    }
+    tree[period].period_avr = averages[period].period_avr;
+  }
+  tree.all_avr = averages.all_avr;
+  return tree;
+}
+
+/**
+ * Fetch the grades tree, patching the cached copy when there is one
+ * @returns {Promise<Response>} - The /grades response (or an equivalent 200 built from the cache)
+ */
+async function apiFetchGrades() {
+  const cacheKey = ETAG_CACHE_PREFIX + apiUrl('/grades');
+  const cached = readCachedResponse(cacheKey);
+  if (cached && cached.version) {
+    try {
+      const response = await apiFetch(`/grades/changes?since=${encodeURIComponent(cached.version)}`);
+      if (response.status === 401) {
+        return response;
+      }
+      const changes = response.ok ? await response.json() : { reset: true };
+      if (!changes.reset) {
+        const body = JSON.stringify(applyGradeChanges(JSON.parse(cached.body), changes));
+        sessionStorage.setItem(cacheKey, JSON.stringify({
+          ...cached,
+          etag: changes.etag,
+          version: String(changes.version),
+          body
+        }));
+        // Freshness headers (X-Grades-Age...) come with the changes
+        const headers = new Headers(response.headers);
+        headers.set('Content-Type', cached.contentType);
+        return new Response(body, { status: 200, headers });
+      }
+    } catch (error) {
+      console.log('[apiFetchGrades] Could not apply grade changes:', error);
+    }
+  }
+  return apiFetch('/grades');
+}
+
+// /grades/stream sends a 'grades' event whenever the grades tree of the
+// session changes on the server (a sync from another tab, the background
+// refresh, the blue-grade preference). It is read with fetch instead of
+// EventSource, which can't send the X-API-Key header. The event id is the
+// ETag of the new tree: reconnecting with it as Last-Event-ID only brings an
+// event if one was missed.
+
+function etagEventId(etag) {
+  return etag ? etag.replace(/^W\//, '').replace(/"/g, '') : null;
+}
+
+/**
+ * Call onChange whenever the grades tree kept by apiFetchGrades is out of date
+ * @param {function} onChange - Called with the event data ({ version, etag })
+ * @returns {function} - Stops watching
+ */
+function watchGrades(onChange) {
+  const cacheKey = ETAG_CACHE_PREFIX + apiUrl('/grades');
+  const controller = new AbortController();
+  let lastEventId = null;
+  let retryMs = 3000;
+
+  function handleMessage(block) {
+    let event = 'message';
+    const data = [];
+    for (const line of block.split('\n')) {
+      if (!line || line.startsWith(':')) continue;
+      const colon = line.indexOf(':');
+      const field = colon < 0 ? line : line.slice(0, colon);
+      const value = colon < 0 ? '' : line.slice(colon + 1).replace(/^ /, '');
+      if (field === 'data') data.push(value);
+      else if (field === 'event') event = value;
+      else if (field === 'id') lastEventId = value;
+      else if (field === 'retry' && /^\d+$/.test(value)) retryMs = Number(value);
+    }
+    if (event !== 'grades' || !data.length) return;
+    const update = JSON.parse(data.join('\n'));
+    const cached = readCachedResponse(cacheKey);
+    if (!cached || cached.etag !== update.etag) {
+      onChange(update);
+    }
+  }
+
+  async function listen() {
+    const cached = readCachedResponse(cacheKey);
+    const eventId = lastEventId || etagEventId(cached && cached.etag);
+    const response = await apiFetch('/grades/stream', {
+      headers: { Accept: 'text/event-stream', ...(eventId ? { 'Last-Event-ID': eventId } : {}) },
+      signal: controller.signal
+    });
+    if (response.status === 401) {
+      return false;
+    }
+    if (!response.ok || !response.body) {
+      throw new Error(`Stream not available (${response.status})`);
+    }
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = '';
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) return true;
+      buffer += value;
+      let end;
+      while ((end = buffer.indexOf('\n\n')) >= 0) {
+        handleMessage(buffer.slice(0, end));
+        buffer = buffer.slice(end + 2);
+      }
+    }
+  }
+
+  (async () => {
+    while (!controller.signal.aborted) {
+      try {
+        if (!(await listen())) return;
+      } catch (error) {
+        if (controller.signal.aborted) return;
+        console.log('[watchGrades] Stream interrupted:', error);
+      }
+      await new Promise((resolve) => setTimeout(resolve, retryMs));
+    }
+  })();
+  return () => controller.abort();
+}
+
 /**
  * Navigate to a frontend page (static HTML files)
  * @param {string} page - The page to navigate to (e.g., 'grades.html', 'settings.html')
@@ -76,6 +295,7 @@ async function apiFormSubmit(path, data, options = {}) {
  * Perform logout - calls backend and redirects to login
  */
 async function performLogout() {
+  clearCachedResponses();
   try {
     await apiFetch('/logout', { method: 'POST' });
   } catch (error) {
@@ -100,6 +320,8 @@ async function checkAuth() {
 
 // Make functions globally available
 window.apiFetch = apiFetch;
+window.apiFetchGrades = apiFetchGrades;
+window.watchGrades = watchGrades;
 window.navigateTo = navigateTo;
 window.apiFormSubmit = apiFormSubmit;
 window.performLogout = performLogout;
@@ -202,7 +202,7 @@ if (logoutBtn) {
 // Fetch grades data on page load
 async function loadGrades() {
   try {
-    const response = await apiFetch('/grades');
+    const response = await apiFetchGrades();
     
     if (!response.ok) {
       if (response.status === 401) {
@@ -215,6 +215,7 @@ async function loadGrades() {
     
     const data = await response.json();
     renderGrades(data);
+    watchForUpdates();
   } catch (error) {
     console.error('Error loading grades:', error);
     document.getElementById('gradesContainer').innerHTML = `
@@ -226,5 +227,24 @@ async function loadGrades() {
   }
 }
 
+// Re-render when the grades change on the server (a sync from another tab or
+// the background refresh), instead of polling for them
+let watching = false;
+function watchForUpdates() {
+  if (watching) return;
+  watching = true;
+  let updating = Promise.resolve();
+  watchGrades(() => {
+    updating = updating.then(async () => {
+      const response = await apiFetchGrades();
+      if (response.ok) {
+        renderGrades(await response.json());
+      }
+    }).catch((error) => {
+      console.error('Error updating grades:', error);
+    });
+  });
+}
+
 // Load grades when page loads
 document.addEventListener('DOMContentLoaded', loadGrades);
@@ -8,7 +8,7 @@ let gradesData = {};
 // Load data from API
 async function loadOverallData() {
   try {
-    const response = await apiFetch('/overall_average_detail');
+    const response = await apiFetch('/overall_average_detail?fields=avr');
     
     if (!response.ok) {
       if (response.status === 401) {
@@ -1,60 +1,63 @@
-const CACHE_NAME = 'chemediaho-v2.5.0';
-const urlsToCache = [
-  '/',
-  '/static/manifest.json',
-  '/static/icons/icon-192.png',
-  '/static/icons/icon-512.png'
-];
+// In standalone mode the server prepends self.__PRECACHE_MANIFEST: the pages
+// and the fingerprinted CSS, JS and icons, with a version that changes
+// whenever one of them does. Without it (frontend deployed on its own) only
+// the start page is precached.
+const PRECACHE_MANIFEST = self.__PRECACHE_MANIFEST || { version: 'v2.5.0', urls: ['/'] };
+const CACHE_NAME = `chemediaho-${PRECACHE_MANIFEST.version}`;
+const PRECACHE_URLS = new Set(PRECACHE_MANIFEST.urls);
 
-// Install event - cache resources
+// Install event - precache the current version
 self.addEventListener('install', (event) => {
   event.waitUntil(
     caches.open(CACHE_NAME)
-      .then((cache) => {
-        console.log('Opened cache');
-        return cache.addAll(urlsToCache);
-      })
+      .then((cache) => cache.addAll(PRECACHE_MANIFEST.urls))
+      .then(() => self.skipWaiting())
       .catch((error) => {
         console.log('Cache installation failed:', error);
       })
   );
 });
 
-// Fetch event - serve from cache, fallback to network
+// Fetch event
+// - fingerprinted assets never change: cache first
+// - everything else (pages, API): network first, cache as offline fallback
 self.addEventListener('fetch', (event) => {
   // Skip caching for POST requests and other non-GET methods
   if (event.request.method !== 'GET') {
-    event.respondWith(fetch(event.request));
     return;
   }
 
-  event.respondWith(
-    caches.match(event.request)
-      .then((response) => {
-        // Cache hit - return response
-        if (response) {
-          return response;
-        }
-
-        return fetch(event.request).then(
-          (response) => {
-            // Check if valid response
-            if (!response || response.status !== 200 || response.type !== 'basic') {
-              return response;
-            }
+  // Live update streams never end: nothing to cache
+  if (event.request.headers.get('Accept') === 'text/event-stream') {
+    return;
+  }
 
-            // Clone the response
-            const responseToCache = response.clone();
+  const url = new URL(event.request.url);
+  if (url.origin !== self.location.origin) {
+    return;
+  }
 
-            caches.open(CACHE_NAME)
-              .then((cache) => {
-                cache.put(event.request, responseToCache);
-              });
+  if (PRECACHE_URLS.has(url.pathname) && /\.[0-9a-f]{12}\.[^./]+$/.test(url.pathname)) {
+    event.respondWith(
+      caches.match(event.request).then((response) => response || fetch(event.request))
+    );
+    return;
+  }
 
-            return response;
-          }
-        );
+  event.respondWith(
+    fetch(event.request)
+      .then((response) => {
+        // Check if valid response
+        if (response && response.status === 200 && response.type === 'basic') {
+          const responseToCache = response.clone();
+          caches.open(CACHE_NAME)
+            .then((cache) => {
+              cache.put(event.request, responseToCache);
+            });
+        }
+        return response;
       })
+      .catch(() => caches.match(event.request))
   );
 });
 
@@ -70,6 +73,6 @@ self.addEventListener('activate', (event) => {
           }
         })
       );
-    })
+    }).then(() => self.clients.claim())
   );
 });
@@ -0,0 +1,67 @@
+"""
+Gunicorn settings for che media ho?
+
+Almost all the time of a login or a refresh is spent waiting for
+web.spaggiari.eu, so the default worker class is gevent: every worker serves
+many requests at once and a slow ClasseViva response only holds up the
+greenlet waiting for it. Without gevent installed it falls back to threaded
+(gthread) workers.
+
+Every setting can be overridden from the environment:
+
+    GUNICORN_WORKER_CLASS   gevent | gthread | sync (default: gevent if installed)
+    WEB_CONCURRENCY         worker processes
+                            (default: one per core for gevent, 2 x cores + 1 otherwise)
+    GUNICORN_THREADS        threads per gthread worker (default: 8)
+    GUNICORN_CONNECTIONS    concurrent requests per gevent worker (default: 500)
+    GUNICORN_TIMEOUT        seconds before a stuck worker is restarted (default: 90)
+    GUNICORN_MAX_REQUESTS   requests before a worker is recycled (default: 2000)
+    GUNICORN_BIND           listen address (default: 0.0.0.0:8001)
+
+Usage:
+    gunicorn -c gunicorn.conf.py app:app
+"""
+
+import multiprocessing
+import os
+
+
+def _default_worker_class():
+    try:
+        import gevent  # noqa: F401
+        return 'gevent'
+    except ImportError:
+        return 'gthread'
+
+
+cores = multiprocessing.cpu_count()
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8001')
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or _default_worker_class()
+
+if worker_class == 'gevent':
+    workers = int(os.environ.get('WEB_CONCURRENCY', max(2, cores)))
+    worker_connections = int(os.environ.get('GUNICORN_CONNECTIONS', '500'))
+    # A worker now has many upstream calls in flight: give its connection pool
+    # room for them instead of opening and dropping extra connections
+    os.environ.setdefault('UPSTREAM_POOL_SIZE', '50')
+    # The gevent worker monkey-patches when it starts. A preloaded app would
+    # have created its locks, threads and sockets in the master before that,
+    # unpatched, and those block the whole worker.
+    preload_app = False
+else:
+    workers = int(os.environ.get('WEB_CONCURRENCY', cores * 2 + 1))
+    threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+    # Import the app (and build the static asset table) once, in the master
+    preload_app = True
+
+# Above the worst upstream case: connect + read timeout with retries and backoff
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '90'))
+graceful_timeout = 30
+# Behind a tunnel or reverse proxy that reuses connections
+keepalive = 5
+
+# Recycle workers now and then so that slow leaks can't pile up; the jitter
+# keeps them from all restarting at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '2000'))
+max_requests_jitter = max_requests // 10
@@ -0,0 +1,113 @@
+"""
+Shared fixtures. The app is imported with an in-memory grade store and
+without the grade history file or the background refresher, so the tests
+touch nothing outside the process.
+"""
+
+import itertools
+import os
+import random
+import sys
+
+import pytest
+
+os.environ.setdefault('SECRET_KEY', 'tests')
+os.environ['GRADE_STORE'] = 'memory'
+os.environ['GRADE_HISTORY'] = 'false'
+os.environ['BACKGROUND_REFRESH'] = 'false'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as app_module  # noqa: E402
+from resp_server import RespServer  # noqa: E402
+
+SUBJECTS = ['MATEMATICA', 'ITALIANO', 'INGLESE', 'STORIA', 'FISICA', 'LATINO']
+VALUES = [4, 4.5, 5, 5.5, 6, 6.25, 6.5, 7, 7.5, 8, 8.5, 9, 10]
+
+_students = itertools.count(1)
+
+
+def make_grade(evt_id, rng):
+    """One REST grade, with component and blue grades mixed in."""
+    return {
+        "subjectId": 0,
+        "subjectDesc": rng.choice(SUBJECTS),
+        "evtId": evt_id,
+        "evtDate": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 4):02d}",
+        "decimalValue": rng.choice(VALUES),
+        "displayValue": "",
+        "color": "blue" if rng.random() < 0.25 else "green",
+        "periodPos": rng.choice([2, 3]),
+        "periodDesc": "",
+        "componentDesc": rng.choice(['', '', 'Scritto', 'Orale']),
+        "notesForFamily": "",
+        "teacherName": "DOCENTE",
+    }
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+@pytest.fixture
+def resp_server():
+    """A stand-in Redis server on a free local port, see resp_server.py."""
+    server = RespServer(password='tests')
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def make_payload():
+    """make_payload(count, seed) -> a grades payload like /grades of the REST API."""
+    def make(count, seed=0):
+        rng = random.Random(seed)
+        return {"grades": [make_grade(evt_id, rng) for evt_id in range(1, count + 1)]}
+    return make
+
+
+@pytest.fixture
+def student():
+    """A login that no other test uses, so the shared grade store starts empty for it."""
+    return 'userid', f'S{next(_students):07d}'
+
+
+@pytest.fixture
+def grades_client(app, make_payload, student):
+    """
+    grades_client(payload=None) -> (test client, grade document): a logged-in
+    session holding the grades of payload, 120 random grades by default.
+    """
+    def make(payload=None):
+        payload = payload or make_payload(120)
+        document = app.build_student_document(*student, payload, app._payload_hash(payload))
+        sid = f'tests-{student[1]}'
+        app.grade_store.set(app.grades_key(sid), document)
+        client = app.app.test_client()
+        with client.session_transaction() as session:
+            session.update(sid=sid, token='tok', login_type=student[0], user_id=student[1])
+        return client, document
+    return make
+
+
+@pytest.fixture
+def grades_tree(app):
+    """
+    grades_tree(document, view_name) -> the /grades tree of a document, with
+    every subject's grades sorted by evtId (merged rows keep upstream order
+    only within a subject) and the averages rounded.
+    """
+    def tree(document, view_name=app.VIEW_WITH_BLUE):
+        result = app.document_table(document).to_grades_avr(document['views'][view_name])
+        for period, subjects in result.items():
+            if period == 'all_avr':
+                result[period] = round(subjects, 9)
+                continue
+            for subject, node in subjects.items():
+                if subject == 'period_avr':
+                    subjects[subject] = round(node, 9)
+                    continue
+                node['avr'] = round(node['avr'], 9)
+                node['grades'].sort(key=lambda grade: grade['evtId'])
+        return result
+    return tree
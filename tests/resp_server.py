@@ -0,0 +1,176 @@
+"""
+Stand-in Redis server speaking RESP, with just the commands RedisStore uses.
+
+Keys expire like in Redis, and max_keys makes it evict the least recently used
+key like a server with maxmemory-policy allkeys-lru. SCAN walks the keys from
+the least recently used and looks at COUNT of them per call, so a large
+keyspace takes several pages, some of them empty, as with a real server.
+"""
+
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+
+def _glob_regex(pattern):
+    """Redis MATCH pattern (*, ? and backslash escapes) as a regex."""
+    parts = []
+    chars = iter(pattern)
+    for char in chars:
+        if char == '\\':
+            parts.append(re.escape(next(chars, '\\')))
+        elif char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    return re.compile(''.join(parts), re.DOTALL)
+
+
+class RespServer:
+    def __init__(self, password=None, max_keys=None):
+        self.password = password
+        self.max_keys = max_keys
+        self.commands = []  # names of the commands received, in order
+        self._data = {}     # db -> OrderedDict of key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._clients = []
+        self._listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self._listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def url(self, db=0):
+        auth = f":{self.password}@" if self.password else ''
+        return f"redis://{auth}127.0.0.1:{self.port}/{db}"
+
+    def close(self):
+        self._listener.close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        """Close every client connection, like a server restart."""
+        for client in self._clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+                client.close()
+            except OSError:
+                pass
+        self._clients.clear()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self._listener.accept()
+            except OSError:
+                return
+            self._clients.append(client)
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        reader = client.makefile('rb')
+        state = {'db': 0, 'authenticated': self.password is None}
+        try:
+            while True:
+                line = reader.readline()
+                if not line:
+                    return
+                args = []
+                for _ in range(int(line[1:])):
+                    length = int(reader.readline()[1:])
+                    args.append(reader.read(length + 2)[:-2])
+                client.sendall(self._encode(self._command(state, args)))
+        except (OSError, ValueError):
+            return
+
+    def _encode(self, reply):
+        if isinstance(reply, Exception):
+            return b'-%s\r\n' % str(reply).encode()
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, int):
+            return b':%d\r\n' % reply
+        if isinstance(reply, str):
+            return b'+%s\r\n' % reply.encode()
+        if isinstance(reply, bytes):
+            return b'$%d\r\n%s\r\n' % (len(reply), reply)
+        return b'*%d\r\n' % len(reply) + b''.join(self._encode(item) for item in reply)
+
+    def _command(self, state, args):
+        name = args[0].decode().upper()
+        self.commands.append(name)
+        if name == 'AUTH':
+            state['authenticated'] = args[1].decode() == self.password
+            return 'OK' if state['authenticated'] else Exception('WRONGPASS invalid password')
+        if not state['authenticated']:
+            return Exception('NOAUTH Authentication required.')
+        if name == 'SELECT':
+            state['db'] = int(args[1])
+            return 'OK'
+        with self._lock:
+            handler = getattr(self, f"_{name.lower()}", None)
+            if handler is None:
+                return Exception(f"ERR unknown command '{name}'")
+            return handler(self._data.setdefault(state['db'], OrderedDict()), *args[1:])
+
+    @staticmethod
+    def _live(data, key):
+        entry = data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del data[key]
+            return None
+        return entry
+
+    def _store(self, data, key, value, expires_at):
+        data[key] = (value, expires_at)
+        data.move_to_end(key)
+        while self.max_keys and len(data) > self.max_keys:
+            data.popitem(last=False)
+
+    def _get(self, data, key):
+        entry = self._live(data, key)
+        if entry is None:
+            return None
+        data.move_to_end(key)
+        return entry[0]
+
+    def _set(self, data, key, value, *options):
+        options = [option.decode().upper() for option in options]
+        expires_at = None
+        if 'PX' in options:
+            expires_at = time.time() + int(options[options.index('PX') + 1]) / 1000
+        if 'NX' in options and self._live(data, key) is not None:
+            return None
+        self._store(data, key, value, expires_at)
+        return 'OK'
+
+    def _incr(self, data, key):
+        entry = self._live(data, key) or (b'0', None)
+        value = int(entry[0]) + 1
+        self._store(data, key, str(value).encode(), entry[1])
+        return value
+
+    def _pexpire(self, data, key, milliseconds):
+        entry = self._live(data, key)
+        if entry is None:
+            return 0
+        data[key] = (entry[0], time.time() + int(milliseconds) / 1000)
+        return 1
+
+    def _del(self, data, *keys):
+        return sum(data.pop(key, None) is not None for key in keys)
+
+    def _scan(self, data, cursor, *options):
+        options = [option.decode() for option in options]
+        options = dict(zip(options[::2], options[1::2]))
+        pattern = _glob_regex(options.get('MATCH', '*'))
+        count = int(options.get('COUNT', 10))
+        start = int(cursor)
+        now = time.time()
+        # Expired keys are skipped, not deleted, so the cursor positions stay put
+        found = [key for key in list(data)[start:start + count]
+                 if (data[key][1] is None or data[key][1] > now) and pattern.fullmatch(key.decode())]
+        following = start + count if start + count < len(data) else 0
+        return [str(following).encode(), found]
@@ -0,0 +1,117 @@
+"""Single-pass and incremental averages, compared with the full recomputation."""
+
+import random
+
+import pytest
+
+
+def reference_averages(app, payload, exclude_blue=False):
+    """
+    Averages the way calculate_avr used to compute them: group the grades by
+    period and subject, then average the effective grades of every level.
+    """
+    tree = {}
+    for grade in payload['grades']:
+        if exclude_blue and grade['color'] == 'blue':
+            continue
+        period = str(max(grade['periodPos'] - 1, 1))
+        tree.setdefault(period, {}).setdefault(grade['subjectDesc'], []).append(grade)
+
+    def mean(values):
+        return sum(values) / len(values) if values else 0
+
+    averages = {}
+    everything = []
+    for period, subjects in tree.items():
+        in_period = []
+        for subject, grades in subjects.items():
+            effective = app._get_effective_grades(grades)
+            averages[(period, subject)] = mean(effective)
+            in_period.extend(effective)
+        averages[period] = mean(in_period)
+        everything.extend(in_period)
+    averages['all'] = mean(everything)
+    return averages
+
+
+def view_averages(app, view):
+    averages = {'all': app._view_avr(view)}
+    for period, period_view in view['periods'].items():
+        averages[period] = app._view_avr(period_view)
+        for subject, bucket in period_view['subjects'].items():
+            averages[(period, subject)] = app._view_avr(bucket)
+    return averages
+
+
+def aggregator_averages(aggregator):
+    averages = {'all': aggregator.overall_avr()}
+    for period, subject in aggregator.subjects:
+        averages[period] = aggregator.period_avr(period)
+        if aggregator.subjects[(period, subject)].effective_count:
+            averages[(period, subject)] = aggregator.subject_avr(period, subject)
+    return averages
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_document_views_match_full_recomputation(app, make_payload, seed):
+    payload = make_payload(120, seed)
+    document = app.build_grade_document(payload)
+    with_blue = view_averages(app, document['views'][app.VIEW_WITH_BLUE])
+    without_blue = view_averages(app, document['views'][app.VIEW_WITHOUT_BLUE])
+    assert with_blue == pytest.approx(reference_averages(app, payload))
+    assert without_blue == pytest.approx(reference_averages(app, payload, exclude_blue=True))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_incremental_add_and_remove_match_full_recomputation(app, make_payload, seed):
+    payload = make_payload(80, seed)
+    rng = random.Random(seed)
+    aggregator = app.GradeAggregator()
+    kept = []
+    # Add every grade, removing a random earlier one now and then
+    for grade in payload['grades']:
+        period = str(max(grade['periodPos'] - 1, 1))
+        component_key = grade['evtDate'] if grade['componentDesc'] else None
+        aggregator.add(period, grade['subjectDesc'], grade['decimalValue'], component_key)
+        kept.append(grade)
+        if rng.random() < 0.3:
+            removed = kept.pop(rng.randrange(len(kept)))
+            aggregator.remove(str(max(removed['periodPos'] - 1, 1)), removed['subjectDesc'], removed['decimalValue'],
+                              removed['evtDate'] if removed['componentDesc'] else None)
+
+    expected = reference_averages(app, {'grades': kept})
+    assert aggregator_averages(aggregator) == pytest.approx(expected)
+    assert aggregator.count == sum(aggregate.effective_count for aggregate in aggregator.subjects.values())
+
+
+def test_component_grades_count_as_one(app):
+    aggregate = app.SubjectAggregate()
+    assert aggregate.add(6, '2025-10-01') == (6, 1)
+    assert aggregate.add(8, '2025-10-01') == (1, 0)
+    aggregate.add(10)
+    assert (aggregate.effective_sum, aggregate.effective_count) == (17, 2)
+    assert aggregate.remove(6, '2025-10-01') == (1, 0)
+    assert aggregate.remove(8, '2025-10-01') == (-8, -1)
+    assert aggregate.average == 10
+
+
+def test_calculate_avr_tree_matches_full_recomputation(app, make_payload):
+    payload = make_payload(60, 7)
+    tree = app.calculate_avr(payload)
+    expected = reference_averages(app, payload)
+    assert tree['all_avr'] == pytest.approx(expected['all'])
+    for period, subjects in tree.items():
+        if period == 'all_avr':
+            continue
+        assert subjects['period_avr'] == pytest.approx(expected[period])
+        for subject, node in subjects.items():
+            if subject != 'period_avr':
+                assert node['avr'] == pytest.approx(expected[(period, subject)])
+
+
+@pytest.mark.parametrize('exclude_blue', [False, True])
+def test_from_grades_avr_matches_full_recomputation(app, make_payload, exclude_blue):
+    payload = make_payload(60, 8)
+    tree = app.calculate_avr(payload)
+    aggregator = app.GradeAggregator.from_grades_avr(tree, exclude_blue=exclude_blue)
+    assert aggregator_averages(aggregator) == pytest.approx(reference_averages(app, payload, exclude_blue))
@@ -0,0 +1,98 @@
+"""Streamed exports: every format holds exactly the session's grades."""
+
+import csv
+import io
+import json
+import re
+
+import pytest
+
+
+@pytest.fixture
+def payload(make_payload):
+    payload = make_payload(150, 3)
+    notes = ['Verifica di fine <unità> & recupero', 'Interrogazione\x01 "lunga"', 'riga 1\nriga 2']
+    for grade, note in zip(payload['grades'], notes):
+        grade['notesForFamily'] = note
+    return payload
+
+
+def expected_rows(payload):
+    """Export rows straight from the upstream payload, in a stable order."""
+    return sorted((f"Periodo {grade['periodPos'] - 1}", grade['subjectDesc'], float(grade['decimalValue']),
+                   grade['evtDate'], grade['componentDesc'], grade['teacherName'], grade['notesForFamily'])
+                  for grade in payload['grades'])
+
+
+def export(client, export_format):
+    response = client.post(f'/export/{export_format}')
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert re.fullmatch(rf'attachment; filename=voti_\d{{8}}_\d{{6}}\.{export_format}', response.headers['Content-Disposition'])
+    return response
+
+
+@pytest.fixture
+def small_chunks(app, monkeypatch):
+    # Many chunks even for a small export
+    monkeypatch.setattr(app, 'EXPORT_CHUNK_SIZE', 512)
+
+
+def test_csv(grades_client, payload, small_chunks):
+    client, _ = grades_client(payload)
+    response = export(client, 'csv')
+    assert response.mimetype == 'text/csv'
+    chunks = list(response.response)
+    assert len(chunks) > 1
+    header, *rows = list(csv.reader(io.StringIO(''.join(chunk if isinstance(chunk, str) else chunk.decode() for chunk in chunks))))
+    assert header == ['Periodo', 'Materia', 'Voto', 'Data', 'Tipo', 'Docente', 'Note']
+    assert sorted((*row[:2], float(row[2]), *row[3:]) for row in rows) == expected_rows(payload)
+
+
+def test_ndjson(grades_client, payload, small_chunks):
+    client, _ = grades_client(payload)
+    response = export(client, 'ndjson')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    records = [json.loads(line) for line in lines]
+    assert sorted((f"Periodo {record['period']}", record['subject'], float(record['decimalValue']), record['evtDate'],
+                   record['componentDesc'], record['teacherName'], record['notesForFamily']) for record in records) == \
+        expected_rows(payload)
+
+
+def test_xlsx_opens_in_openpyxl(grades_client, payload, small_chunks):
+    openpyxl = pytest.importorskip('openpyxl')
+    client, _ = grades_client(payload)
+    response = export(client, 'xlsx')
+    assert response.mimetype == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    workbook = openpyxl.load_workbook(io.BytesIO(response.get_data()), read_only=True)
+    assert workbook.sheetnames == ['Voti']
+    header, *rows = list(workbook['Voti'].iter_rows(values_only=True))
+    assert list(header) == ['Periodo', 'Materia', 'Voto', 'Data', 'Tipo', 'Docente', 'Note']
+    assert all(isinstance(row[2], (int, float)) for row in rows)
+    # Characters XML can't hold are dropped, markup is kept as text
+    expected = [(*row[:6], row[6].replace('\x01', '')) for row in expected_rows(payload)]
+    assert sorted((*row[:2], float(row[2]), *row[3:6], row[6] or '') for row in rows) == expected
+
+
+def test_pdf_has_a_page_per_period(app, grades_client, payload):
+    pytest.importorskip('reportlab')
+    client, document = grades_client(payload)
+    response = export(client, 'pdf')
+    assert response.mimetype == 'application/pdf'
+    data = response.get_data()
+    assert data.startswith(b'%PDF-') and data.rstrip().endswith(b'%%EOF')
+    pages = len(re.findall(rb'/Type /Page\b(?!s)', data))
+    assert pages >= len(document['views'][app.VIEW_WITH_BLUE]['periods'])
+
+
+def test_pdf_without_reportlab_is_not_available(app, grades_client, monkeypatch):
+    monkeypatch.setattr(app, 'REPORTLAB_AVAILABLE', False)
+    client, _ = grades_client()
+    assert client.post('/export/pdf').status_code == 501
+
+
+def test_unknown_format_and_missing_session(app, grades_client):
+    client, _ = grades_client()
+    assert client.post('/export/docx').status_code == 404
+    assert app.app.test_client().post('/export/csv').status_code == 401
@@ -0,0 +1,102 @@
+"""The exact goal planner, compared with a brute-force search on small cases."""
+
+import itertools
+import random
+
+import pytest
+
+
+def make_view(subjects):
+    """One-period view from {subject: (sum, count)}."""
+    period = {'sum': 0.0, 'count': 0, 'subjects': {}}
+    for subject, (total, count) in subjects.items():
+        period['subjects'][subject] = {'sum': total, 'count': count}
+        period['sum'] += total
+        period['count'] += count
+    return {'sum': period['sum'], 'count': period['count'], 'periods': {'1': period}}
+
+
+def brute_force_efforts(app, subjects, target, max_grades, max_per_subject):
+    """Least effort for every number of new grades that can reach target, trying every plan."""
+    averages = {subject: total / count for subject, (total, count) in subjects.items()}
+    current_total = sum(total for total, _ in subjects.values())
+    current_count = sum(count for _, count in subjects.values())
+    best = {}
+    for n in range(1, max_grades + 1):
+        for chosen in itertools.combinations_with_replacement(sorted(subjects), n):
+            if max(chosen.count(subject) for subject in chosen) > max_per_subject:
+                continue
+            for grades in itertools.product(app.ALLOWED_GRADES, repeat=n):
+                if (current_total + sum(grades)) / (current_count + n) < target - 1e-9:
+                    continue
+                effort = sum(max(0.0, grade - averages[subject]) for grade, subject in zip(grades, chosen))
+                best[n] = min(best.get(n, effort), effort)
+    return best
+
+
+def pareto(best):
+    frontier, lowest = [], None
+    for n in sorted(best):
+        if lowest is None or best[n] < lowest - 1e-9:
+            frontier.append((n, best[n]))
+            lowest = best[n]
+    return frontier
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_frontier_matches_brute_force(app, seed):
+    rng = random.Random(seed)
+    subjects = {}
+    for name in ['MATEMATICA', 'ITALIANO', 'INGLESE'][:rng.choice([2, 3])]:
+        count = rng.randint(2, 6)
+        subjects[name] = (sum(rng.choice(app.ALLOWED_GRADES) for _ in range(count)), count)
+    current = sum(total for total, _ in subjects.values()) / sum(count for _, count in subjects.values())
+    target = round(min(current + rng.uniform(0.1, 0.8), 9.5), 2)
+    app._plan_frontier.cache_clear()
+
+    plans = app.plan_goal(make_view(subjects), target, period='1', max_grades=3, max_per_subject=2)
+    expected = pareto(brute_force_efforts(app, subjects, target, 3, 2))
+
+    assert [plan['num_grades'] for plan in plans] == [n for n, _ in expected]
+    for plan, (_, effort) in zip(plans, expected):
+        assert plan['effort'] == pytest.approx(effort, abs=0.006)
+        grades = [(entry['subject'], grade) for entry in plan['grades'] for grade in entry['grades']]
+        assert len(grades) == plan['num_grades']
+        assert all(grade in app.ALLOWED_GRADES for _, grade in grades)
+        assert all(len(entry['grades']) <= 2 for entry in plan['grades'])
+        total = sum(total for total, _ in subjects.values()) + sum(grade for _, grade in grades)
+        assert total / (sum(count for _, count in subjects.values()) + len(grades)) >= target - 1e-9
+
+
+def test_overall_plan_uses_every_period(app):
+    view = make_view({'MATEMATICA': (20.0, 4), 'ITALIANO': (32.0, 4)})
+    view['periods']['2'] = {'sum': 12.0, 'count': 2, 'subjects': {'MATEMATICA': {'sum': 12.0, 'count': 2}}}
+    view['sum'] += 12.0
+    view['count'] += 2
+    app._plan_frontier.cache_clear()
+    plans = app.plan_goal(view, 7.0, max_grades=3, max_per_subject=2)
+    # Overall, a subject is all of its grades in every period
+    expected = pareto(brute_force_efforts(app, {'MATEMATICA': (32.0, 6), 'ITALIANO': (32.0, 4)}, 7.0, 3, 2))
+    assert [(plan['num_grades'], plan['effort']) for plan in plans] == [(n, round(effort, 2)) for n, effort in expected]
+
+
+def test_unreachable_target_has_no_plans(app):
+    assert app.plan_goal(make_view({'MATEMATICA': (8.0, 2)}), 9.9, period='1', max_grades=3) == []
+
+
+@pytest.mark.parametrize('total, count, target', [
+    (50.0, 10, 6.0), (50.0, 10, 7.0), (50.0, 10, 9.5), (60.0, 10, 7.0), (0.0, 0, 8.0), (7.0, 1, 6.0),
+])
+def test_optimal_grades_needed_matches_the_loop(app, total, count, target):
+    needed, plan = app.calculate_optimal_grades_needed(total, count, target)
+    if count and total / count >= target:
+        assert (needed, plan) == (0, [])
+        return
+    # The capped loop it replaced: add tens until the target is reached
+    n = 1
+    while (total + 10 * n) / (count + n) < target and n < app.PLANNER_MAX_GRADES:
+        n += 1
+    assert needed == n
+    assert len(plan) == n
+    assert all(grade in app.ALLOWED_GRADES for grade in plan)
+    assert (total + sum(plan)) / (count + n) >= target - 1e-9 or plan == [10] * n
@@ -0,0 +1,144 @@
+"""Grade history: changed averages only, day and week rollups, and the point before a range."""
+
+import copy
+import time
+from datetime import date, datetime
+
+import pytest
+from zoneinfo import ZoneInfo
+
+ROME = ZoneInfo('Europe/Rome')
+STUDENT = 'student'
+
+
+@pytest.fixture
+def history(app, tmp_path):
+    return app.GradeHistory(str(tmp_path / 'history.sqlite3'), tz=ROME)
+
+
+def views(**subjects):
+    """Views of one period with the given grades per subject, as view_series reads them."""
+    period = {'sum': 0, 'count': 0, 'subjects': {}}
+    for subject, values in subjects.items():
+        period['subjects'][subject] = {'sum': sum(values), 'count': len(values)}
+        period['sum'] += sum(values)
+        period['count'] += len(values)
+    return {'with_blue': {'sum': period['sum'], 'count': period['count'], 'periods': {'1': period}}}
+
+
+def at(*args):
+    return datetime(*args, tzinfo=ROME).timestamp()
+
+
+@pytest.mark.parametrize('moment, day, week', [
+    ((2025, 3, 2, 23, 30), '2025-03-02', '2025-02-24'),  # Sunday night, still last week
+    ((2025, 3, 3, 0, 30), '2025-03-03', '2025-03-03'),   # Monday after midnight in Rome, Sunday in UTC
+    ((2025, 3, 30, 3, 0), '2025-03-30', '2025-03-24'),   # the night clocks go forward
+    ((2025, 12, 31, 23, 59), '2025-12-31', '2025-12-29'),
+])
+def test_buckets_are_local_days_and_weeks_from_monday(history, moment, day, week):
+    assert history.buckets(at(*moment)) == (day, week)
+
+
+def test_only_changed_averages_are_written(app, history, make_payload):
+    payload = make_payload(60, 2)
+    document = app.build_grade_document(payload)
+    written = history.record(STUDENT, document['views'], at(2025, 3, 3, 9))
+    assert written == len(app.view_series(document['views']))
+    assert history.record(STUDENT, document['views'], at(2025, 3, 3, 10)) == 0
+
+    changed = copy.deepcopy(payload)
+    grade = next(grade for grade in changed['grades'] if grade['color'] == 'green')
+    grade['decimalValue'] = 1 if grade['decimalValue'] != 1 else 10
+    # Its subject, its period and the overall average, in both views
+    assert history.record(STUDENT, app.build_grade_document(changed)['views'], at(2025, 3, 3, 11)) == 6
+
+
+def test_day_rollup_keeps_the_last_value_and_the_range(history):
+    for hour, values in ((8, [6]), (12, [6, 9]), (16, [6, 9, 3]), (20, [6, 9, 3, 7])):
+        history.record(STUDENT, views(MATEMATICA=values), at(2025, 3, 4, hour))
+    [point] = history.points(STUDENT, 'with_blue', '1', 'MATEMATICA', 'day')
+    assert point == {'date': '2025-03-04', 'count': 4, 'avr': 6.25, 'min': 6, 'max': 7.5, 'samples': 4}
+
+
+def test_week_rollup_spans_its_days(history):
+    history.record(STUDENT, views(MATEMATICA=[8]), at(2025, 3, 3, 9))    # Monday
+    history.record(STUDENT, views(MATEMATICA=[8, 4]), at(2025, 3, 5, 9))  # Wednesday
+    history.record(STUDENT, views(MATEMATICA=[8, 4, 9]), at(2025, 3, 9, 23, 59))  # Sunday
+    history.record(STUDENT, views(MATEMATICA=[8, 4, 9, 10]), at(2025, 3, 10, 0, 1))  # next Monday
+    days = history.points(STUDENT, 'with_blue', '', '', 'day')
+    assert [point['date'] for point in days] == ['2025-03-03', '2025-03-05', '2025-03-09', '2025-03-10']
+    weeks = history.points(STUDENT, 'with_blue', '', '', 'week')
+    assert weeks == [
+        {'date': '2025-03-03', 'count': 3, 'avr': 7, 'min': 6, 'max': 8, 'samples': 3},
+        {'date': '2025-03-10', 'count': 4, 'avr': 7.75, 'min': 7.75, 'max': 7.75, 'samples': 1},
+    ]
+
+
+@pytest.mark.parametrize('resolution, key', [('day', 'date'), ('week', 'date'), ('sync', 'at')])
+def test_range_starts_with_the_point_before_it(history, resolution, key):
+    history.record(STUDENT, views(STORIA=[5]), at(2025, 1, 10, 9))
+    history.record(STUDENT, views(STORIA=[5, 7]), at(2025, 2, 10, 9))
+    history.record(STUDENT, views(STORIA=[5, 7, 9]), at(2025, 3, 10, 9))
+    history.record(STUDENT, views(STORIA=[5, 7, 9, 9]), at(2025, 4, 10, 9))
+
+    points = history.points(STUDENT, 'with_blue', '1', 'STORIA', resolution, date(2025, 2, 10), date(2025, 3, 31))
+    assert [point['count'] for point in points] == [1, 2, 3]
+    assert points[1][key].startswith('2025-02-') and points[2][key].startswith('2025-03-')
+    # Nothing before the first point, nothing after the last
+    assert [p['count'] for p in history.points(STUDENT, 'with_blue', '1', 'STORIA', resolution, None, date(2025, 1, 31))] == [1]
+    assert [p['count'] for p in history.points(STUDENT, 'with_blue', '1', 'STORIA', resolution, date(2025, 5, 1))] == [4]
+
+
+def test_sync_points_are_local_times(history):
+    history.record(STUDENT, views(FISICA=[6]), at(2025, 7, 1, 0, 15))
+    [point] = history.points(STUDENT, 'with_blue', '1', 'FISICA', 'sync')
+    assert point == {'at': '2025-07-01T00:15:00+02:00', 'count': 1, 'avr': 6}
+    assert history.points(STUDENT, 'with_blue', '1', 'FISICA', 'sync', end=date(2025, 6, 30)) == []
+
+
+def test_series_are_per_student(history):
+    history.record(STUDENT, views(INGLESE=[8]), at(2025, 3, 3, 9))
+    assert history.points('other', 'with_blue', '1', 'INGLESE') == []
+    assert history.points(STUDENT, 'with_blue', '1', 'LATINO') == []
+
+
+@pytest.fixture
+def history_client(app, history, grades_client, monkeypatch):
+    """A session whose grades were recorded in history when its document was built."""
+    monkeypatch.setattr(app, 'grade_history', history)
+    return grades_client()
+
+
+def test_history_route(app, history, history_client):
+    client, document = history_client
+    period = sorted(document['views'][app.VIEW_WITH_BLUE]['periods'])[0]
+    response = client.get('/grades/history', query_string={'period': period, 'resolution': 'week'})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body['period'], body['subject'], body['resolution']) == (period, '', 'week')
+    period_view = document['views'][app.VIEW_WITH_BLUE]['periods'][period]
+    avr = pytest.approx(period_view['sum'] / period_view['count'])
+    assert body['points'] == [{'date': history.buckets(time.time())[1], 'count': period_view['count'],
+                               'avr': avr, 'min': avr, 'max': avr, 'samples': 1}]
+
+
+@pytest.mark.parametrize('query', [
+    {'subject': 'MATEMATICA'},
+    {'resolution': 'month'},
+    {'from': '03/03/2025'},
+    {'to': '2025-02-30'},
+])
+def test_history_route_rejects_bad_parameters(history_client, query):
+    client, _ = history_client
+    assert client.get('/grades/history', query_string=query).status_code == 400
+
+
+def test_history_route_needs_a_session(app, history_client):
+    assert app.app.test_client().get('/grades/history').status_code == 401
+
+
+def test_history_route_without_history(app, grades_client, monkeypatch):
+    client, _ = grades_client()
+    monkeypatch.setattr(app, 'grade_history', None)
+    assert client.get('/grades/history').status_code == 404
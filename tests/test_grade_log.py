@@ -0,0 +1,129 @@
+"""Delta sync: the grade change log and merging changes into a stored document."""
+
+import copy
+import random
+
+import pytest
+
+from conftest import make_grade
+
+
+def sync(app, student, payload, document=None):
+    return app.build_student_document(*student, payload, app._payload_hash(payload), document)
+
+
+def edit(payload, seed):
+    """A later payload: some grades added, some modified, some removed."""
+    rng = random.Random(seed)
+    payload = copy.deepcopy(payload)
+    grades = payload['grades']
+    next_id = max(grade['evtId'] for grade in grades) + 1
+    for grade in rng.sample(grades, 3):
+        grade['decimalValue'] = rng.choice([3, 6.5, 10])
+    grades[rng.randrange(len(grades))]['subjectDesc'] = 'STORIA DELL\'ARTE'
+    del grades[rng.randrange(len(grades))]
+    grades.extend(make_grade(next_id + n, rng) for n in range(2))
+    return payload
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_merged_document_matches_rebuild(app, make_payload, student, grades_tree, seed):
+    payload = make_payload(40, seed)
+    document = sync(app, student, payload)
+    for step in range(3):
+        payload = edit(payload, seed * 10 + step)
+        merged = sync(app, student, payload, document)
+        assert merged['version'] == document['version'] + 1
+        rebuilt = app.build_grade_document(payload)
+        for view_name in (app.VIEW_WITH_BLUE, app.VIEW_WITHOUT_BLUE):
+            assert grades_tree(merged, view_name) == grades_tree(rebuilt, view_name)
+        document = merged
+
+
+def test_other_sessions_catch_up_through_the_log(app, make_payload, student, grades_tree):
+    payload = make_payload(30, 1)
+    behind = sync(app, student, payload)
+    ahead = behind
+    for step in range(3):
+        payload = edit(payload, step)
+        ahead = sync(app, student, payload, ahead)
+    # Same payload, already in the log: the lagging session merges three versions at once
+    caught_up = sync(app, student, payload, behind)
+    assert caught_up['version'] == ahead['version']
+    assert grades_tree(caught_up) == grades_tree(app.build_grade_document(payload))
+
+
+def test_expired_log_rebuilds_the_document(app, make_payload, student, grades_tree):
+    payload = make_payload(20, 2)
+    document = sync(app, student, payload)
+    app.grade_store.delete(app.grade_log_key(*student))
+
+    changed = copy.deepcopy(payload)
+    changed['grades'][1]['decimalValue'] = 4.0 if changed['grades'][1]['decimalValue'] != 4.0 else 8.0
+    rebuilt = sync(app, student, changed, document)
+
+    assert rebuilt['log_epoch'] != document['log_epoch']
+    assert rebuilt['version'] != document['version']
+    assert grades_tree(rebuilt) == grades_tree(app.build_grade_document(changed))
+    # The next sync of the same payload keeps the right grades
+    assert grades_tree(sync(app, student, changed, rebuilt)) == grades_tree(rebuilt)
+
+
+def test_document_of_another_epoch_is_not_merged(app, make_payload, student, grades_tree):
+    payload = make_payload(20, 3)
+    document = sync(app, student, payload)
+    app.grade_store.delete(app.grade_log_key(*student))
+    # Another session starts the new log at the same payload...
+    sync(app, student, payload)
+    # ...so its content hash matches, but the stored document is from the old epoch
+    changed = copy.deepcopy(payload)
+    del changed['grades'][0]
+    changed['grades'].append(make_grade(100, random.Random(3)))
+    sync(app, student, changed)
+    result = sync(app, student, changed, document)
+    assert result['log_epoch'] != document['log_epoch']
+    assert grades_tree(result) == grades_tree(app.build_grade_document(changed))
+
+
+def test_diff_grade_rows(app, make_payload):
+    payload = make_payload(10, 4)
+    table = app.document_table(app.build_grade_document(payload))
+    changed = copy.deepcopy(payload)
+    changed['grades'][0]['decimalValue'] = 1
+    del changed['grades'][1]
+    changed['grades'].append(make_grade(11, random.Random(4)))
+    rows = dict(app.grade_rows(changed))
+    assert app.diff_grade_rows(table, rows) == {1: 'modified', 2: 'removed', 11: 'added'}
+
+
+def test_grade_changes_since_nets_out_versions(app):
+    log = {'epoch': 100, 'version': 104, 'content_hash': 'h', 'history': [
+        [102, {'1': 'added', '2': 'modified', '3': 'modified'}],
+        [103, {'1': 'modified', '2': 'removed', '4': 'added'}],
+        [104, {'4': 'removed', '5': 'removed'}],
+    ]}
+    assert app.grade_changes_since(log, 101, 104) == {1: 'added', 2: 'removed', 3: 'modified', 5: 'removed'}
+    assert app.grade_changes_since(log, 103, 104) == {4: 'removed', 5: 'removed'}
+    assert app.grade_changes_since(log, 104, 104) == {}
+    # Older than the log, or from another epoch
+    assert app.grade_changes_since(log, 100, 104) is None
+    assert app.grade_changes_since(log, 7, 104) is None
+
+
+def test_changes_endpoint_resets_after_a_new_epoch(app, make_payload, student):
+    payload = make_payload(20, 5)
+    document = sync(app, student, payload)
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session.update(sid=f'tests-{student[1]}', login_type=student[0], user_id=student[1])
+    app.grade_store.set(app.grades_key(f'tests-{student[1]}'), document)
+
+    response = client.get(f"/grades/changes?since={document['version']}")
+    assert response.status_code == 200
+    assert response.get_json()['added'] == []
+
+    # The log expires and starts over: the stored document can't be patched from it
+    app.grade_store.delete(app.grade_log_key(*student))
+    sync(app, student, edit(payload, 5))
+    response = client.get(f"/grades/changes?since={document['version']}")
+    assert response.get_json()['reset'] is True
@@ -0,0 +1,158 @@
+"""/grades/stream: the hub fanning grade states out to open streams, and the one-shot stream of other workers."""
+
+import json
+import queue
+import threading
+
+import pytest
+
+
+def parse(chunks):
+    """The (id, event, data) of every event in the chunks, skipping retry lines and comments."""
+    events = []
+    for chunk in chunks:
+        fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n') if line and not line.startswith(('retry:', ':')))
+        if fields:
+            events.append((fields['id'], fields['event'], json.loads(fields['data'])))
+    return events
+
+
+class Consumer:
+    """Runs an event generator in a thread and hands its chunks out as they are yielded."""
+
+    def __init__(self, events):
+        self.chunks = queue.Queue()
+        self.thread = threading.Thread(target=self._run, args=(events,), daemon=True)
+        self.thread.start()
+
+    def _run(self, events):
+        for chunk in events:
+            self.chunks.put(chunk)
+        self.chunks.put(None)
+
+    def next(self, timeout=5):
+        return self.chunks.get(timeout=timeout)
+
+    def next_event(self):
+        while True:
+            chunk = self.next()
+            assert chunk is not None, 'stream ended'
+            if not chunk.startswith(('retry:', ':')):
+                return parse([chunk])[0]
+
+
+@pytest.fixture
+def hub(app, monkeypatch):
+    """A hub of its own, so no test sees the streams of another."""
+    hub = app.GradeStreamHub(app.grade_store)
+    monkeypatch.setattr(app, 'grade_stream_hub', hub)
+    return hub
+
+
+def grades_etag(client):
+    etag = client.get('/grades').headers['ETag']
+    assert etag.startswith('W/"') and etag.endswith('"')
+    return etag[3:-1]
+
+
+def test_fallback_stream_sends_the_current_state_and_closes(app, grades_client, hub):
+    client, document = grades_client()
+    assert not app.cooperative_workers()
+    response = client.get('/grades/stream')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    body = response.get_data(as_text=True)
+    assert body.startswith(f'retry: {app.STREAM_FALLBACK_RETRY * 1000}\n\n')
+    etag = grades_etag(client)
+    assert parse(body.split('\n\n')) == [(etag, 'grades', {'version': document['version'], 'etag': f'W/"{etag}"'})]
+    assert hub._streams == {}
+
+
+def test_fallback_stream_is_empty_for_a_client_that_is_current(app, grades_client, hub):
+    client, _ = grades_client()
+    etag = grades_etag(client)
+    body = client.get('/grades/stream', headers={'Last-Event-ID': etag}).get_data(as_text=True)
+    assert body == f'retry: {app.STREAM_FALLBACK_RETRY * 1000}\n\n'
+    client.post('/set_blue_grade_preference', json={'include_blue_grades': False})
+    events = parse(client.get('/grades/stream', headers={'Last-Event-ID': etag}).get_data(as_text=True).split('\n\n'))
+    assert [event_id for event_id, _, _ in events] == [grades_etag(client)]
+
+
+def test_stream_requires_a_session(app):
+    assert app.app.test_client().get('/grades/stream').status_code == 401
+
+
+@pytest.fixture
+def short_streams(app, monkeypatch):
+    monkeypatch.setattr(app, 'STREAM_HEARTBEAT', 0.1)
+    monkeypatch.setattr(app, 'STREAM_MAX_AGE', 1)
+
+
+def test_cooperative_stream_follows_published_states(app, hub, short_streams):
+    state = {'source_hash': 'a' * 64, 'version': 1}
+    consumer = Consumer(app.grade_stream_events('sid-1', state, app.VIEW_WITH_BLUE, None, cooperative=True))
+    assert consumer.next() == f'retry: {app.STREAM_RETRY * 1000}\n\n'
+    first = consumer.next_event()
+    assert first[0] == app.view_etag('a' * 64, app.VIEW_WITH_BLUE, 'grades', '*')
+    assert first[2] == {'version': 1, 'etag': f'W/"{first[0]}"'}
+
+    hub.publish('sid-1', source_hash='b' * 64, version=2)
+    assert consumer.next_event()[2]['version'] == 2
+    # A new view of the same grades is a new tree; the same state again is not
+    hub.publish('sid-1', view=app.VIEW_WITHOUT_BLUE)
+    event_id, _, _ = consumer.next_event()
+    assert event_id == app.view_etag('b' * 64, app.VIEW_WITHOUT_BLUE, 'grades', '*')
+    hub.publish('sid-1', view=app.VIEW_WITHOUT_BLUE)
+    assert consumer.next() == ': ping\n\n'
+
+    # Closed after STREAM_MAX_AGE, and unsubscribed
+    while consumer.next() is not None:
+        pass
+    consumer.thread.join(5)
+    assert hub._streams == {}
+
+
+def test_every_stream_of_a_session_gets_the_state(app, hub, short_streams):
+    consumers = [Consumer(app.grade_stream_events('sid-2', None, app.VIEW_WITH_BLUE, None, cooperative=True))
+                 for _ in range(3)]
+    other = Consumer(app.grade_stream_events('sid-3', None, app.VIEW_WITH_BLUE, None, cooperative=True))
+    for consumer in consumers + [other]:
+        assert consumer.next().startswith('retry:')
+    hub.publish('sid-2', source_hash='c' * 64, version=5)
+    for consumer in consumers:
+        assert consumer.next_event()[2]['version'] == 5
+    assert other.next() == ': ping\n\n'
+
+
+def test_other_workers_see_the_state_on_their_next_poll(app, hub):
+    # Two hubs on one store: two gunicorn workers
+    other_worker = app.GradeStreamHub(app.grade_store)
+    stream = hub.subscribe('sid-4')
+    other_worker.publish('sid-4', source_hash='d' * 64, version=7)
+    with pytest.raises(queue.Empty):
+        stream.get_nowait()
+    hub.poll()
+    assert stream.get_nowait() == {'source_hash': 'd' * 64, 'version': 7}
+    hub.poll()  # unchanged: nothing new to hand out
+    with pytest.raises(queue.Empty):
+        stream.get_nowait()
+    other_worker.publish('sid-4', view=app.VIEW_WITHOUT_BLUE)
+    hub.poll()
+    assert stream.get_nowait() == {'source_hash': 'd' * 64, 'version': 7, 'view': app.VIEW_WITHOUT_BLUE}
+    hub.unsubscribe('sid-4', stream)
+    assert hub._streams == {} and hub._states == {}
+
+
+def test_saving_a_document_publishes_it(app, hub, grades_client, student):
+    client, document = grades_client()
+    sid = f'tests-{student[1]}'
+    stream = hub.subscribe(sid)
+    app.publish_grade_document(sid, document)
+    state = stream.get_nowait()
+    assert state == {'source_hash': document['source_hash'], 'version': document['version']}
+    # The event id of the state is the ETag of /grades
+    assert app.view_etag(state['source_hash'], app.VIEW_WITH_BLUE, 'grades', '*') == grades_etag(client)
+    client.post('/set_blue_grade_preference', json={'include_blue_grades': False})
+    assert stream.get_nowait()['view'] == app.VIEW_WITHOUT_BLUE
+    hub.unsubscribe(sid, stream)
@@ -0,0 +1,114 @@
+"""Slices of the grades tree: ?fields= on /grades and the single subject of /subject_detail."""
+
+import copy
+import random
+import urllib.parse
+
+import pytest
+
+from conftest import make_grade
+
+
+@pytest.mark.parametrize('fields, keys', [
+    ('count,avr', {'count', 'avr'}),
+    ('grades', {'grades'}),
+    (' avr , count,avr', {'count', 'avr'}),
+    ('count,avr,grades', {'count', 'avr', 'grades'}),
+])
+def test_fields_keep_only_the_requested_keys(grades_client, fields, keys):
+    client, _ = grades_client()
+    full = client.get('/grades').get_json()
+    response = client.get('/grades', query_string={'fields': fields})
+    assert response.status_code == 200
+    projected = response.get_json()
+    assert projected['all_avr'] == full['all_avr']
+    assert projected.keys() == full.keys()
+    for period, subjects in full.items():
+        if period == 'all_avr':
+            continue
+        assert projected[period]['period_avr'] == subjects['period_avr']
+        for subject, node in subjects.items():
+            if subject != 'period_avr':
+                assert projected[period][subject] == {key: node[key] for key in keys}
+
+
+@pytest.mark.parametrize('fields', ['avg', 'count,teacher', '', ' , '])
+def test_invalid_fields_are_a_400(grades_client, fields):
+    client, _ = grades_client()
+    response = client.get('/grades', query_string={'fields': fields})
+    assert response.status_code == 400
+    assert response.get_json()['error']
+
+
+def test_etag_depends_on_the_fields_but_not_their_order(grades_client):
+    client, _ = grades_client()
+    everything = client.get('/grades').headers['ETag']
+    averages = client.get('/grades?fields=avr,count').headers['ETag']
+    assert averages != everything
+    assert client.get('/grades?fields=count,avr').headers['ETag'] == averages
+    assert client.get('/grades?fields=count,avr', headers={'If-None-Match': averages}).status_code == 304
+    assert client.get('/grades', headers={'If-None-Match': averages}).status_code == 200
+
+
+def subject_detail(client, subject, **headers):
+    return client.get('/subject_detail/' + urllib.parse.quote(subject, safe=''), headers=headers)
+
+
+def test_subject_slice_matches_the_full_tree(grades_client):
+    client, _ = grades_client()
+    full = client.get('/grades').get_json()
+    subjects = {subject for period, tree in full.items() if period != 'all_avr' for subject in tree} - {'period_avr'}
+    for subject in subjects:
+        body = subject_detail(client, subject).get_json()
+        assert body['subject_name'] == subject
+        expected = {period: {subject: tree[subject], 'period_avr': tree['period_avr']}
+                    for period, tree in full.items() if period != 'all_avr' and subject in tree}
+        expected['all_avr'] = full['all_avr']
+        assert body['grades_avr'] == expected
+
+
+def test_subject_names_with_spaces_accents_and_quotes(app, grades_client, make_payload):
+    payload = make_payload(30, 5)
+    payload['grades'][0]['subjectDesc'] = "ATTIVITÀ ALTERNATIVA"
+    payload['grades'][1]['subjectDesc'] = "STORIA DELL'ARTE"
+    client, _ = grades_client(payload)
+    for subject in ("ATTIVITÀ ALTERNATIVA", "STORIA DELL'ARTE"):
+        response = subject_detail(client, subject)
+        assert response.status_code == 200
+        grades = [grade for period, tree in response.get_json()['grades_avr'].items() if period != 'all_avr'
+                  for grade in tree[subject]['grades']]
+        assert len(grades) == 1
+
+
+def test_unknown_subject_is_a_404(grades_client):
+    client, _ = grades_client()
+    assert subject_detail(client, 'MATERIA INESISTENTE').status_code == 404
+    assert subject_detail(client, 'period_avr').status_code == 404
+    assert subject_detail(client, 'all_avr').status_code == 404
+
+
+def test_subject_slice_revalidates_with_its_etag(grades_client):
+    client, _ = grades_client()
+    response = subject_detail(client, 'MATEMATICA')
+    etag = response.headers['ETag']
+    assert subject_detail(client, 'MATEMATICA', **{'If-None-Match': etag}).status_code == 304
+    assert subject_detail(client, 'ITALIANO', **{'If-None-Match': etag}).status_code == 200
+    client.post('/set_blue_grade_preference', json={'include_blue_grades': False})
+    assert subject_detail(client, 'MATEMATICA', **{'If-None-Match': etag}).status_code == 200
+
+
+def test_subject_index_follows_merged_changes(app, grades_client, make_payload, student):
+    payload = make_payload(40, 6)
+    client, document = grades_client(payload)
+    changed = copy.deepcopy(payload)
+    for grade in changed['grades']:
+        if grade['subjectDesc'] == 'LATINO':
+            grade['subjectDesc'] = 'GRECO'
+    changed['grades'].append(dict(make_grade(1000, random.Random(6)), subjectDesc='CHIMICA'))
+    merged = app.build_student_document(*student, changed, app._payload_hash(changed), document)
+    assert merged['version'] == document['version'] + 1
+    app.grade_store.set(app.grades_key(f'tests-{student[1]}'), merged)
+
+    assert subject_detail(client, 'LATINO').status_code == 404
+    for subject in ('GRECO', 'CHIMICA'):
+        assert subject_detail(client, subject).status_code == 200
@@ -0,0 +1,111 @@
+"""FastJSONProvider: orjson output means the same as Flask's own provider, byte for byte where it can."""
+
+import dataclasses
+import decimal
+import json
+import uuid
+from datetime import date, datetime, timezone
+
+import pytest
+from flask.json.provider import DefaultJSONProvider
+
+pytest.importorskip('orjson')
+
+
+@dataclasses.dataclass
+class Point:
+    date: str
+    avr: float
+
+
+VALUES = [
+    {'b': 1, 'a': [1, 2.5, None, True, False], 'c': {'z': 'x', 'y': ''}},
+    {'subject': 'ATTIVITÀ ALTERNATIVA', 'notes': 'verifica "lunga" <b>\n\t\\ ', 'emoji': '📚'},
+    [0.1, 6.25, 1e16, -0.0, 2 ** 53, -(2 ** 63), 1 / 3],
+    {'when': datetime(2025, 3, 3, 9, 30, tzinfo=timezone.utc), 'day': date(2025, 3, 3)},
+    {'id': uuid.UUID(int=12345), 'exact': decimal.Decimal('7.25'), 'point': Point('2025-03-03', 6.5)},
+    {1: 'int keys', 2: 'are strings'},
+    [],
+    {},
+    'text',
+    7,
+]
+
+
+@pytest.fixture
+def providers(app, monkeypatch):
+    monkeypatch.setattr(app, 'FAST_JSON', True)
+    with app.app.app_context():
+        yield app.FastJSONProvider(app.app), DefaultJSONProvider(app.app)
+
+
+@pytest.mark.parametrize('value', VALUES)
+def test_dumps_means_the_same(providers, value):
+    fast, stdlib = providers
+    assert json.loads(fast.dumps(value)) == json.loads(stdlib.dumps(value))
+    assert fast.loads(fast.dumps(value)) == stdlib.loads(stdlib.dumps(value))
+
+
+@pytest.mark.parametrize('value', VALUES)
+def test_responses_mean_the_same(providers, value):
+    fast, stdlib = providers
+    fast_response, stdlib_response = fast.response(value), stdlib.response(value)
+    assert fast_response.mimetype == stdlib_response.mimetype == 'application/json'
+    assert fast_response.get_data().endswith(b'\n')
+    assert json.loads(fast_response.get_data()) == json.loads(stdlib_response.get_data())
+
+
+def test_grades_tree_is_byte_for_byte_the_same(app, providers, grades_client):
+    # ASCII and plain floats: only \u escapes and exponents (1e+16 / 1e16) are spelled differently
+    fast, stdlib = providers
+    _, document = grades_client()
+    tree = app.document_table(document).to_grades_avr(document['views'][app.VIEW_WITH_BLUE])
+    assert fast.response(tree).get_data() == stdlib.response(tree).get_data()
+
+
+def test_non_ascii_is_written_as_utf8(providers):
+    fast, stdlib = providers
+    value = {'subject': 'ATTIVITÀ'}
+    assert fast.response(value).get_data() == '{"subject":"ATTIVITÀ"}\n'.encode('utf-8')
+    assert stdlib.response(value).get_data() == b'{"subject":"ATTIVIT\\u00c0"}\n'
+
+
+def test_other_arguments_and_debug_use_the_json_module(app, providers, monkeypatch):
+    fast, stdlib = providers
+    value = {'b': [1, 2], 'a': 'x'}
+    assert fast.dumps(value, indent=2) == stdlib.dumps(value, indent=2)
+    assert fast.loads('{"a": 1.5}', parse_float=decimal.Decimal) == {'a': decimal.Decimal('1.5')}
+    monkeypatch.setattr(app.app, 'debug', True)
+    assert fast.response(value).get_data() == stdlib.response(value).get_data()
+
+
+def test_unserializable_values_are_a_type_error(providers):
+    for provider in providers:
+        with pytest.raises(TypeError):
+            provider.dumps({'value': object()})
+        with pytest.raises(TypeError):
+            provider.response({'value': {1, 2}})
+
+
+def test_session_cookies_load_with_either_provider(app, monkeypatch):
+    session = {'sid': 'abc', 'user_id': 'S1234567', 'login_type': 'userid', 'name': 'Niccolò',
+               'when': datetime(2025, 3, 3, tzinfo=timezone.utc), 'include_blue_grades': False}
+    with app.app.app_context():
+        serializer = app.app.session_interface.get_signing_serializer(app.app)
+        monkeypatch.setattr(app, 'FAST_JSON', True)
+        fast_cookie = serializer.dumps(session)
+        monkeypatch.setattr(app, 'FAST_JSON', False)
+        stdlib_cookie = serializer.dumps(session)
+        assert serializer.loads(fast_cookie) == session
+        monkeypatch.setattr(app, 'FAST_JSON', True)
+        assert serializer.loads(stdlib_cookie) == session
+
+
+@pytest.mark.parametrize('value', VALUES[:3] + VALUES[6:])
+def test_store_encoding_matches_the_json_module(app, monkeypatch, value):
+    monkeypatch.setattr(app, 'FAST_JSON', True)
+    fast = app.dumps_json(value, sort_keys=True)
+    monkeypatch.setattr(app, 'FAST_JSON', False)
+    stdlib = app.dumps_json(value, sort_keys=True)
+    assert json.loads(fast) == json.loads(stdlib)
+    assert app.loads_json(fast) == app.loads_json(stdlib.encode('utf-8'))
@@ -0,0 +1,91 @@
+"""JSON responses: content negotiation of the compression, and conditional requests on the grades."""
+
+import gzip
+import json
+
+import pytest
+
+
+def grades(client, **headers):
+    return client.get('/grades', headers=headers)
+
+
+@pytest.fixture
+def brotli():
+    return pytest.importorskip('brotli')
+
+
+def test_gzip_when_the_client_accepts_it(grades_client):
+    client, _ = grades_client()
+    plain = grades(client)
+    assert 'Content-Encoding' not in plain.headers
+    response = grades(client, **{'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(response.get_data())) == plain.get_json()
+    assert len(response.get_data()) < len(plain.get_data())
+
+
+def test_brotli_unless_the_client_prefers_gzip(app, grades_client, brotli, monkeypatch):
+    client, _ = grades_client()
+    plain = grades(client).get_json()
+    response = grades(client, **{'Accept-Encoding': 'gzip, deflate, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert json.loads(brotli.decompress(response.get_data())) == plain
+    assert grades(client, **{'Accept-Encoding': 'gzip;q=1, br;q=0.5'}).headers['Content-Encoding'] == 'gzip'
+    assert grades(client, **{'Accept-Encoding': 'br;q=0, gzip'}).headers['Content-Encoding'] == 'gzip'
+    monkeypatch.setattr(app, 'BROTLI_AVAILABLE', False)
+    assert grades(client, **{'Accept-Encoding': 'br, gzip;q=0.1'}).headers['Content-Encoding'] == 'gzip'
+
+
+@pytest.mark.parametrize('accept', ['identity', 'deflate', 'gzip;q=0'])
+def test_unsupported_encodings_get_plain_json(grades_client, accept):
+    client, _ = grades_client()
+    response = grades(client, **{'Accept-Encoding': accept})
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_json()
+
+
+def test_small_responses_are_not_compressed(app, grades_client):
+    client, _ = grades_client()
+    response = client.get('/api/session', headers={'Accept-Encoding': 'gzip'})
+    assert len(response.get_data()) < app.JSON_COMPRESS_MIN_SIZE
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_json() == {'authenticated': True}
+
+
+@pytest.mark.parametrize('accept', [None, 'gzip', 'identity'])
+def test_json_varies_on_accept_encoding(grades_client, accept):
+    client, _ = grades_client()
+    headers = {'Accept-Encoding': accept} if accept else {}
+    for path in ('/grades', '/api/session'):
+        assert 'Accept-Encoding' in client.get(path, headers=headers).vary
+
+
+def test_matching_etag_is_a_304_without_a_body(grades_client):
+    client, _ = grades_client()
+    response = grades(client, **{'Accept-Encoding': 'gzip'})
+    etag = response.headers['ETag']
+    assert etag.startswith('W/"')
+    assert response.cache_control.no_cache and response.cache_control.private
+
+    not_modified = grades(client, **{'If-None-Match': etag, 'Accept-Encoding': 'gzip'})
+    assert not_modified.status_code == 304
+    assert not_modified.get_data() == b''
+    assert not_modified.headers['ETag'] == etag
+    assert 'Content-Encoding' not in not_modified.headers
+    # The same tag covers the plain and the compressed body
+    assert grades(client, **{'If-None-Match': etag}).status_code == 304
+    assert grades(client, **{'If-None-Match': f'"other", {etag}'}).status_code == 304
+    assert grades(client, **{'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_etag_changes_with_the_view_and_the_grades(app, grades_client, make_payload):
+    client, _ = grades_client()
+    etag = grades(client).headers['ETag']
+    client.post('/set_blue_grade_preference', json={'include_blue_grades': False})
+    response = grades(client, **{'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+    client, _ = grades_client(make_payload(120, seed=1))
+    assert grades(client, **{'If-None-Match': etag}).status_code == 200
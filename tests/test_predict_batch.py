@@ -0,0 +1,122 @@
+"""/predict_batch: many what-if scenarios in one call, each computed or rejected on its own."""
+
+import copy
+import random
+
+import pytest
+
+from conftest import make_grade
+
+
+def with_grades(payload, period, subject, values):
+    """The payload with standalone grades added to a subject, as if they had been given."""
+    payload = copy.deepcopy(payload)
+    rng = random.Random(0)
+    next_id = max(grade['evtId'] for grade in payload['grades']) + 1
+    for n, value in enumerate(values):
+        grade = make_grade(next_id + n, rng)
+        grade.update(subjectDesc=subject, periodPos=int(period) + 1, decimalValue=value, componentDesc='', color='green')
+        payload['grades'].append(grade)
+    return payload
+
+
+def averages(app, payload, period, subject):
+    view = app.build_grade_document(payload)['views'][app.VIEW_WITH_BLUE]
+    return (app._view_avr(view['periods'][period]['subjects'][subject]),
+            app._view_avr(view['periods'][period]), app._view_avr(view))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_scenarios_match_a_rebuild_with_the_grades_added(app, make_payload, grades_client, seed):
+    payload = make_payload(100, seed)
+    client, document = grades_client(payload)
+    rng = random.Random(seed)
+    view = document['views'][app.VIEW_WITH_BLUE]
+    scenarios = []
+    for _ in range(10):
+        period = rng.choice(sorted(view['periods']))
+        subject = rng.choice(sorted(view['periods'][period]['subjects']))
+        scenarios.append({'period': period, 'subject': subject,
+                          'predicted_grades': [rng.choice([2, 5.5, 6, 7.25, 10]) for _ in range(rng.randint(1, 4))]})
+
+    response = client.post('/predict_batch', json={'scenarios': scenarios})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['current_overall_average'] == round(app._view_avr(view), 2)
+    assert len(body['results']) == len(scenarios)
+    for scenario, result in zip(scenarios, body['results']):
+        period, subject, values = scenario['period'], scenario['subject'], scenario['predicted_grades']
+        before = averages(app, payload, period, subject)
+        after = averages(app, with_grades(payload, period, subject, values), period, subject)
+        assert (result['period'], result['subject'], result['num_predicted_grades']) == (period, subject, len(values))
+        for name, current, predicted in zip(('average', 'period_average', 'overall_average'), before, after):
+            assert result[f'current_{name}'] == round(current, 2)
+            assert result[f'predicted_{name}'] == round(predicted, 2)
+            assert result[f'{name}_change'] == round(predicted - current, 2)
+
+
+def test_subject_average_matches_predict_average(grades_client):
+    client, document = grades_client()
+    period = sorted(document['views']['with_blue']['periods'])[0]
+    subject = sorted(document['views']['with_blue']['periods'][period]['subjects'])[0]
+    single = client.post('/predict_average', json={'period': period, 'subject': subject, 'predicted_grades': [9, 4]}).get_json()
+    batch = client.post('/predict_batch', json={'scenarios': [
+        {'period': period, 'subject': subject, 'predicted_grades': [9, 4]}]}).get_json()['results'][0]
+    assert (batch['current_average'], batch['predicted_average'], batch['average_change']) == \
+        (single['current_average'], single['predicted_average'], single['change'])
+
+
+def test_invalid_scenarios_get_their_own_error(grades_client):
+    client, document = grades_client()
+    period = sorted(document['views']['with_blue']['periods'])[0]
+    subject = sorted(document['views']['with_blue']['periods'][period]['subjects'])[0]
+    valid = {'period': period, 'subject': subject, 'predicted_grades': [8]}
+    scenarios = [
+        'not a scenario',
+        {'period': period, 'subject': subject, 'predicted_grades': []},
+        {'period': period, 'subject': subject},
+        {'period': period, 'subject': subject, 'predicted_grades': [8, 11]},
+        {'period': period, 'subject': subject, 'predicted_grades': ['8']},
+        {'period': period, 'subject': 'MATERIA INESISTENTE', 'predicted_grades': [8]},
+        {'period': '9', 'subject': subject, 'predicted_grades': [8]},
+        valid,
+    ]
+    response = client.post('/predict_batch', json={'scenarios': scenarios})
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [result.get('error') for result in results] == [
+        'Scenario non valido',
+        'Inserisci almeno un voto previsto',
+        'Inserisci almeno un voto previsto',
+        'Tutti i voti devono essere tra 1 e 10',
+        'Tutti i voti devono essere tra 1 e 10',
+        'Materia o periodo non trovato',
+        'Materia o periodo non trovato',
+        None,
+    ]
+    assert results[-1]['predicted_average'] is not None
+
+
+@pytest.mark.parametrize('body, status', [
+    ({}, 400),
+    ({'scenarios': []}, 400),
+    ({'scenarios': {'period': '1'}}, 400),
+])
+def test_requests_without_scenarios_are_rejected(grades_client, body, status):
+    client, _ = grades_client()
+    assert client.post('/predict_batch', json=body).status_code == status
+
+
+def test_too_many_scenarios_are_rejected(app, grades_client):
+    client, document = grades_client()
+    period = sorted(document['views']['with_blue']['periods'])[0]
+    subject = sorted(document['views']['with_blue']['periods'][period]['subjects'])[0]
+    scenario = {'period': period, 'subject': subject, 'predicted_grades': [7]}
+    assert client.post('/predict_batch', json={'scenarios': [scenario] * app.PREDICT_BATCH_MAX_SCENARIOS}).status_code == 200
+    response = client.post('/predict_batch', json={'scenarios': [scenario] * (app.PREDICT_BATCH_MAX_SCENARIOS + 1)})
+    assert response.status_code == 400
+
+
+def test_predict_batch_needs_a_session(app):
+    response = app.app.test_client().post('/predict_batch', json={'scenarios': [{}]})
+    assert response.status_code == 401
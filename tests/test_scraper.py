@@ -0,0 +1,91 @@
+"""Email-login grades page: the fast parser must read exactly what the full parse reads."""
+
+import random
+
+import pytest
+import requests
+
+SUBJECTS = ['MATEMATICA', 'ITALIANO', 'SCIENZE MOTORIE', 'ATTIVITÀ ALTERNATIVA']
+
+
+def grades_page(app, seed=0, grades_per_subject=6):
+    """A page shaped like genitori_voti.php, with the quirks of the real one."""
+    rng = random.Random(seed)
+    marks = list(app.MARK_TABLE) + ['g', 'nc']  # unknown marks are skipped
+    parts = ['<!DOCTYPE html><html><head><title>ClasseViva</title>',
+             '<script>var menu = {"voce": "<table sessione=\\"S9\\">"};</script></head><body>',
+             '<span class="scuola">ISTITUTO DI PROVA</span>',
+             '<form action="/cerca.php" id="ricerca"><input name="q"></form>']
+    evt_id = 500
+    for period in (1, 2):
+        parts.append(f'<div class="tab"><table sessione="S{period}" class="registro">'
+                     '<thead><tr><th>Materia</th></tr></thead><tbody>')
+        for subject_id, subject in enumerate(SUBJECTS, start=1):
+            parts.append(f'<tr class="riga_competenza_default" materia_id="{subject_id}"><td>{subject}</td></tr>')
+            parts.append(f'<tr class="riga_materia_componente"><td class="materia"> {subject.lower()} </td>')
+            for _ in range(grades_per_subject):
+                evt_id += 1
+                css = 'f_reg_voto_dettaglio' if rng.random() < 0.3 else 'voto_verde s_reg_testo'
+                # Whitespace between the children, like the real page
+                parts.append(f'<td class="cella_voto" evento_id="{evt_id}">\n  '
+                             f'<span class="voto_data">{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}</span>\n  '
+                             f'<p class="{css}"> {rng.choice(marks)} </p>\n</td>')
+            parts.append('<td class="cella_voto"><span>01/01</span></td></tr>')
+        parts.append('</tbody></table></div>')
+    # Not a period table, and a period table without a number or a body
+    parts.append('<table class="legenda"><tbody><tr class="riga_materia_componente"><td>X</td>'
+                 '<td class="cella_voto" evento_id="1"><span>01/01</span><p>10</p></td></tr></tbody></table>')
+    parts.append('<table sessione="finale"><tbody><tr class="riga_materia_componente"><td>Storia</td>'
+                 '<td class="cella_voto" evento_id="2"><span>02/02</span><p>7½</p></td></tr></tbody></table>')
+    parts.append('<table sessione="S3"><tr><td>vuota</td></tr></table>')
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+@pytest.fixture(params=['lxml', 'html.parser'])
+def tree_builder(request, app, monkeypatch):
+    if request.param == 'lxml':
+        pytest.importorskip('lxml')
+    monkeypatch.setattr(app, 'SCRAPER_PARSER', request.param)
+    return request.param
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_fast_parser_matches_full_parse(app, tree_builder, seed):
+    html = grades_page(app, seed)
+    full = app.parse_grades_page(html, fast=False)
+    assert full['grades']
+    assert app.parse_grades_page(html, fast=True) == full
+
+
+@pytest.mark.parametrize('extra', [
+    '<form data-action="/auth" method="post"><input name="voto"></form>',
+    '<form data-id="login_form" action="/cerca.php"></form>',
+    '<!-- <form id="login_form"> -->',
+    '<script>var login = \'<form action="/auth-sso/login.php">\';</script>',
+])
+def test_login_form_lookalikes_are_not_a_login(app, tree_builder, extra):
+    html = grades_page(app).replace('<span class="scuola">', extra + '<span class="scuola">')
+    full = app.parse_grades_page(html, fast=False)
+    assert full['grades']
+    assert app.parse_grades_page(html, fast=True) == full
+
+
+@pytest.mark.parametrize('page', [
+    '<html><body><form id="login_form" method="post"><input name="uid"></form></body></html>',
+    '<html><body><form method=post action=/auth-sso/login.php><input></form></body></html>',
+    "<html><body><FORM ACTION='/home/app/default/Login.php'></FORM></body></html>",
+    '<html><body><form title="a > b" data-action="/x" id="login_form"></form></body></html>',
+    '<html><body><h1>Autenticazione</h1><p>Accedi con la tua password</p></body></html>',
+])
+def test_login_page_is_a_401_on_both_paths(app, tree_builder, page):
+    for fast in (True, False):
+        with pytest.raises(requests.exceptions.HTTPError) as error:
+            app.parse_grades_page(page, fast=fast)
+        assert error.value.response.status_code == 401
+
+
+def test_words_of_the_login_page_elsewhere_are_not_a_login(app, tree_builder):
+    # All three words appear, but not in the visible text
+    html = grades_page(app).replace('</body>', '<!-- accedi password autenticazione --></body>')
+    assert app.parse_grades_page(html, fast=True) == app.parse_grades_page(html, fast=False)
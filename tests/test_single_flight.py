@@ -0,0 +1,137 @@
+"""Request coalescing: concurrent callers of a key share one call, within a worker and across workers."""
+
+import threading
+import time
+
+import pytest
+import requests
+
+
+class CountingCall:
+    """A call that counts how often it runs and blocks until released."""
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        assert self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def http_error(status):
+    response = requests.models.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"upstream {status}", response=response)
+
+
+def run_in_threads(count, target):
+    """Start count threads calling target(); returns their outcomes (result or exception) once joined."""
+    outcomes = [None] * count
+
+    def run(n):
+        try:
+            outcomes[n] = target()
+        except Exception as e:
+            outcomes[n] = e
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+
+def join(threads):
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+
+
+@pytest.fixture
+def store(app):
+    return app.MemoryStore()
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(app, monkeypatch):
+    monkeypatch.setattr(app, 'REFRESH_POLL_INTERVAL', 0.01)
+
+
+def test_callers_in_one_worker_share_the_leader_call(app, store):
+    flight = app.SingleFlight(store)
+    call = CountingCall(result={'grades': [1, 2]})
+    threads, outcomes = run_in_threads(8, lambda: flight.do('student', call))
+    assert call.started.wait(5)
+    time.sleep(0.1)  # the others are waiting on the leader's Future now
+    call.release.set()
+    join(threads)
+    assert call.calls == 1
+    assert outcomes == [{'grades': [1, 2]}] * 8
+
+
+def test_other_workers_wait_for_the_lease_holder(app, store):
+    # Two SingleFlights on one store: two gunicorn workers
+    leader, other = app.SingleFlight(store), app.SingleFlight(store)
+    call = CountingCall(result='fresh')
+    threads, outcomes = run_in_threads(1, lambda: leader.do('student', call))
+    assert call.started.wait(5)
+    assert store.get('flight:lease:student') is not None
+    waiting, waited = run_in_threads(3, lambda: other.do('student', lambda: pytest.fail('ran twice')))
+    time.sleep(0.1)
+    call.release.set()
+    join(threads + waiting)
+    assert outcomes == ['fresh'] and waited == ['fresh'] * 3
+    assert store.get('flight:lease:student') is None
+
+
+def test_result_is_shared_for_the_coalescing_window(app, store):
+    flight = app.SingleFlight(store, result_ttl=0.2)
+    calls = []
+    def call():
+        calls.append(1)
+        return len(calls)
+    assert flight.do('student', call) == 1
+    assert app.SingleFlight(store).do('student', call) == 1  # just finished in another worker
+    time.sleep(0.3)
+    assert flight.do('student', call) == 2
+    assert flight.do('other student', call) == 3
+
+
+def test_leader_http_error_is_shared_with_its_waiters(app, store):
+    leader, other = app.SingleFlight(store), app.SingleFlight(store)
+    call = CountingCall(error=http_error(401))
+    threads, outcomes = run_in_threads(3, lambda: leader.do('student', call))
+    assert call.started.wait(5)
+    waiting, waited = run_in_threads(2, lambda: other.do('student', lambda: pytest.fail('ran twice')))
+    time.sleep(0.1)
+    call.release.set()
+    join(threads + waiting)
+    assert call.calls == 1
+    for error in outcomes + waited:
+        assert isinstance(error, requests.exceptions.HTTPError)
+        assert error.response.status_code == 401
+
+
+def test_leader_failing_otherwise_lets_the_next_caller_retry(app, store):
+    flight = app.SingleFlight(store)
+    def broken():
+        raise ValueError('bad payload')
+    with pytest.raises(ValueError):
+        flight.do('student', broken)
+    assert store.get('flight:lease:student') is None
+    assert flight.do('student', lambda: 'ok') == 'ok'
+
+
+def test_lease_of_a_dead_leader_times_out(app, store):
+    flight = app.SingleFlight(store, lease_ttl=0.2)
+    store.add('flight:lease:student', 12345, ttl=60)  # a worker that was killed mid-call
+    started = time.time()
+    assert flight.do('student', lambda: 'direct') == 'direct'
+    assert 0.2 <= time.time() - started < 2
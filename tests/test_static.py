@@ -0,0 +1,27 @@
+"""Frontend route: only the files of the built frontend are matched."""
+
+import pytest
+
+
+@pytest.fixture
+def client(app):
+    if not app.STANDALONE_MODE:
+        pytest.skip('the frontend is only served in STANDALONE_MODE')
+    return app.app.test_client()
+
+
+@pytest.mark.parametrize('method', ['get', 'post', 'put', 'delete'])
+def test_unknown_paths_are_404_for_every_method(client, method):
+    assert getattr(client, method)('/api/nope').status_code == 404
+    assert getattr(client, method)('/js/api.js/nope').status_code == 404
+
+
+def test_assets_are_served_with_any_fingerprint(app, client):
+    asset = next(asset for asset in app.STATIC_ASSETS.values() if asset.versioned)
+    response = client.get(asset.url)
+    assert response.status_code == 200
+    assert response.cache_control.immutable
+    stale = client.get(asset.url.replace(asset.digest, '0' * app.STATIC_HASH_LENGTH))
+    assert stale.status_code == 200
+    assert not stale.cache_control.immutable
+    assert client.post('/grades.html').status_code == 405
@@ -0,0 +1,180 @@
+"""
+Grade store backends: one contract for MemoryStore, SqliteStore and
+RedisStore (against the RESP stand-in of resp_server.py).
+"""
+
+import os
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+TTL = 0.2  # seconds, short enough to wait out
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def make_store(request, app, tmp_path, resp_server):
+    """make_store(max_entries=None) -> a fresh store of each backend."""
+    def make(max_entries=None):
+        if request.param == 'memory':
+            return app.MemoryStore(max_entries or app.GRADE_STORE_MAX_ENTRIES)
+        if request.param == 'sqlite':
+            if max_entries:
+                pytest.skip('SqliteStore keeps every key until it expires')
+            return app.SqliteStore(str(tmp_path / 'store.sqlite3'))
+        resp_server.max_keys = max_entries
+        return app.RedisStore(resp_server.url(db=2))
+    return make
+
+
+def test_values_round_trip(make_store):
+    store = make_store()
+    value = {'voti': [7.5, 8, None], 'materia': 'ITALIANO', 'è': True}
+    store.set('grades:a', value)
+    assert store.get('grades:a') == value
+    assert store.get('grades:missing') is None
+    store.set('grades:a', [1])
+    assert store.get('grades:a') == [1]
+    store.delete('grades:a')
+    store.delete('grades:a')
+    assert store.get('grades:a') is None
+
+
+def test_least_recently_used_keys_are_evicted(make_store):
+    store = make_store(max_entries=3)
+    for key in 'abc':
+        store.set(key, key)
+    assert store.get('a') == 'a'  # b is now the least recently used
+    store.set('d', 'd')
+    assert store.get('b') is None
+    assert [store.get(key) for key in 'acd'] == ['a', 'c', 'd']
+
+
+def test_keys_expire_after_their_ttl(make_store):
+    store = make_store()
+    store.set('short', 1, ttl=TTL)
+    store.set('forever', 2)
+    assert store.add('lease', 'me', ttl=TTL)
+    assert store.incr('rate', ttl=TTL) == 1
+    assert sorted(store.keys('')) == ['forever', 'lease', 'rate', 'short']
+    time.sleep(TTL + 0.1)
+    assert store.get('short') is None
+    assert store.get('forever') == 2
+    assert store.keys('') == ['forever']
+    # Expired keys can be claimed and counted again
+    assert store.add('lease', 'you', ttl=TTL)
+    assert store.get('lease') == 'you'
+    assert store.incr('rate', ttl=TTL) == 1
+
+
+def test_add_only_sets_missing_keys(make_store):
+    store = make_store()
+    assert store.add('lease', 1, ttl=60)
+    assert not store.add('lease', 2, ttl=60)
+    assert store.get('lease') == 1
+    store.delete('lease')
+    assert store.add('lease', 3)
+    assert store.get('lease') == 3
+
+
+def test_incr_counts_from_one(make_store):
+    store = make_store()
+    assert [store.incr('bg:rate:1', ttl=120) for _ in range(3)] == [1, 2, 3]
+    assert store.incr('bg:rate:2') == 1
+    assert store.get('bg:rate:1') == 3
+
+
+def test_keys_lists_every_key_with_the_prefix(make_store):
+    store = make_store()
+    # More than one SCAN page (COUNT 200) of matching keys, mixed with others
+    expected = set()
+    for n in range(450):
+        store.set(f"active:{n}", n)
+        expected.add(f"active:{n}")
+        store.set(f"auth:{n}", n)
+    store.set('active*', 'glob characters are literal')
+    store.set('activ', 'shorter than the prefix')
+    assert set(store.keys('active:')) == expected
+    assert store.keys('active*') == ['active*']
+    assert store.keys('missing:') == []
+
+
+def test_redis_keys_follow_the_scan_cursor(app, resp_server):
+    store = app.RedisStore(resp_server.url())
+    for n in range(500):
+        store.set(f"stream:{n}", n)
+    resp_server.commands.clear()
+    assert len(store.keys('stream:')) == 500
+    assert resp_server.commands == ['SCAN'] * 3
+
+
+def test_redis_store_logs_in_and_reconnects(app, resp_server):
+    store = app.RedisStore(resp_server.url(db=3))
+    store.set('k', 1)
+    assert resp_server.commands[:2] == ['AUTH', 'SELECT']
+    resp_server.drop_connections()
+    assert store.get('k') == 1
+    assert resp_server.commands.count('AUTH') == 2
+    assert app.RedisStore(resp_server.url(db=0)).get('k') is None
+
+
+# Runs in its own interpreter: monkey-patching can't be undone in this one
+GEVENT_SCRIPT = textwrap.dedent('''
+    from gevent import monkey
+    monkey.patch_all()
+
+    import sqlite3
+    import sys
+    import time
+
+    import gevent
+
+    connects = []
+    connect = sqlite3.connect
+    sqlite3.connect = lambda *args, **kwargs: connects.append(args) or connect(*args, **kwargs)
+
+    import app
+
+    store = app.SqliteStore(sys.argv[1])
+    history = app.GradeHistory(sys.argv[2])
+
+    def request(n):
+        store.set(f'k{n}', {'n': n})
+        assert store.get(f'k{n}') == {'n': n}
+        store.incr('hits')
+        history.points('student', 'view', 'all', '', 'day')
+
+    gevent.joinall([gevent.spawn(request, n) for n in range(50)], raise_error=True)
+    assert store.get('hits') == 50
+    assert len(connects) == 2, len(connects)
+
+    # Another process holds the write lock: a writer waiting for it must not stall the other greenlets
+    other = connect(sys.argv[1], isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    ticks = []
+    def release():
+        for _ in range(5):
+            ticks.append(time.monotonic())
+            gevent.sleep(0.05)
+        other.execute('COMMIT')
+    started = time.monotonic()
+    gevent.joinall([gevent.spawn(store.set, 'blocked', 1), gevent.spawn(release)], raise_error=True)
+    assert store.get('blocked') == 1
+    assert len(ticks) == 5 and time.monotonic() - started < 5
+    print('ok')
+''')
+
+
+def test_sqlite_under_gevent_shares_one_connection_and_does_not_block(tmp_path):
+    pytest.importorskip('gevent')
+    env = dict(os.environ, SECRET_KEY='tests', GRADE_STORE='memory', GRADE_HISTORY='false', BACKGROUND_REFRESH='false')
+    result = subprocess.run(
+        [sys.executable, '-c', GEVENT_SCRIPT, str(tmp_path / 'store.sqlite3'), str(tmp_path / 'history.sqlite3')],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().endswith('ok')
@@ -0,0 +1,143 @@
+"""Upstream session lifecycle: the password is kept for renewals only when enabled."""
+
+import json
+
+import pytest
+
+
+class GradesResponse:
+    def __init__(self, payload):
+        self.status_code = 200
+        self.headers = {}
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+@pytest.fixture
+def client(app, make_payload, student, monkeypatch):
+    payload = make_payload(10)
+    monkeypatch.setattr(app, 'login', lambda user_id, password: {'token': 'tok', 'expire': '2099-01-01T00:00:00+01:00'})
+    monkeypatch.setattr(app, 'fetch_grades_response', lambda *args, **kwargs: GradesResponse(payload))
+    client = app.app.test_client()
+    response = client.post('/login', data={'user_id': student[1], 'user_pass': 'pässwörd'})
+    assert response.status_code == 200
+    return client
+
+
+def session_sid(client):
+    with client.session_transaction() as session:
+        return session['sid'], session.get('auth_pad')
+
+
+def test_password_is_not_kept_by_default(app, client):
+    sid, pad = session_sid(client)
+    assert pad is None
+    assert app.grade_store.get(app.auth_secret_key(sid)) is None
+    assert 'secret' not in app.grade_store.get(app.auth_key(sid))
+
+
+def test_kept_password_expires_with_the_session_and_goes_on_logout(app, monkeypatch, make_payload, student):
+    monkeypatch.setattr(app, 'UPSTREAM_AUTH_KEEP_PASSWORD', True)
+    monkeypatch.setattr(app, 'login', lambda user_id, password: {'token': 'tok', 'expire': '2099-01-01T00:00:00+01:00'})
+    monkeypatch.setattr(app, 'fetch_grades_response', lambda *args, **kwargs: GradesResponse(make_payload(5)))
+    client = app.app.test_client()
+    assert client.post('/login', data={'user_id': student[1], 'user_pass': 'pässwörd'}).status_code == 200
+
+    sid, pad = session_sid(client)
+    sealed = app.grade_store.get(app.auth_secret_key(sid))
+    assert app._unseal_secret(pad, sealed) == 'pässwörd'
+
+    # Gone once the upstream session has expired
+    app._store_secret(sid, sealed, expires_at=0)
+    assert app.grade_store.get(app.auth_secret_key(sid)) is None
+
+    app._store_secret(sid, sealed, expires_at=4102441200)
+    client.post('/logout')
+    assert app.grade_store.get(app.auth_secret_key(sid)) is None
+    assert app.grade_store.get(app.auth_key(sid)) is None
+
+
+def test_expired_session_is_not_renewed_without_the_password(app, client, monkeypatch):
+    sid, _ = session_sid(client)
+    auth = app.grade_store.get(app.auth_key(sid))
+    auth['expires_at'] = 0
+    app.grade_store.set(app.auth_key(sid), auth)
+    logins = []
+    monkeypatch.setattr(app, 'login', lambda user_id, password: logins.append(user_id))
+    monkeypatch.setattr(app, 'UPSTREAM_CACHE_TTL', 0)
+    monkeypatch.setattr(app, 'fetch_grades_response', lambda *args, **kwargs: app._raise_session_expired())
+
+    response = client.post('/refresh_grades')
+    assert response.status_code == 401
+    assert response.get_json()['redirect'] == '/'
+    assert logins == []
+
+
+def test_grades_hands_the_renewal_to_the_background_refresher(app, monkeypatch, make_payload, student):
+    monkeypatch.setattr(app, 'UPSTREAM_AUTH_KEEP_PASSWORD', True)
+    monkeypatch.setattr(app, 'BACKGROUND_REFRESH', True)
+    monkeypatch.setattr(app.background_refresher, 'ensure_started', lambda: None)
+    logins = []
+    def login(user_id, password):
+        logins.append(password)
+        return {'token': f'tok{len(logins)}', 'expire': '2099-01-01T00:00:00+01:00'}
+    monkeypatch.setattr(app, 'login', login)
+    monkeypatch.setattr(app, 'fetch_grades_response', lambda *args, **kwargs: GradesResponse(make_payload(5)))
+    client = app.app.test_client()
+    assert client.post('/login', data={'user_id': student[1], 'user_pass': 'pässwörd'}).status_code == 200
+    sid, pad = session_sid(client)
+
+    # Grades stale, upstream session about to expire
+    auth = app.grade_store.get(app.auth_key(sid))
+    auth['expires_at'] = app.time.time() + 10
+    app.grade_store.set(app.auth_key(sid), auth)
+    entry = app.grade_store.get(app.active_key(sid))
+    entry['checked_at'] = app.time.time() - app.BACKGROUND_REFRESH_INTERVAL - 60
+    app.grade_store.set(app.active_key(sid), entry)
+
+    response = client.get('/grades')
+    assert response.status_code == 200
+    assert response.headers['X-Grades-Stale'] == 'true'
+    assert logins == ['pässwörd']  # only the first login
+    assert app.grade_store.get(app.auth_pad_key(sid)) == pad
+    entry = app.grade_store.get(app.active_key(sid))
+    assert entry['next_refresh'] <= app.time.time()
+
+    app.background_refresher.refresh_session(sid, entry)
+    assert logins == ['pässwörd', 'pässwörd']
+    assert app.grade_store.get(app.auth_key(sid))['token'] == 'tok2'
+    assert app.grade_store.get(app.auth_pad_key(sid)) is None
+    assert app.grade_store.get(app.active_key(sid))['checked_at'] > app.time.time() - 5
+
+
+def test_background_refresher_does_not_renew_without_a_handed_over_pad(app, client, monkeypatch):
+    monkeypatch.setattr(app, 'UPSTREAM_AUTH_KEEP_PASSWORD', True)
+    sid, _ = session_sid(client)
+    auth = app.grade_store.get(app.auth_key(sid))
+    auth['expires_at'] = 0
+    app.grade_store.set(app.auth_key(sid), auth)
+    logins = []
+    monkeypatch.setattr(app, 'login', lambda user_id, password: logins.append(user_id))
+    entry = app.grade_store.get(app.active_key(sid))
+    checked_at = entry.get('checked_at')
+    app.background_refresher.refresh_session(sid, entry)
+    assert logins == []
+    assert app.grade_store.get(app.active_key(sid)).get('checked_at') == checked_at
+
+
+def test_legacy_cookie_without_sid_is_an_expired_session(app, monkeypatch):
+    fetches = []
+    monkeypatch.setattr(app, 'fetch_grades_response', lambda *args, **kwargs: fetches.append(args))
+    client = app.app.test_client()
+    # A cookie from before the grade store: token and user, no sid
+    with client.session_transaction() as session:
+        session.update(token='tok', login_type='userid', user_id='S1234567')
+
+    response = client.post('/refresh_grades')
+    assert response.status_code == 401
+    assert response.get_json()['redirect'] == '/'
+    assert fetches == []
+    with client.session_transaction() as session:
+        assert dict(session) == {}
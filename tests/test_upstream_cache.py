@@ -0,0 +1,130 @@
+"""Upstream response cache: refreshes skip, revalidate or reuse what they can."""
+
+import json
+
+import pytest
+
+from test_scraper import grades_page
+
+
+class StubResponse:
+    def __init__(self, status_code, payload=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = json.dumps(payload) if payload is not None else ''
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class StubSession:
+    """Stands in for the shared upstream requests session, answering from a script."""
+
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append((url, headers))
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def upstream(app, monkeypatch):
+    session = StubSession()
+    monkeypatch.setattr(app, 'upstream_session', lambda: session)
+    return session
+
+
+@pytest.fixture
+def cache_counts(app):
+    """cache_counts() -> the cache lookups by result since the test started."""
+    start = dict(app.CACHE_REQUESTS._values)
+    return lambda: {labels[0]: value - start.get(labels, 0) for labels, value in app.CACHE_REQUESTS._values.items()
+                    if value != start.get(labels, 0)}
+
+
+def fetch(app, student, document=None):
+    return app.fetch_student_grades(student[0], 'tok', student[1], document=document)
+
+
+def test_first_fetch_stores_the_validators(app, upstream, student, make_payload, cache_counts):
+    upstream.responses.append(StubResponse(200, make_payload(10), {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Sep 2025 08:00:00 GMT'}))
+    document = fetch(app, student)
+    assert document['source_hash'] == app._payload_hash(make_payload(10))
+    url, headers = upstream.requests[0]
+    assert url.endswith(f"/students/{student[1][1:]}/grades")
+    assert 'If-None-Match' not in headers and headers['Z-Auth-Token'] == 'tok'
+    assert cache_counts() == {'miss': 1}
+
+
+def test_refresh_within_the_ttl_does_not_call_upstream(app, upstream, student, make_payload, cache_counts):
+    upstream.responses.append(StubResponse(200, make_payload(10), {'ETag': '"v1"'}))
+    document = fetch(app, student)
+    assert fetch(app, student, document) is None
+    assert len(upstream.requests) == 1
+    assert cache_counts() == {'miss': 1, 'hit': 1}
+
+
+def test_expired_entry_is_revalidated_with_the_etag(app, upstream, student, make_payload, monkeypatch, cache_counts):
+    monkeypatch.setattr(app, 'UPSTREAM_CACHE_TTL', 0)
+    modified = 'Mon, 01 Sep 2025 08:00:00 GMT'
+    upstream.responses += [StubResponse(200, make_payload(10), {'ETag': '"v1"', 'Last-Modified': modified}),
+                           StubResponse(304)]
+    document = fetch(app, student)
+    assert fetch(app, student, document) is None
+    _, headers = upstream.requests[1]
+    assert headers['If-None-Match'] == '"v1"'
+    assert headers['If-Modified-Since'] == modified
+    assert cache_counts() == {'miss': 1, 'revalidated': 1}
+
+
+def test_caller_without_the_cached_data_gets_a_full_response(app, upstream, student, make_payload, monkeypatch):
+    monkeypatch.setattr(app, 'UPSTREAM_CACHE_TTL', 0)
+    upstream.responses += [StubResponse(200, make_payload(10), {'ETag': '"v1"'}),
+                           StubResponse(200, make_payload(10), {'ETag': '"v1"'})]
+    fetch(app, student)
+    # Another session of the student, with no document yet: a 304 would leave it empty
+    document = fetch(app, student)
+    assert document is not None
+    assert 'If-None-Match' not in upstream.requests[1][1]
+
+
+def test_unchanged_payload_skips_the_aggregation(app, upstream, student, make_payload, monkeypatch, cache_counts):
+    monkeypatch.setattr(app, 'UPSTREAM_CACHE_TTL', 0)
+    payload = make_payload(10)
+    # Same grades, new ETag and another key order: ClasseViva does not always send validators
+    reordered = {'grades': [dict(reversed(list(grade.items()))) for grade in payload['grades']]}
+    upstream.responses += [StubResponse(200, payload, {'ETag': '"v1"'}), StubResponse(200, reordered, {'ETag': '"v2"'})]
+    document = fetch(app, student)
+    monkeypatch.setattr(app, 'build_student_document', lambda *args: pytest.fail('aggregated an unchanged payload'))
+    assert fetch(app, student, document) is None
+    assert cache_counts() == {'miss': 1, 'unchanged': 1}
+    entry = app.grade_store.get(f"upstream:{student[0]}:{student[1][1:]}")
+    assert entry['etag'] == '"v2"'
+
+
+def test_changed_payload_builds_a_new_version(app, upstream, student, make_payload, monkeypatch):
+    monkeypatch.setattr(app, 'UPSTREAM_CACHE_TTL', 0)
+    changed = make_payload(10)
+    changed['grades'][0]['decimalValue'] = 2
+    upstream.responses += [StubResponse(200, make_payload(10), {'ETag': '"v1"'}), StubResponse(200, changed, {'ETag': '"v2"'})]
+    document = fetch(app, student)
+    new_document = fetch(app, student, document)
+    assert new_document['source_hash'] == app._payload_hash(changed)
+    assert new_document['version'] == document['version'] + 1
+
+
+def test_email_login_revalidates_the_grades_page(app, upstream, monkeypatch, cache_counts):
+    monkeypatch.setattr(app, 'UPSTREAM_CACHE_TTL', 0)
+    page = StubResponse(200, headers={'ETag': '"p1"'})
+    page.text = grades_page(app)
+    upstream.responses += [page, StubResponse(304)]
+    document = app.fetch_student_grades('email', 'sess', 'Studente@Scuola.it', 'ident')
+    assert document['table']
+    assert app.fetch_student_grades('email', 'sess', 'studente@scuola.it ', 'ident', document) is None
+    url, headers = upstream.requests[1]
+    assert url == app.GRADES_PAGE_URL
+    assert headers['Cookie'] == 'PHPSESSID=sess; webidentity=ident'
+    assert headers['If-None-Match'] == '"p1"'
+    assert cache_counts() == {'miss': 1, 'revalidated': 1}